@@ -6,12 +6,24 @@
 
 from django.contrib import admin
 
-from . import models
+from . import models, search
+
+
+class QuestionAdmin(admin.ModelAdmin):
+
+    list_display = ("text", "answer", "category", "point_value")
+    list_filter = ("point_value",)
+    list_select_related = ("category",)
+    search_fields = ("text", "answer")
+
+    def get_search_results(self, request, queryset, search_term):
+        # Searched through the full-text index rather than with LIKE on every row.
+        return search.filter_questions(queryset, search_term), False
 
 
 admin.site.register(models.UserData)
 admin.site.register(models.Category)
-admin.site.register(models.Question)
+admin.site.register(models.Question, QuestionAdmin)
 admin.site.register(models.Game)
 admin.site.register(models.GameRound)
 admin.site.register(models.CategoryState)
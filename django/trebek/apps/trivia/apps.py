@@ -5,8 +5,22 @@
 # :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
 
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+def repair_search_index(sender, using, **kwargs):
+    # A migration that rebuilds the question table on SQLite takes the index's triggers with it.
+    from . import search
+    connection = connections[using]
+    if connection.vendor == "sqlite" and search.has_index(connection):
+        with connection.schema_editor() as schema_editor:
+            search.install_index(schema_editor)
 
 
 class TriviaConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "trebek.apps.trivia"
+
+    def ready(self):
+        post_migrate.connect(repair_search_index, sender=self)
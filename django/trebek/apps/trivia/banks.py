@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Reading and writing question banks as CSV or JSON lines."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import csv
+import json
+
+from django.db import transaction
+
+from .models import bulk_create_ids, Category, Question
+
+
+FIELDS = ("category", "point_value", "text", "answer")
+FORMATS = ("csv", "jsonl")
+
+
+class BankError(Exception):
+
+    """A question bank couldn't be read."""
+
+
+def get_format(path):
+    """Guess a bank's format from its file name."""
+    if path.lower().endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    return "csv"
+
+
+def read_rows(file, format):
+    """Yield (line number, row dict) for each question in a bank."""
+    if format == "jsonl":
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as exc:
+                raise BankError(f"Line {line_number}: {exc}")
+            if not isinstance(row, dict):
+                raise BankError(f"Line {line_number}: expected an object")
+            yield line_number, row
+    else:
+        reader = csv.DictReader(file)
+        missing = set(FIELDS) - set(reader.fieldnames or ())
+        if missing:
+            raise BankError(f"Missing columns: {', '.join(sorted(missing))}")
+        for row in reader:
+            yield reader.line_num, row
+
+
+def write_rows(file, format, rows):
+    """Write (category, point value, text, answer) rows to a bank."""
+    if format == "jsonl":
+        for values in rows:
+            file.write(json.dumps(dict(zip(FIELDS, values))) + "\n")
+    else:
+        writer = csv.writer(file)
+        writer.writerow(FIELDS)
+        writer.writerows(rows)
+
+
+def make_question(line_number, row):
+    """Build an unsaved question from a row, with its category title as an attribute."""
+    try:
+        text = str(row["text"]).strip()
+        answer = str(row["answer"]).strip()
+        point_value = row.get("point_value")
+        # A point value of 0 is allowed, so only a missing one gets the default.
+        point_value = 200 if point_value in (None, "") else int(point_value)
+    except KeyError as exc:
+        raise BankError(f"Line {line_number}: missing {exc}")
+    except (TypeError, ValueError):
+        raise BankError(f"Line {line_number}: bad point value {row.get('point_value')!r}")
+    title = str(row.get("category") or "").strip()
+    for name, value, field in (("text", text, Question._meta.get_field("text")),
+                               ("answer", answer, Question._meta.get_field("answer")),
+                               ("category", title, Category._meta.get_field("title"))):
+        if len(value) > field.max_length:
+            raise BankError(f"Line {line_number}: {name} is longer than {field.max_length} characters")
+    if not text or not answer or not 0 <= point_value <= 32767:
+        raise BankError(f"Line {line_number}: needs a text, an answer and a point value from 0 to 32767")
+    question = Question(text=text, answer=answer, point_value=point_value)
+    question.category_title = title
+    return question
+
+
+class Importer:
+
+    """Loads rows from a question bank into the database in batches.
+
+    Only one batch of questions is held at a time, along with a map of
+    category titles to IDs so each category is created once. Each batch is
+    written in its own transaction, so an error part way through leaves the
+    batches before it in place.
+
+    """
+
+    def __init__(self, batch_size=2000):
+        self.batch_size = batch_size
+        self.category_ids = {}
+        for category_id, title in Category.objects.order_by("-id").values_list("id", "title").iterator():
+            # Where titles repeat, the oldest category wins.
+            self.category_ids[title] = category_id
+        self.question_count = 0
+        self.category_count = 0
+        self._batch = []
+
+    def add(self, question):
+        self._batch.append(question)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        new_titles = {question.category_title for question in batch
+                      if question.category_title and question.category_title not in self.category_ids}
+        new_ids = {}
+        with transaction.atomic():
+            if new_titles:
+                new_ids = bulk_create_ids(Category, (Category(title=title) for title in new_titles), "title")
+            for question in batch:
+                title = question.category_title
+                question.category_id = self.category_ids.get(title) or new_ids.get(title)
+            Question.objects.bulk_create(batch)
+        # Only once the batch is committed, so a failed one doesn't leave IDs behind that were rolled back.
+        self.category_ids.update(new_ids)
+        self.category_count += len(new_ids)
+        self.question_count += len(batch)
+
+    def load(self, rows):
+        """Import every (line number, row dict) pair."""
+        for line_number, row in rows:
+            self.add(make_question(line_number, row))
+        self.flush()
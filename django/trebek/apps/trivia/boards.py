@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Building game boards from an in-memory index of the question bank."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import random
+
+# Nothing in here touches the database, so boards can be built in worker processes.
+
+POINT_VALUES = (200, 400, 600, 800, 1000)
+# The number of wager questions in each round, and the values they can be hidden behind.
+WAGER_COUNTS = {1: 1, 2: 2}
+WAGER_POINT_VALUES = (400, 600, 800)
+
+
+class QuestionIndex:
+
+    """The IDs of the questions that can go on a board, by category and point value."""
+
+    def __init__(self, rows=()):
+        self.candidates = defaultdict(list)
+        for question_id, category_id, point_value in rows:
+            if point_value in POINT_VALUES:
+                self.candidates[(category_id, point_value)].append(question_id)
+
+    def get_full_categories(self):
+        """Return the IDs of the categories with a question at every point value."""
+        counts = defaultdict(int)
+        for category_id, _ in self.candidates:
+            counts[category_id] += 1
+        return sorted(category_id for category_id, count in counts.items() if count == len(POINT_VALUES))
+
+    def subset(self, category_ids):
+        """Return an index of just the given categories."""
+        category_ids = set(category_ids)
+        index = QuestionIndex()
+        index.candidates.update((key, ids) for key, ids in self.candidates.items() if key[0] in category_ids)
+        return index
+
+
+class BoardGenerator:
+
+    """Picks categories and questions for boards without repeating any.
+
+    Questions in the used set (say, from the last few games) are passed
+    over, as is every question the generator picks, so a batch of boards
+    from one generator never shares a question. A slot only gets a used
+    question if there's nothing else left for it.
+
+    """
+
+    def __init__(self, index, used=(), rng=None):
+        self.index = index
+        self.used = set(used)
+        self.rng = rng or random.Random()
+        self._full_categories = None
+
+    def pick_question(self, category_id, point_value):
+        choices = self.index.candidates.get((category_id, point_value))
+        if not choices:
+            return None
+        used = self.used
+        fresh = [question_id for question_id in choices if question_id not in used]
+        question_id = self.rng.choice(fresh or choices)
+        used.add(question_id)
+        return question_id
+
+    def pick_categories(self, round_sizes):
+        """Return a list of category IDs for each round, with no category in two rounds."""
+        if self._full_categories is None:
+            self._full_categories = self.index.get_full_categories()
+        full = self._full_categories
+        total = sum(round_sizes)
+        if total > len(full):
+            raise ValueError(f"A board needs {total} full categories, but there are only {len(full)}.")
+        chosen = self.rng.sample(full, total)
+        rounds = []
+        for size in round_sizes:
+            rounds.append(chosen[:size])
+            chosen = chosen[size:]
+        return rounds
+
+    def fill(self, rounds):
+        """Pick the questions for a board.
+
+        Rounds are (round number, category IDs) pairs. Returns a list of
+        (round number, question ID, requires wager) for every question.
+
+        """
+        questions = []
+        wager_choices = defaultdict(list)
+        for round_number, category_ids in rounds:
+            for category_id in category_ids:
+                for point_value in POINT_VALUES:
+                    question_id = self.pick_question(category_id, point_value)
+                    if question_id is None:
+                        continue
+                    if round_number in WAGER_COUNTS and point_value in WAGER_POINT_VALUES:
+                        wager_choices[round_number].append(len(questions))
+                    questions.append([round_number, question_id, False])
+        for round_number, count in WAGER_COUNTS.items():
+            choices = wager_choices[round_number]
+            for position in self.rng.sample(choices, min(count, len(choices))):
+                questions[position][2] = True
+        return [tuple(question) for question in questions]
+
+    def generate(self, round_sizes):
+        """Pick the categories and questions for a whole board.
+
+        Returns a (categories, questions) pair, where categories is a list
+        of category IDs for each round and questions is as from fill().
+
+        """
+        categories = self.pick_categories(round_sizes)
+        return categories, self.fill(zip(range(1, len(categories) + 1), categories))
+
+
+def _generate_share(index, count, round_sizes, used, seed):
+    generator = BoardGenerator(index, used, random.Random(seed))
+    return [generator.generate(round_sizes) for _ in range(count)]
+
+
+def generate_boards(index, count, round_sizes, used=(), workers=1, seed=None):
+    """Generate a batch of boards, over a pool of worker processes if asked.
+
+    Each worker gets its own share of the bank's categories, so boards from
+    different workers can't share a question either. Workers are cut back
+    if there aren't enough categories to give each of them a full board.
+
+    """
+    rng = random.Random(seed)
+    categories = index.get_full_categories()
+    workers = max(1, min(workers, count, len(categories) // max(1, sum(round_sizes))))
+    if workers == 1:
+        return _generate_share(index, count, round_sizes, used, rng.random())
+    rng.shuffle(categories)
+    shares = []
+    for worker in range(workers):
+        shares.append((index.subset(categories[worker::workers]),
+                       count // workers + (worker < count % workers),
+                       round_sizes, used, rng.random()))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_generate_share, *zip(*shares))
+        return [board for share in results for board in share]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""Export the question bank as CSV or JSON lines."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+from django.core.management.base import BaseCommand
+
+from ...banks import FORMATS, get_format, write_rows
+from ...models import Question
+
+
+class Command(BaseCommand):
+
+    help = "Export every question, in the format import_questions reads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The file to write, or - for standard output.")
+        parser.add_argument("--format", choices=FORMATS, help="Guessed from the file name if not given.")
+        parser.add_argument("--chunk-size", type=int, default=2000,
+                            help="How many questions are read from the database at a time.")
+
+    def handle(self, path, format=None, chunk_size=2000, **options):
+        format = format or get_format(path)
+        rows = (Question.objects
+                .order_by("id")
+                .values_list("category__title", "point_value", "text", "answer")
+                .iterator(chunk_size=chunk_size))
+        if path == "-":
+            write_rows(self.stdout, format, rows)
+        else:
+            with open(path, "w", newline="", encoding="utf-8") as file:
+                write_rows(file, format, rows)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Create a batch of games with their boards already generated."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import datetime
+import random
+import string
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...boards import generate_boards, POINT_VALUES, QuestionIndex
+from ...models import bulk_create_ids, CategoryState, Game, GameRound, Question, QuestionState
+
+
+class Command(BaseCommand):
+
+    help = ("Create games with randomly chosen categories and questions, none of which repeat "
+            "across the batch or the most recent games while the bank has others to offer.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("count", type=int, help="How many games to create.")
+        parser.add_argument("--name", default="Game", help="Games are named this followed by a number.")
+        parser.add_argument("--date", type=datetime.date.fromisoformat, default=None,
+                            help="The date of the games, as YYYY-MM-DD (today by default).")
+        parser.add_argument("--categories-per-round", type=int, default=6)
+        parser.add_argument("--rounds", type=int, default=2, help="Rounds before the final round.")
+        parser.add_argument("--recent", type=int, default=settings.BOARD_RECENT_GAMES,
+                            help="Avoid questions used in this many of the most recent games.")
+        parser.add_argument("--workers", type=int, default=1, help="Worker processes to build boards with.")
+        parser.add_argument("--seed", type=int, default=None)
+
+    def handle(self, count, name, date, categories_per_round, rounds, recent, workers, seed, **options):
+        date = date or datetime.date.today()
+        # Every regular round, then a final round with a single category.
+        round_sizes = [categories_per_round] * rounds + [1]
+        index = QuestionIndex(Question.objects
+                              .filter(category__isnull=False, point_value__in=POINT_VALUES)
+                              .order_by()
+                              .values_list("id", "category_id", "point_value")
+                              .iterator(chunk_size=10000))
+        used = Game.get_recent_question_ids(recent)
+        try:
+            boards = generate_boards(index, count, round_sizes, used, workers=workers, seed=seed)
+        except ValueError as exc:
+            raise CommandError(exc)
+        with transaction.atomic():
+            keys = self.make_keys(len(boards), random.Random(seed))
+            game_ids = bulk_create_ids(
+                Game, (Game(name=f"{name} {number}", date=date, key=key) for number, key in enumerate(keys, 1)), "key")
+            GameRound.objects.bulk_create(
+                GameRound(game_id=game_ids[key], round=round_number, is_final=round_number == len(round_sizes))
+                for key in keys for round_number in range(1, len(round_sizes) + 1))
+            round_ids = {(game_id, round_number): round_id for round_id, game_id, round_number in GameRound.objects
+                         .filter(game_id__in=game_ids.values())
+                         .values_list("id", "game_id", "round")}
+            category_states = []
+            question_states = []
+            for key, (categories, questions) in zip(keys, boards):
+                game_id = game_ids[key]
+                for round_number, category_ids in enumerate(categories, 1):
+                    category_states.extend(
+                        CategoryState(game_round_id=round_ids[(game_id, round_number)], category_id=category_id,
+                                      order=order)
+                        for order, category_id in enumerate(category_ids, 1))
+                question_states.extend(
+                    QuestionState(game_round_id=round_ids[(game_id, round_number)], question_id=question_id,
+                                  requires_wager=requires_wager)
+                    for round_number, question_id, requires_wager in questions)
+            CategoryState.objects.bulk_create(category_states, batch_size=2000)
+            QuestionState.objects.bulk_create(question_states, batch_size=2000)
+        self.stdout.write(f"Created {len(boards)} games: {', '.join(keys)}")
+
+    def make_keys(self, count, rng):
+        taken = set(Game.objects.values_list("key", flat=True))
+        keys = []
+        while len(keys) < count:
+            key = "".join(rng.choices(string.ascii_uppercase, k=4))
+            if key not in taken:
+                taken.add(key)
+                keys.append(key)
+        return keys
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""Import a question bank from CSV or JSON lines."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...banks import BankError, FORMATS, get_format, Importer, read_rows
+
+
+class Command(BaseCommand):
+
+    help = ("Import questions from a CSV file with category, point_value, text and answer columns, "
+            "or a JSON lines file of objects with those keys.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The file to import, or - for standard input.")
+        parser.add_argument("--format", choices=FORMATS, help="Guessed from the file name if not given.")
+        parser.add_argument("--batch-size", type=int, default=2000,
+                            help="How many questions are written in each transaction.")
+
+    def handle(self, path, format=None, batch_size=2000, **options):
+        format = format or get_format(path)
+        importer = Importer(batch_size=batch_size)
+        try:
+            if path == "-":
+                importer.load(read_rows(sys.stdin, format))
+            else:
+                with open(path, newline="", encoding="utf-8") as file:
+                    importer.load(read_rows(file, format))
+        except (BankError, OSError, UnicodeDecodeError) as exc:
+            raise CommandError(f"{exc} ({importer.question_count} questions were imported before this)")
+        self.stdout.write(f"Imported {importer.question_count} questions"
+                          f" and {importer.category_count} new categories.")
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.15 on 2026-10-18 15:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trivia', '0020_rename_requires_bid_questionstate_requires_wager'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='board_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 3.2.15 on 2026-10-18 18:02
+
+from django.db import migrations, models
+from django.db.utils import OperationalError
+
+
+# The SQL is copied here rather than imported from trivia.search, so this migration
+# keeps doing what it did when it was written however that module changes.
+SQLITE_INSTALL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS trivia_question_fts USING fts5("
+    "text, answer, content='trivia_question', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS trivia_question_fts_insert AFTER INSERT ON trivia_question BEGIN "
+    "INSERT INTO trivia_question_fts(rowid, text, answer) VALUES (new.id, new.text, new.answer); END",
+    "CREATE TRIGGER IF NOT EXISTS trivia_question_fts_delete AFTER DELETE ON trivia_question BEGIN "
+    "INSERT INTO trivia_question_fts(trivia_question_fts, rowid, text, answer) "
+    "VALUES ('delete', old.id, old.text, old.answer); END",
+    "CREATE TRIGGER IF NOT EXISTS trivia_question_fts_update AFTER UPDATE OF text, answer ON trivia_question BEGIN "
+    "INSERT INTO trivia_question_fts(trivia_question_fts, rowid, text, answer) "
+    "VALUES ('delete', old.id, old.text, old.answer); "
+    "INSERT INTO trivia_question_fts(rowid, text, answer) VALUES (new.id, new.text, new.answer); END",
+    "INSERT INTO trivia_question_fts(trivia_question_fts) VALUES ('rebuild')",
+)
+SQLITE_UNINSTALL = (
+    "DROP TRIGGER IF EXISTS trivia_question_fts_insert",
+    "DROP TRIGGER IF EXISTS trivia_question_fts_delete",
+    "DROP TRIGGER IF EXISTS trivia_question_fts_update",
+    "DROP TABLE IF EXISTS trivia_question_fts",
+)
+POSTGRES_INSTALL = ("CREATE INDEX IF NOT EXISTS trivia_question_search ON trivia_question "
+                    "USING GIN (to_tsvector('english', text || ' ' || answer))")
+POSTGRES_UNINSTALL = "DROP INDEX IF EXISTS trivia_question_search"
+
+
+def install_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        with schema_editor.connection.cursor() as cursor:
+            try:
+                for statement in SQLITE_INSTALL:
+                    cursor.execute(statement)
+            except OperationalError:
+                # SQLite was built without FTS5, searches will fall back to LIKE.
+                pass
+    elif vendor == "postgresql":
+        schema_editor.execute(POSTGRES_INSTALL)
+
+
+def uninstall_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        for statement in SQLITE_UNINSTALL:
+            schema_editor.execute(statement)
+    elif vendor == "postgresql":
+        schema_editor.execute(POSTGRES_UNINSTALL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trivia', '0021_game_board_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=('category', 'point_value'), name='trivia_question_cat_value'),
+        ),
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
@@ -4,11 +4,29 @@
 # :copyright: (c) 2018 Will Hutcheson
 # :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
 
-import random
+from collections import defaultdict
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+
+from .boards import BoardGenerator, POINT_VALUES, QuestionIndex
+
+
+def bulk_create_ids(model, objects, field):
+    """Insert a batch of new rows, returning a dict of their primary keys by a field.
+
+    Not every backend hands back primary keys from a bulk insert, so they're
+    read back by the field instead, which has to tell the new rows apart from
+    each other and from any already in the table.
+
+    """
+    objects = list(objects)
+    model.objects.bulk_create(objects)
+    values = [getattr(obj, field) for obj in objects]
+    return dict(model.objects.filter(**{f"{field}__in": values}).values_list(field, "pk"))
 
 
 class UserData(models.Model):
@@ -44,6 +62,8 @@ class Question(models.Model):
 
     class Meta:
         ordering = ("category", "point_value", "text")
+        # Board generation looks questions up by both at once.
+        indexes = [models.Index(fields=("category", "point_value"), name="trivia_question_cat_value")]
 
     def __str__(self):
         return "{} ({}): {}".format(self.category, self.point_value, self.text)
@@ -55,6 +75,8 @@ class Game(models.Model):
     date = models.DateField()
     key = models.CharField(max_length=4, unique=True)
     current_round = models.PositiveSmallIntegerField(default=0)
+    # Bumped whenever the board changes, so cached renders of it can be thrown out.
+    board_version = models.PositiveIntegerField(default=0)
 
     class Meta:
         ordering = ("date", "name")
@@ -63,52 +85,52 @@ class Game(models.Model):
         return str(self.name)
 
     def reset(self):
-        for question_state in QuestionState.objects.filter(game_round__game=self):
-            if question_state.answered:
-                question_state.answered = False
-                question_state.save()
-        for player in Player.objects.filter(game=self):
-            if player.score != 0:
-                player.score = 0
-                player.save()
-        self.current_round = 0
-        self.save()
+        with transaction.atomic():
+            QuestionState.objects.filter(game_round__game=self, answered=True).update(answered=False)
+            Player.objects.filter(game=self).exclude(score=0).update(score=0)
+            self.current_round = 0
+            self.board_version = F("board_version") + 1
+            self.save(update_fields=["current_round", "board_version"])
+            self.refresh_from_db(fields=["board_version"])
 
     def generate_questions(self):
-        # Delete any existing question states and reset the game.
-        QuestionState.objects.filter(game_round__game=self).delete()
-        self.reset()
-        # Randomly select questions from each point value group in each category.
-        point_groups = (200, 400, 600, 800, 1000)
-        for round in self.rounds.all():
-            for category in round.categories.all():
-                for point_value in point_groups:
-                    choices = category.questions.filter(point_value=point_value)
-                    if len(choices) < 1:
-                        continue
-                    question = random.choice(choices)
-                    question_state = QuestionState()
-                    question_state.game_round = round
-                    question_state.question = question
-                    question_state.save()
-        # Choose the wager questions for each round.
-        choices = QuestionState.objects.filter(
-            game_round__game=self,
-            game_round__round=1,
-            question__point_value__gte=400,
-            question__point_value__lte=800)
-        question_state = random.choice(choices)
-        question_state.requires_wager = True
-        question_state.save()
-        choices = QuestionState.objects.filter(
-            game_round__game=self,
-            game_round__round=2,
-            question__point_value__gte=400,
-            question__point_value__lte=800)
-        choices = list(choices)
-        for question_state in random.sample(choices, 2):
-            question_state.requires_wager = True
-            question_state.save()
+        with transaction.atomic():
+            # Delete any existing question states and reset the game.
+            QuestionState.objects.filter(game_round__game=self).delete()
+            self.reset()
+            category_states = list(CategoryState.objects
+                                   .filter(game_round__game=self)
+                                   .order_by("game_round__round", "order")
+                                   .values_list("game_round_id", "game_round__round", "category_id"))
+            # Load every candidate question at once, grouped by category and point value.
+            index = QuestionIndex(Question.objects
+                                  .filter(category__in={category_id for _, _, category_id in category_states},
+                                          point_value__in=POINT_VALUES)
+                                  .order_by()
+                                  .values_list("id", "category_id", "point_value"))
+            generator = BoardGenerator(index, used=Game.get_recent_question_ids(
+                settings.BOARD_RECENT_GAMES, exclude=self))
+            rounds = defaultdict(list)
+            round_ids = {}
+            for round_id, round_number, category_id in category_states:
+                rounds[round_number].append(category_id)
+                round_ids[round_number] = round_id
+            QuestionState.objects.bulk_create(
+                QuestionState(game_round_id=round_ids[round_number], question_id=question_id,
+                              requires_wager=requires_wager)
+                for round_number, question_id, requires_wager in generator.fill(rounds.items()))
+
+    @classmethod
+    def get_recent_question_ids(cls, game_count, exclude=None):
+        """Return the IDs of the questions used in the most recent games."""
+        if not game_count:
+            return set()
+        games = cls.objects.order_by("-date", "-id")
+        if exclude is not None:
+            games = games.exclude(pk=exclude.pk)
+        return set(QuestionState.objects
+                   .filter(game_round__game__in=games.values("id")[:game_count])
+                   .values_list("question_id", flat=True))
 
 
 class GameRound(models.Model):
@@ -128,6 +150,31 @@ class GameRound(models.Model):
     def __str__(self):
         return "{}: Round {}{}".format(self.game, self.round, " (Final)" if self.is_final else "")
 
+    def get_board(self, include_answers=False):
+        """Return this round's categories and the question data for each of them.
+
+        The whole board is loaded in two queries no matter how many categories
+        or questions it has.
+
+        """
+        category_states = self.categorystate_set.select_related("category")
+        question_states = self.questionstate_set.select_related("question")
+        questions_by_category = defaultdict(list)
+        for question_state in question_states:
+            question = question_state.question
+            question_data = {
+                "id": question.id,
+                "point_value": question.point_value * self.round,
+                "answered": question_state.answered,
+            }
+            if include_answers:
+                question_data["text"] = question.text
+                question_data["answer"] = question.answer
+                question_data["requires_wager"] = question_state.requires_wager
+            questions_by_category[question.category_id].append(question_data)
+        return [[category_state.category, questions_by_category[category_state.category_id]]
+                for category_state in category_states]
+
 
 class CategoryState(models.Model):
 
@@ -143,11 +190,12 @@ class CategoryState(models.Model):
         return "{}: {} ({})".format(self.game_round, self.category, self.order)
 
     def validate_unique(self, exclude=None):
-        rounds = self.game_round.game.rounds.exclude(round=self.game_round.round)
-        for round in rounds:
-            for category in round.categories.all():
-                if category == self.category:
-                    raise ValidationError("Category state with this Category already exists in Game.")
+        in_other_rounds = (CategoryState.objects
+                           .filter(game_round__game_id=self.game_round.game_id, category_id=self.category_id)
+                           .exclude(game_round_id=self.game_round_id)
+                           .exclude(pk=self.pk))
+        if in_other_rounds.exists():
+            raise ValidationError("Category state with this Category already exists in Game.")
         return super().validate_unique(exclude=exclude)
 
 
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Publisher for sending messages from the web server to the middleware."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import asyncio
+import json
+import logging
+import os
+import threading
+
+import websockets
+
+
+log = logging.getLogger(__name__)
+
+# These have to match MessageTypes in the middleware.
+SERVER_CONNECTED = 13
+PLAYER_REGISTERED = 14
+
+
+class Publisher:
+
+    """Sends messages to the middleware over one long-lived websocket.
+
+    Messages are put on a bounded outbox and sent by a background thread, so
+    publishing never blocks a request. If the outbox is full (because the
+    middleware is down, say) new messages are dropped.
+
+    """
+
+    def __init__(self, uri, ssl=None, max_size=1000, reconnect_delay=1.0):
+        self.uri = uri
+        self.ssl = ssl
+        self.max_size = max_size
+        self.reconnect_delay = reconnect_delay
+        self._loop = None
+        self._outbox = None
+        self._thread = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+
+    def publish(self, msg_type, msg_data={}):
+        """Queue a message to be sent, returning False if it was dropped."""
+        self._ensure_started()
+        with self._pending_lock:
+            if self._pending >= self.max_size:
+                log.warning(f"Publisher outbox is full, dropping message of type {msg_type}.")
+                return False
+            self._pending += 1
+        self._loop.call_soon_threadsafe(self._outbox.put_nowait, {"type": msg_type, "data": msg_data})
+        return True
+
+    def _ensure_started(self):
+        # Worker processes may be forked after this was created, and threads don't survive a fork.
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._loop = asyncio.new_event_loop()
+            self._pending = 0
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(ready,), name="trebek-publisher", daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+            ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self._loop)
+        # The outbox has to be created in this thread so it's bound to the right loop.
+        self._outbox = asyncio.Queue()
+        ready.set()
+        self._loop.run_until_complete(self._send_forever())
+
+    async def _connect(self):
+        while True:
+            try:
+                ws = await websockets.connect(self.uri, ssl=self.ssl)
+                await ws.send(json.dumps({"type": SERVER_CONNECTED, "data": {}}))
+                return ws
+            except (OSError, websockets.WebSocketException) as exc:
+                log.warning(f"Could not connect to middleware at {self.uri}: {exc!r}")
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def _send_forever(self):
+        ws = None
+        while True:
+            msg = await self._outbox.get()
+            with self._pending_lock:
+                self._pending -= 1
+            msg_json = json.dumps(msg)
+            while True:
+                if not ws or not ws.open:
+                    ws = await self._connect()
+                try:
+                    await ws.send(msg_json)
+                    break
+                except websockets.ConnectionClosed:
+                    ws = None
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Full-text search over the question bank."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import re
+
+from django.db import connection, models
+from django.db.models.expressions import RawSQL
+from django.db.utils import OperationalError
+
+
+SQLITE_TABLE = "trivia_question_fts"
+POSTGRES_INDEX = "trivia_question_search"
+POSTGRES_CONFIG = "english"
+
+# An external content table, so the text isn't stored twice; the triggers keep it in step.
+SQLITE_INSTALL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_TABLE} USING fts5("
+    "text, answer, content='trivia_question', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    f"CREATE TRIGGER IF NOT EXISTS {SQLITE_TABLE}_insert AFTER INSERT ON trivia_question BEGIN "
+    f"INSERT INTO {SQLITE_TABLE}(rowid, text, answer) VALUES (new.id, new.text, new.answer); END",
+    f"CREATE TRIGGER IF NOT EXISTS {SQLITE_TABLE}_delete AFTER DELETE ON trivia_question BEGIN "
+    f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}, rowid, text, answer) "
+    "VALUES ('delete', old.id, old.text, old.answer); END",
+    f"CREATE TRIGGER IF NOT EXISTS {SQLITE_TABLE}_update AFTER UPDATE OF text, answer ON trivia_question BEGIN "
+    f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}, rowid, text, answer) "
+    "VALUES ('delete', old.id, old.text, old.answer); "
+    f"INSERT INTO {SQLITE_TABLE}(rowid, text, answer) VALUES (new.id, new.text, new.answer); END",
+)
+SQLITE_TRIGGERS = (f"{SQLITE_TABLE}_insert", f"{SQLITE_TABLE}_delete", f"{SQLITE_TABLE}_update")
+
+POSTGRES_DOCUMENT = f"to_tsvector('{POSTGRES_CONFIG}', text || ' ' || answer)"
+
+
+def install_index(schema_editor):
+    """Create the search index for the database behind a schema editor.
+
+    This is safe to run again, and has to be on SQLite after any migration
+    that rebuilds the question table, as that drops the triggers with it.
+    Returns whether anything was (re)created.
+
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN (%s, %s, %s)",
+                           SQLITE_TRIGGERS)
+            if len(cursor.fetchall()) == len(SQLITE_TRIGGERS):
+                return False
+            try:
+                for statement in SQLITE_INSTALL:
+                    cursor.execute(statement)
+            except OperationalError:
+                # SQLite was built without FTS5, searches will fall back to LIKE.
+                return False
+            # Anything written while the triggers were missing isn't in the index yet.
+            cursor.execute(f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}) VALUES ('rebuild')")
+        return True
+    if vendor == "postgresql":
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS {POSTGRES_INDEX} ON trivia_question USING GIN ({POSTGRES_DOCUMENT})")
+        return True
+    return False
+
+
+def uninstall_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        for trigger in SQLITE_TRIGGERS:
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {SQLITE_TABLE}")
+    elif vendor == "postgresql":
+        schema_editor.execute(f"DROP INDEX IF EXISTS {POSTGRES_INDEX}")
+
+
+def has_index(db_connection=connection):
+    if db_connection.vendor == "sqlite":
+        return SQLITE_TABLE in db_connection.introspection.table_names()
+    return db_connection.vendor == "postgresql"
+
+
+def get_terms(query):
+    return re.findall(r"\w+", query)
+
+
+def filter_questions(queryset, query):
+    """Filter a queryset of questions down to those matching a search.
+
+    Every word in the search has to appear in the question's text or answer,
+    with the last one matched as a prefix so this works as you type.
+
+    """
+    terms = get_terms(query)
+    if not terms:
+        return queryset
+    if connection.vendor == "sqlite" and has_index():
+        match = " ".join(f'"{term}"' for term in terms) + "*"
+        return queryset.filter(id__in=RawSQL(
+            f"SELECT rowid FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s", (match,)))
+    if connection.vendor == "postgresql":
+        tsquery = " & ".join(terms) + ":*"
+        return queryset.annotate(search_match=RawSQL(
+            f"{POSTGRES_DOCUMENT} @@ to_tsquery('{POSTGRES_CONFIG}', %s)", (tsquery,),
+            output_field=models.BooleanField())).filter(search_match=True)
+    # No index to use, so scan the table instead.
+    for term in terms:
+        queryset = queryset.filter(models.Q(text__icontains=term) | models.Q(answer__icontains=term))
+    return queryset
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""Pinning games to middleware workers."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import zlib
+
+from django.conf import settings
+
+
+def get_worker_index(game_key, worker_count=None):
+    """Return the index of the middleware worker that hosts a game."""
+    if worker_count is None:
+        worker_count = len(settings.MIDDLEWARE_WORKERS)
+    # This has to be stable across processes, so the built-in hash() won't do.
+    return zlib.crc32(game_key.upper().encode()) % worker_count
+
+
+def get_worker(game_key):
+    """Return the (host, port) of the middleware worker that hosts a game."""
+    return settings.MIDDLEWARE_WORKERS[get_worker_index(game_key)]
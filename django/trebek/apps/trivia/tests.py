@@ -4,6 +4,418 @@
 # :copyright: (c) 2018 Will Hutcheson
 # :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
 
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+import websockets
+
+from .models import Category, CategoryState, Game, GameRound, Player, Question, QuestionState
+from .publisher import PLAYER_REGISTERED, Publisher, SERVER_CONNECTED
+from .search import filter_questions
+from .sharding import get_worker, get_worker_index
+
+
+def make_game(key, categories_per_round=2, questions_per_value=2, rounds=2):
+    """Create a game with a full board of categories and questions."""
+    game = Game.objects.create(name=f"Game {key}", date=datetime.date(2021, 6, 12), key=key)
+    for round_number in range(1, rounds + 1):
+        game_round = GameRound.objects.create(game=game, round=round_number)
+        for order in range(1, categories_per_round + 1):
+            category = Category.objects.create(title=f"{key} {round_number}-{order}")
+            CategoryState.objects.create(game_round=game_round, category=category, order=order)
+            for point_value in (200, 400, 600, 800, 1000):
+                for index in range(questions_per_value):
+                    Question.objects.create(
+                        category=category, text=f"Question {index}", answer="Answer", point_value=point_value)
+    return game
+
+
+def count_queries(func):
+    with CaptureQueriesContext(connection) as context:
+        func()
+    return len(context.captured_queries)
+
+
+class GameTestCase(TestCase):
+
+    def test_generate_questions(self):
+        game = make_game("GEN")
+        game.generate_questions()
+        for game_round in game.rounds.all():
+            question_states = QuestionState.objects.filter(game_round=game_round)
+            self.assertEqual(question_states.count(), 10)
+            for category in game_round.categories.all():
+                self.assertEqual(question_states.filter(question__category=category).count(), 5)
+        wagers = QuestionState.objects.filter(game_round__game=game, requires_wager=True)
+        self.assertEqual(wagers.filter(game_round__round=1).count(), 1)
+        self.assertEqual(wagers.filter(game_round__round=2).count(), 2)
+        self.assertFalse(wagers.exclude(question__point_value__in=(400, 600, 800)).exists())
+
+    def test_generate_questions_query_count(self):
+        small = make_game("SML", categories_per_round=1, questions_per_value=1)
+        large = make_game("LRG", categories_per_round=6, questions_per_value=5)
+        self.assertEqual(count_queries(small.generate_questions), count_queries(large.generate_questions))
+
+    def test_generate_questions_avoids_recent(self):
+        first = make_game("FST", questions_per_value=2)
+        first.generate_questions()
+        second = Game.objects.create(name="Second", date=first.date, key="SND")
+        third = Game.objects.create(name="Third", date=first.date, key="THD")
+        for game in (second, third):
+            for game_round in first.rounds.all():
+                new_round = GameRound.objects.create(game=game, round=game_round.round)
+                for category_state in CategoryState.objects.filter(game_round=game_round):
+                    CategoryState.objects.create(
+                        game_round=new_round, category_id=category_state.category_id, order=category_state.order)
+            game.generate_questions()
+        questions = {game.key: set(QuestionState.objects.filter(game_round__game=game).values_list("question_id"))
+                     for game in (first, second, third)}
+        self.assertFalse(questions["FST"] & questions["SND"])
+        # Once every question has been used, boards are still filled.
+        self.assertEqual(len(questions["THD"]), 20)
+
+    def test_category_unique_across_rounds(self):
+        game = make_game("UNQ")
+        category_state = CategoryState.objects.filter(game_round__game=game, game_round__round=1).first()
+        other_round = game.rounds.get(round=2)
+        duplicate = CategoryState(game_round=other_round, category=category_state.category, order=3)
+        with self.assertRaises(ValidationError):
+            duplicate.validate_unique()
+        category_state.validate_unique()
+
+    def test_reset(self):
+        game = make_game("RST")
+        game.generate_questions()
+        game.current_round = 2
+        game.save()
+        QuestionState.objects.filter(game_round__game=game).update(answered=True)
+        Player.objects.create(game=game, name="Alex", score=1200)
+        game.reset()
+        game.refresh_from_db()
+        self.assertEqual(game.current_round, 0)
+        self.assertFalse(QuestionState.objects.filter(game_round__game=game, answered=True).exists())
+        self.assertFalse(Player.objects.filter(game=game).exclude(score=0).exists())
+
+    def test_reset_query_count(self):
+        small = make_game("SML", categories_per_round=1)
+        large = make_game("LRG", categories_per_round=6)
+        for game in (small, large):
+            game.generate_questions()
+            QuestionState.objects.filter(game_round__game=game).update(answered=True)
+            for index in range(10):
+                Player.objects.create(game=game, name=f"Player {index}", score=index * 200)
+        self.assertEqual(count_queries(small.reset), count_queries(large.reset))
+
+
+class BoardViewTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def make_started_game(self, key, categories_per_round):
+        game = make_game(key, categories_per_round=categories_per_round)
+        game.generate_questions()
+        game.current_round = 1
+        game.save()
+        for index in range(3):
+            Player.objects.create(game=game, name=f"Player {index}")
+        return game
+
+    def test_board(self):
+        game = self.make_started_game("BRD", categories_per_round=3)
+        game_round = game.rounds.get(round=1)
+        board = game_round.get_board(include_answers=True)
+        self.assertEqual([category.title for category, _ in board], ["BRD 1-1", "BRD 1-2", "BRD 1-3"])
+        for category, questions in board:
+            self.assertEqual([question["point_value"] for question in questions], [200, 400, 600, 800, 1000])
+            for question in questions:
+                self.assertEqual(Question.objects.get(id=question["id"]).category, category)
+                self.assertIn("answer", question)
+        for _, questions in game_round.get_board():
+            for question in questions:
+                self.assertNotIn("answer", question)
+
+    def test_admin_query_count(self):
+        for key, categories_per_round in (("SML", 1), ("LRG", 6)):
+            game = self.make_started_game(key, categories_per_round)
+            with self.assertNumQueries(5):
+                response = self.client.get(f"/{game.key}/admin/", HTTP_HOST="testserver")
+            self.assertEqual(response.status_code, 200)
+
+    def test_display_query_count(self):
+        for key, categories_per_round in (("SML", 1), ("LRG", 6)):
+            game = self.make_started_game(key, categories_per_round)
+            with self.assertNumQueries(5):
+                response = self.client.get(f"/{game.key}/display/", HTTP_HOST="testserver")
+            self.assertEqual(response.status_code, 200)
+
+    def test_display_render_cache(self):
+        game = self.make_started_game("CHE", categories_per_round=3)
+        question_state = QuestionState.objects.filter(game_round__game=game, game_round__round=1).first()
+        point_value = question_state.get_modified_point_value()
+        self.client.get("/CHE/display/", HTTP_HOST="testserver")
+        # The board itself shouldn't be loaded again while the version hasn't changed.
+        with self.assertNumQueries(3):
+            self.client.get("/CHE/display/", HTTP_HOST="testserver")
+        question_state.answered = True
+        question_state.save()
+        # Without a version bump, the cached board is still served.
+        response = self.client.get("/CHE/display/", HTTP_HOST="testserver")
+        self.assertInHTML(
+            f'<div class="question" id="question-{question_state.question_id}"><p>{point_value}</p></div>',
+            response.content.decode())
+        game.board_version += 1
+        game.save()
+        with self.assertNumQueries(5):
+            response = self.client.get("/CHE/display/", HTTP_HOST="testserver")
+        self.assertInHTML(
+            f'<div class="question" id="question-{question_state.question_id}"><p></p></div>',
+            response.content.decode())
+
+
+class StateViewTestCase(TestCase):
+
+    def test_state(self):
+        game = make_game("STA")
+        game.generate_questions()
+        game.current_round = 1
+        game.save()
+        player = Player.objects.create(game=game, name="Alex", score=400)
+        response = self.client.get("/STA/state.json", HTTP_HOST="testserver")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["round"], 1)
+        self.assertEqual([category["title"] for category in data["categories"]], ["STA 1-1", "STA 1-2"])
+        self.assertEqual(len(data["categories"][0]["questions"]), 5)
+        self.assertNotIn("answer", data["categories"][0]["questions"][0])
+        self.assertEqual(data["players"], [{"id": player.id, "name": "Alex", "score": 400}])
+        etag = response["ETag"]
+        with self.assertNumQueries(2):
+            response = self.client.get("/STA/state.json", HTTP_HOST="testserver", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        # A score change has to produce a new tag.
+        player.score = 800
+        player.save()
+        response = self.client.get("/STA/state.json", HTTP_HOST="testserver", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class ShardingTestCase(TestCase):
+
+    @override_settings(MIDDLEWARE_WORKERS=[(None, 8765), ("ws.example.com", 8766), (None, 8767)])
+    def test_ws_uri(self):
+        uris = {None: "ws://testserver:{}", "ws.example.com": "ws://ws.example.com:{}"}
+        for key in ("AAA", "BBB", "CCC", "DDD"):
+            make_game(key, categories_per_round=1, rounds=1)
+            host, port = get_worker(key)
+            self.assertEqual(get_worker_index(key.lower()), get_worker_index(key))
+            response = self.client.get(f"/{key}/display/", HTTP_HOST="testserver")
+            self.assertEqual(response.context["ws_uri"], uris[host].format(port))
+
+
+class SearchTestCase(TestCase):
+
+    def search(self, query):
+        return set(filter_questions(Question.objects.all(), query).values_list("text", flat=True))
+
+    def test_search(self):
+        category = Category.objects.create(title="Literature")
+        Question.objects.create(category=category, text="He wrote Moby-Dick", answer="Herman Melville")
+        Question.objects.create(category=category, text="She wrote Frankenstein", answer="Mary Shelley")
+        self.assertEqual(self.search("melville"), {"He wrote Moby-Dick"})
+        self.assertEqual(self.search("wrote"), {"He wrote Moby-Dick", "She wrote Frankenstein"})
+        # The last word is matched as a prefix, so searches work as they're typed.
+        self.assertEqual(self.search("wrote frank"), {"She wrote Frankenstein"})
+        self.assertEqual(self.search("wrote dickens"), set())
+        self.assertEqual(len(self.search("")), 2)
+
+    def test_search_follows_changes(self):
+        question = Question.objects.create(text="The capital of Peru", answer="Lima")
+        question.answer = "Lima, Peru"
+        question.text = "This city was founded by Pizarro"
+        question.save()
+        self.assertEqual(self.search("capital"), set())
+        self.assertEqual(self.search("pizarro"), {question.text})
+        question.delete()
+        self.assertEqual(self.search("pizarro"), set())
+
+
+class QuestionBankTestCase(TestCase):
+
+    def import_bank(self, name, contents, batch_size=2):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, name)
+            with open(path, "w", encoding="utf-8") as file:
+                file.write(contents)
+            call_command("import_questions", path, batch_size=batch_size, stdout=io.StringIO())
+
+    def export_bank(self, format):
+        stdout = io.StringIO()
+        call_command("export_questions", "-", format=format, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_import(self):
+        Category.objects.create(title="Rivers")
+        self.import_bank("bank.csv", (
+            "category,point_value,text,answer\n"
+            "Rivers,200,It flows through Cairo,The Nile\n"
+            "Rivers,400,\"It flows through Vienna, Budapest and Belgrade\",The Danube\n"
+            "Opera,200,He wrote Aida,Verdi\n"
+            ",600,No category here,Nothing\n"))
+        self.assertEqual(Category.objects.filter(title="Rivers").count(), 1)
+        self.assertEqual(Question.objects.filter(category__title="Rivers").count(), 2)
+        self.assertEqual(Question.objects.get(answer="Verdi").category.title, "Opera")
+        self.assertIsNone(Question.objects.get(answer="Nothing").category)
+        self.import_bank("bank.jsonl", (
+            '{"category": "Opera", "point_value": 400, "text": "He wrote Carmen", "answer": "Bizet"}\n'
+            '\n'
+            '{"category": "Poets", "text": "She wrote Ariel", "answer": "Sylvia Plath"}\n'))
+        self.assertEqual(Category.objects.filter(title="Opera").count(), 1)
+        self.assertEqual(Question.objects.get(answer="Sylvia Plath").point_value, 200)
+
+    def test_import_zero_point_value(self):
+        self.import_bank("bank.jsonl", '{"category": "Opera", "point_value": 0, "text": "Warm-up", "answer": "Aida"}\n')
+        self.import_bank("bank.csv", "category,point_value,text,answer\nOpera,0,Warm-up,Tosca\nOpera,,Default,Carmen\n")
+        self.assertEqual(Question.objects.get(answer="Aida").point_value, 0)
+        self.assertEqual(Question.objects.get(answer="Tosca").point_value, 0)
+        self.assertEqual(Question.objects.get(answer="Carmen").point_value, 200)
+
+    def test_import_error(self):
+        with self.assertRaisesMessage(CommandError, "Line 4: bad point value 'lots'"):
+            self.import_bank("bank.csv", (
+                "category,point_value,text,answer\n"
+                "Opera,200,He wrote Aida,Verdi\n"
+                "Opera,400,He wrote Carmen,Bizet\n"
+                "Opera,lots,He wrote Tosca,Puccini\n"))
+        # Batches before the error are kept.
+        self.assertEqual(Question.objects.count(), 2)
+
+    def test_round_trip(self):
+        make_game("RND", categories_per_round=2, questions_per_value=1, rounds=1)
+        Question.objects.create(text="Uncategorized", answer="Answer")
+        for format in ("csv", "jsonl"):
+            exported = self.export_bank(format)
+            Question.objects.all().delete()
+            Category.objects.all().delete()
+            self.import_bank(f"bank.{format}", exported, batch_size=3)
+            self.assertEqual(Question.objects.count(), 11)
+            self.assertEqual(Category.objects.count(), 2)
+            self.assertEqual(self.export_bank(format), exported)
+
+
+class GenerateGamesTestCase(TestCase):
+
+    def test_generate_games(self):
+        for index in range(10):
+            category = Category.objects.create(title=f"Category {index}")
+            for point_value in (200, 400, 600, 800, 1000):
+                for _ in range(2):
+                    Question.objects.create(category=category, text="Question", answer="Answer",
+                                            point_value=point_value)
+        for workers in (1, 2):
+            Game.objects.all().delete()
+            call_command("generate_games", 2, name="Cup", categories_per_round=2, workers=workers, seed=1,
+                         stdout=io.StringIO())
+            used = []
+            for game in Game.objects.filter(name__startswith="Cup "):
+                self.assertEqual([(game_round.round, game_round.is_final) for game_round in game.rounds.all()],
+                                 [(1, False), (2, False), (3, True)])
+                categories = list(CategoryState.objects.filter(game_round__game=game).values_list("category_id"))
+                self.assertEqual(len(set(categories)), 5)
+                question_states = QuestionState.objects.filter(game_round__game=game)
+                self.assertEqual(question_states.count(), 25)
+                self.assertEqual(question_states.filter(requires_wager=True).count(), 3)
+                used.extend(question_states.values_list("question_id", flat=True))
+            self.assertEqual(len(used), 50)
+            self.assertEqual(len(set(used)), 50)
+
+    def test_generate_games_small_bank(self):
+        make_game("SML", categories_per_round=1, rounds=1)
+        with self.assertRaisesMessage(CommandError, "A board needs 13 full categories, but there are only 1."):
+            call_command("generate_games", 1, stdout=io.StringIO())
+
+
+class PublisherTestCase(SimpleTestCase):
+
+    """A stand-in middleware on its own thread, like the real one in its own process."""
+
+    def setUp(self):
+        self.received = queue.Queue()
+        self.connections = []
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        thread.start()
+        self.server = self.run_in_loop(self.serve())
+        self.addCleanup(thread.join)
+        self.addCleanup(self.loop.call_soon_threadsafe, self.loop.stop)
+        self.addCleanup(self.run_in_loop, self.server.wait_closed())
+        self.addCleanup(self.server.close)
+        self.uri = f"ws://localhost:{self.server.sockets[0].getsockname()[1]}"
+
+    def run_in_loop(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout=5)
+
+    async def serve(self):
+        return await websockets.serve(self.handle_connection, "localhost", 0)
+
+    async def handle_connection(self, ws, path):
+        self.connections.append(ws)
+        async for msg_json in ws:
+            self.received.put(json.loads(msg_json))
+
+    def receive(self):
+        msg = self.received.get(timeout=5)
+        return msg["type"], msg["data"]
+
+    def test_publish(self):
+        publisher = Publisher(self.uri, reconnect_delay=0.01)
+        self.assertTrue(publisher.publish(PLAYER_REGISTERED, {"player_id": 1}))
+        self.assertTrue(publisher.publish(PLAYER_REGISTERED, {"player_id": 2}))
+        self.assertEqual(self.receive(), (SERVER_CONNECTED, {}))
+        self.assertEqual(self.receive(), (PLAYER_REGISTERED, {"player_id": 1}))
+        self.assertEqual(self.receive(), (PLAYER_REGISTERED, {"player_id": 2}))
+        # Every message went over the one connection.
+        self.assertEqual(len(self.connections), 1)
+
+    def test_reconnect(self):
+        publisher = Publisher(self.uri, reconnect_delay=0.01)
+        publisher.publish(PLAYER_REGISTERED, {"player_id": 1})
+        self.assertEqual(self.receive(), (SERVER_CONNECTED, {}))
+        self.assertEqual(self.receive(), (PLAYER_REGISTERED, {"player_id": 1}))
+        # Like the middleware restarting.
+        self.run_in_loop(self.connections[0].close())
+        publisher.publish(PLAYER_REGISTERED, {"player_id": 2})
+        self.assertEqual(self.receive(), (SERVER_CONNECTED, {}))
+        self.assertEqual(self.receive(), (PLAYER_REGISTERED, {"player_id": 2}))
+        self.assertEqual(len(self.connections), 2)
+
+    def test_outbox_full(self):
+        self.server.close()
+        self.run_in_loop(self.server.wait_closed())
+        # Long enough that the one message being retried stays out of the outbox.
+        publisher = Publisher(self.uri, max_size=2, reconnect_delay=60)
+        with self.assertLogs("trebek.apps.trivia.publisher", "WARNING") as logs:
+            published = [publisher.publish(PLAYER_REGISTERED, {"player_id": player_id}) for player_id in range(5)]
+            # Wait for the first connection attempt, so its warning is caught here too.
+            for _ in range(500):
+                if any("Could not connect" in line for line in logs.output):
+                    break
+                time.sleep(0.01)
+        self.assertEqual(published[:2], [True, True])
+        self.assertIn(False, published)
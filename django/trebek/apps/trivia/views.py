@@ -4,35 +4,49 @@
 # :copyright: (c) 2018 Will Hutcheson
 # :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
 
-import asyncio
+import hashlib
 import json
 import re
-import ssl
 
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
-import websockets
+from django.utils.cache import get_conditional_response
+from django.utils.functional import SimpleLazyObject
 
 from .models import Game, Player
+from .publisher import PLAYER_REGISTERED, Publisher
+from .sharding import get_worker
 
 
 if settings.ENABLE_SSL:
-    WS_URI = "wss://{}:8765"
+    WS_URI = "wss://{}:{}"
 else:
-    WS_URI = "ws://{}:8765"
+    WS_URI = "ws://{}:{}"
+
+
+# One publisher per middleware worker, keyed by URI.
+PUBLISHERS = {}
+
+
+def get_ws_uri(request, game_key):
+    """Return the URI of the middleware worker that hosts a game."""
+    host, port = get_worker(game_key)
+    return WS_URI.format(host or request.META["HTTP_HOST"].split(":")[0], port)
+
+
+def get_publisher(game_key):
+    host, port = get_worker(game_key)
+    uri = WS_URI.format(host or "localhost", port)
+    if uri not in PUBLISHERS:
+        PUBLISHERS.setdefault(uri, Publisher(uri, ssl=True if settings.ENABLE_SSL else None))
+    return PUBLISHERS[uri]
 
 
 def msg(msg_type, msg_data):
-    """Send a message to the middleware server."""
-    async def send():
-        uri = WS_URI.format("localhost")
-        ssl_context = True if settings.ENABLE_SSL else None
-        async with websockets.connect(uri, ssl=ssl_context) as ws:
-            msg_data["type"] = msg_type
-            await ws.send(json.dumps(msg_data))
-        asyncio.get_event_loop().run_until_complete(send())
+    """Send a message to the middleware server without waiting for it."""
+    get_publisher(msg_data["game_key"]).publish(msg_type, msg_data)
 
 
 def one_up_player_name(game, name):
@@ -80,10 +94,11 @@ def trivia_home(request):
         })
     if not player:
         player = Player.objects.create(game=game, name=player_name)
-    msg("register_player", {
-        "game": game.key,
-        "id": player.id,
-        "name": player_name,
+    msg(PLAYER_REGISTERED, {
+        "game_key": game.key,
+        "player_id": player.id,
+        "player_name": player.name,
+        "score": player.score,
     })
     request.session["player_id"] = player.id
     return HttpResponseRedirect(reverse("buzzer", args=(game.key,)))
@@ -102,28 +117,16 @@ def admin(request, game_key):
     context = {
         "game": game,
         "players": Player.objects.filter(game=game),
-        "ws_uri": WS_URI.format(request.META["HTTP_HOST"].split(":")[0]),
+        "ws_uri": get_ws_uri(request, game.key),
+        "ws_encoding": settings.MIDDLEWARE_ENCODING,
     }
     if game.current_round == 0:
         return render(request, "trivia/admin_landing.html", context)
     game_round = game.rounds.get(round=game.current_round)
     context["final_round"] = game_round.is_final
-    categories = []
-    for category_state in game_round.categorystate_set.all():
-        questions = []
-        for question_state in game_round.questionstate_set.filter(question__category=category_state.category):
-            question = question_state.question
-            question_data = {
-                "id": question.id,
-                "text": question.text,
-                "answer": question.answer,
-                "point_value": question_state.get_modified_point_value(),
-                "answered": question_state.answered,
-                "requires_wager": question_state.requires_wager,
-            }
-            questions.append(question_data)
-        categories.append([category_state.category, questions])
-    context["categories"] = categories
+    # The board is only loaded if its cached render is missing or out of date.
+    context["categories"] = SimpleLazyObject(lambda: game_round.get_board(include_answers=True))
+    context["board_cache_timeout"] = settings.BOARD_CACHE_TIMEOUT
     return render(request, "trivia/admin_round.html", context)
 
 
@@ -132,29 +135,52 @@ def display(request, game_key):
     context = {
         "game": game,
         "players": Player.objects.filter(game=game),
-        "ws_uri": WS_URI.format(request.META["HTTP_HOST"].split(":")[0]),
+        "ws_uri": get_ws_uri(request, game.key),
+        "ws_encoding": settings.MIDDLEWARE_ENCODING,
     }
     if game.current_round == 0:
         context["host_url"] = request.META["HTTP_HOST"]
         return render(request, "trivia/display_landing.html", context)
     game_round = game.rounds.get(round=game.current_round)
     context["final_round"] = game_round.is_final
-    categories = []
-    for category_state in game_round.categorystate_set.all():
-        questions = []
-        for question_state in game_round.questionstate_set.filter(question__category=category_state.category):
-            question = question_state.question
-            question_data = {
-                "id": question.id,
-                "point_value": question_state.get_modified_point_value(),
-                "answered": question_state.answered,
-            }
-            questions.append(question_data)
-        categories.append([category_state.category, questions])
-    context["categories"] = categories
+    # The board is only loaded if its cached render is missing or out of date.
+    context["categories"] = SimpleLazyObject(game_round.get_board)
+    context["board_cache_timeout"] = settings.BOARD_CACHE_TIMEOUT
     return render(request, "trivia/display_round.html", context)
 
 
+def state(request, game_key):
+    """Return the game's board and scoreboard as JSON, with support for conditional GETs."""
+    game = get_object_or_404(Game, key=game_key)
+    players = list(Player.objects.filter(game=game).values("id", "name", "score"))
+    # The board is covered by its version, the scoreboard has to be hashed.
+    scoreboard = hashlib.sha1(json.dumps(players).encode()).hexdigest()
+    etag = f'"{game.key}-{game.current_round}-{game.board_version}-{scoreboard}"'
+    response = get_conditional_response(request, etag=etag)
+    if response:
+        # A 304 has to repeat the ETag, or the client's cached copy loses it.
+        response["ETag"] = etag
+        return response
+    data = {
+        "game": game.key,
+        "round": game.current_round,
+        "final_round": False,
+        "categories": [],
+        "players": players,
+    }
+    if game.current_round != 0:
+        game_round = game.rounds.get(round=game.current_round)
+        data["final_round"] = game_round.is_final
+        for category, questions in game_round.get_board():
+            data["categories"].append({
+                "title": category.title,
+                "questions": questions,
+            })
+    response = JsonResponse(data)
+    response["ETag"] = etag
+    return response
+
+
 def buzzer(request, game_key):
     player_id = request.session.get("player_id")
     if not player_id:
@@ -167,7 +193,8 @@ def buzzer(request, game_key):
     context = {
         "game": game,
         "player": player,
-        "ws_uri": WS_URI.format(request.META["HTTP_HOST"].split(":")[0]),
+        "ws_uri": get_ws_uri(request, game.key),
+        "ws_encoding": settings.MIDDLEWARE_ENCODING,
         "max_wager": player.score,
     }
     if game.current_round == 0:
@@ -77,14 +77,29 @@ WSGI_APPLICATION = "trebek.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
+# TREBEK_DATABASE points a process at another SQLite file, like the load test's throwaway one.
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+        "NAME": os.environ.get("TREBEK_DATABASE") or os.path.join(BASE_DIR, "db.sqlite3"),
     }
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+
+# Override this in local.py to share rendered boards between web server processes.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+# How long rendered round boards are kept, they're invalidated by the game's board version anyway.
+BOARD_CACHE_TIMEOUT = 60 * 60
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -142,6 +157,41 @@ SSL_CERT_PATH = ""
 SSL_KEY_PATH = ""
 
 
+# Middleware workers
+
+# Games are pinned to one of these (host, port) pairs by a hash of their key. A
+# host of None means the host the page was served from. "middleware.py --spawn"
+# starts every worker configured for that machine.
+MIDDLEWARE_WORKERS = [
+    (None, 8765),
+]
+
+# How workers pass messages for games they don't host to the ones that do: None,
+# "local", or a "redis://host:port" URL (scripts/backplane.py can stand in for Redis).
+MIDDLEWARE_BACKPLANE = None
+
+# How pages ask to be sent messages: "json", or "msgpack" for a more compact binary
+# encoding. Workers without msgpack installed fall back to JSON.
+MIDDLEWARE_ENCODING = "json"
+
+# permessage-deflate compression for middleware connections, or None to turn it off.
+# Messages shorter than min_size bytes are sent uncompressed, since they'd barely
+# shrink. The window and memory level set how much memory each connection uses.
+MIDDLEWARE_DEFLATE = {
+    "min_size": 256,
+    "level": 6,
+    "max_window_bits": 12,
+    "mem_level": 5,
+}
+
+
+# Board generation
+
+# Questions used in this many of the most recent games are kept off new boards
+# while there are others to choose from.
+BOARD_RECENT_GAMES = 10
+
+
 # Miscellaneous options
 
 APPEND_SLASH = True
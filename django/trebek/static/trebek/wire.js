@@ -0,0 +1,218 @@
+// Encoding and decoding of middleware messages, as JSON or msgpack.
+// Part of Trebek (https://github.com/whutch/trebek)
+// :copyright: (c) 2018 Will Hutcheson
+// :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+// Only what the middleware sends is supported: nil, booleans, numbers, strings, arrays and maps.
+function msgpack_encode(value) {
+    var bytes = [];
+    var utf8 = new TextEncoder();
+
+    function push_uint(number, size) {
+        for (var shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+            bytes.push((number >>> shift) & 0xff);
+        }
+    }
+
+    function push_header(length, fix_code, fix_size, code8, code16, code32) {
+        if (length < fix_size) {
+            bytes.push(fix_code | length);
+        } else if (code8 && length < 0x100) {
+            bytes.push(code8, length);
+        } else if (length < 0x10000) {
+            bytes.push(code16);
+            push_uint(length, 2);
+        } else {
+            bytes.push(code32);
+            push_uint(length, 4);
+        }
+    }
+
+    function write(value) {
+        if (value === null || value === undefined) {
+            bytes.push(0xc0);
+        } else if (value === false) {
+            bytes.push(0xc2);
+        } else if (value === true) {
+            bytes.push(0xc3);
+        } else if (typeof value == "number") {
+            if (Number.isInteger(value) && value >= 0 && value < 0x100000000) {
+                if (value < 0x80) {
+                    bytes.push(value);
+                } else if (value < 0x100) {
+                    bytes.push(0xcc, value);
+                } else if (value < 0x10000) {
+                    bytes.push(0xcd);
+                    push_uint(value, 2);
+                } else {
+                    bytes.push(0xce);
+                    push_uint(value, 4);
+                }
+            } else if (Number.isInteger(value) && value < 0 && value >= -0x80000000) {
+                if (value >= -32) {
+                    bytes.push(value & 0xff);
+                } else {
+                    bytes.push(0xd2);
+                    push_uint(value >>> 0, 4);
+                }
+            } else {
+                var view = new DataView(new ArrayBuffer(8));
+                view.setFloat64(0, value);
+                bytes.push(0xcb);
+                for (var i = 0; i < 8; i++) {
+                    bytes.push(view.getUint8(i));
+                }
+            }
+        } else if (typeof value == "string") {
+            var encoded = utf8.encode(value);
+            push_header(encoded.length, 0xa0, 32, 0xd9, 0xda, 0xdb);
+            for (var i = 0; i < encoded.length; i++) {
+                bytes.push(encoded[i]);
+            }
+        } else if (Array.isArray(value)) {
+            push_header(value.length, 0x90, 16, null, 0xdc, 0xdd);
+            for (var i = 0; i < value.length; i++) {
+                write(value[i]);
+            }
+        } else {
+            // Like JSON.stringify, keys with undefined values are left out.
+            var keys = Object.keys(value).filter(function (key) {
+                return value[key] !== undefined;
+            });
+            push_header(keys.length, 0x80, 16, null, 0xde, 0xdf);
+            for (var i = 0; i < keys.length; i++) {
+                write(keys[i]);
+                write(value[keys[i]]);
+            }
+        }
+    }
+
+    write(value);
+    return new Uint8Array(bytes);
+}
+
+function msgpack_decode(bytes) {
+    var view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    var utf8 = new TextDecoder();
+    var pos = 0;
+
+    function take(size) {
+        pos += size;
+        return pos - size;
+    }
+
+    function read_str(length) {
+        var start = take(length);
+        return utf8.decode(bytes.subarray(start, start + length));
+    }
+
+    function read_array(length) {
+        var value = [];
+        for (var i = 0; i < length; i++) {
+            value.push(read());
+        }
+        return value;
+    }
+
+    function read_map(length) {
+        var value = {};
+        for (var i = 0; i < length; i++) {
+            var key = read();
+            value[key] = read();
+        }
+        return value;
+    }
+
+    function read() {
+        var code = bytes[take(1)];
+        if (code < 0x80) {
+            return code;
+        } else if (code < 0x90) {
+            return read_map(code & 0x0f);
+        } else if (code < 0xa0) {
+            return read_array(code & 0x0f);
+        } else if (code < 0xc0) {
+            return read_str(code & 0x1f);
+        } else if (code >= 0xe0) {
+            return code - 0x100;
+        }
+        switch (code) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xca: return view.getFloat32(take(4));
+            case 0xcb: return view.getFloat64(take(8));
+            case 0xcc: return view.getUint8(take(1));
+            case 0xcd: return view.getUint16(take(2));
+            case 0xce: return view.getUint32(take(4));
+            case 0xcf: var start = take(8); return view.getUint32(start) * 0x100000000 + view.getUint32(start + 4);
+            case 0xd0: return view.getInt8(take(1));
+            case 0xd1: return view.getInt16(take(2));
+            case 0xd2: return view.getInt32(take(4));
+            case 0xd3: var start = take(8); return view.getInt32(start) * 0x100000000 + view.getUint32(start + 4);
+            case 0xd9: return read_str(view.getUint8(take(1)));
+            case 0xda: return read_str(view.getUint16(take(2)));
+            case 0xdb: return read_str(view.getUint32(take(4)));
+            case 0xdc: return read_array(view.getUint16(take(2)));
+            case 0xdd: return read_array(view.getUint32(take(4)));
+            case 0xde: return read_map(view.getUint16(take(2)));
+            case 0xdf: return read_map(view.getUint32(take(4)));
+        }
+        throw new Error("Unsupported msgpack type 0x" + code.toString(16));
+    }
+
+    return read();
+}
+
+// The encoding a page asks for is only used once the middleware agrees to it in a RESUME message,
+//  so every connection starts out in JSON. Messages are decoded by how they arrive, text or binary.
+function Wire(requested) {
+    this.requested = requested;
+    this.encoding = "json";
+}
+
+Wire.prototype.open = function (uri) {
+    var ws = new WebSocket(uri);
+    ws.binaryType = "arraybuffer";
+    this.encoding = "json";
+    return ws;
+};
+
+Wire.prototype.agree = function (encoding) {
+    this.encoding = encoding || "json";
+};
+
+Wire.prototype.encode = function (msg) {
+    if (this.encoding == "msgpack") {
+        return msgpack_encode([msg.type, msg.data]);
+    }
+    return JSON.stringify(msg);
+};
+
+Wire.prototype.decode = function (data) {
+    if (typeof data == "string") {
+        return JSON.parse(data);
+    }
+    var values = msgpack_decode(new Uint8Array(data));
+    return {
+        type: values[0],
+        data: values[1],
+        seq: values[2],
+    };
+};
+
+// Reload a page that was rendered for a different round than the middleware says the game is in. The
+//  middleware rereads the game when the two disagree, but if they still don't match after a reload the
+//  page is left as it is rather than reloading forever. Returns whether the page is reloading.
+function reload_for_round(rendered, current) {
+    var key = "trebek-round-reload";
+    var mismatch = location.pathname + ":" + rendered + ":" + current;
+    var last = JSON.parse(sessionStorage.getItem(key) || "null");
+    if (last && last.mismatch == mismatch && Date.now() - last.time < 60000) {
+        console.error("The middleware says round " + current + " but reloading still gave round " + rendered + ".");
+        return false;
+    }
+    sessionStorage.setItem(key, JSON.stringify({mismatch: mismatch, time: Date.now()}));
+    location.reload();
+    return true;
+}
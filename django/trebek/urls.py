@@ -34,4 +34,5 @@ urlpatterns = [
     path("<str:game_key>/admin/", trivia_views.admin, name="admin"),
     path("<str:game_key>/buzzer/", trivia_views.buzzer, name="buzzer"),
     path("<str:game_key>/display/", trivia_views.display, name="display"),
+    path("<str:game_key>/state.json", trivia_views.state, name="state"),
 ]
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Pub/sub backplane for passing messages between middleware workers."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import argparse
+import asyncio
+from collections import defaultdict
+import logging
+from urllib.parse import urlsplit
+
+
+log = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 1.0
+# Reconnects back off up to this long while they keep failing.
+MAX_RECONNECT_DELAY = 30.0
+
+
+class BackplaneError(Exception):
+    """An error reply from the backplane server."""
+
+
+class Backplane:
+
+    """Delivers messages published on a channel to its subscribers.
+
+    Messages are strings, and subscribers are coroutine functions that are
+    called with the channel and message.
+
+    """
+
+    async def start(self):
+        pass
+
+    async def subscribe(self, channel, callback):
+        raise NotImplementedError
+
+    async def publish(self, channel, message):
+        """Publish a message, returning how many subscribers received it."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalBackplane(Backplane):
+
+    """A backplane within a single process, for tests and single workers."""
+
+    def __init__(self):
+        self._callbacks = defaultdict(list)
+
+    async def subscribe(self, channel, callback):
+        self._callbacks[channel].append(callback)
+
+    async def publish(self, channel, message):
+        callbacks = self._callbacks.get(channel, ())
+        for callback in callbacks:
+            asyncio.ensure_future(callback(channel, message))
+        return len(callbacks)
+
+
+def _bulk(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def encode_command(*args):
+    """Encode a command in the Redis protocol."""
+    return b"*%d\r\n" % len(args) + b"".join(_bulk(arg) for arg in args)
+
+
+async def read_reply(reader):
+    """Read one reply (or command) in the Redis protocol."""
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed.")
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest.decode()
+    elif prefix == b"-":
+        raise BackplaneError(rest.decode())
+    elif prefix == b":":
+        return int(rest)
+    elif prefix == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    elif prefix == b"*":
+        count = int(rest)
+        if count < 0:
+            return None
+        return [await read_reply(reader) for _ in range(count)]
+    raise BackplaneError(f"Unexpected reply: {line!r}")
+
+
+class RedisBackplane(Backplane):
+
+    """A backplane using Redis pub/sub, or anything that speaks its protocol.
+
+    Publishing and subscribing use separate connections, since a subscribed
+    connection can't be used for anything else. Both reconnect as needed,
+    including after an error reply (say, if the server wants a password);
+    messages published while the subscriber is disconnected are lost.
+
+    """
+
+    def __init__(self, host="localhost", port=6379, reconnect_delay=RECONNECT_DELAY,
+                 max_reconnect_delay=MAX_RECONNECT_DELAY):
+        self.host = host
+        self.port = port
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self._callbacks = {}
+        self._publisher = None
+        self._publish_lock = None
+        self._subscriber = None
+        self._listener = None
+
+    async def start(self):
+        self._publish_lock = asyncio.Lock()
+        self._listener = asyncio.ensure_future(self._listen())
+
+    async def subscribe(self, channel, callback):
+        self._callbacks[channel] = callback
+        if self._subscriber:
+            self._subscriber.write(encode_command("SUBSCRIBE", channel))
+
+    async def publish(self, channel, message):
+        async with self._publish_lock:
+            # Retry once, in case the connection went stale while idle.
+            for attempt in range(2):
+                try:
+                    if not self._publisher:
+                        self._publisher = await asyncio.open_connection(self.host, self.port)
+                    reader, writer = self._publisher
+                    writer.write(encode_command("PUBLISH", channel, message))
+                    return await read_reply(reader)
+                except (OSError, asyncio.IncompleteReadError, BackplaneError) as exc:
+                    log.warning(f"Could not publish to backplane at {self.host}:{self.port}: {exc!r}")
+                    self._close_publisher()
+        return 0
+
+    async def _listen(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as exc:
+                log.warning(f"Could not connect to backplane at {self.host}:{self.port}: {exc!r}")
+            else:
+                self._subscriber = writer
+                if self._callbacks:
+                    writer.write(encode_command("SUBSCRIBE", *self._callbacks))
+                try:
+                    while True:
+                        reply = await read_reply(reader)
+                        # The server is taking commands, so the next time it goes away can be retried sooner.
+                        delay = self.reconnect_delay
+                        if isinstance(reply, list) and reply[0] == b"message":
+                            await self._deliver(reply[1].decode(), reply[2].decode())
+                except (OSError, asyncio.IncompleteReadError, BackplaneError) as exc:
+                    log.warning(f"Lost connection to backplane at {self.host}:{self.port}: {exc!r}")
+                finally:
+                    self._subscriber = None
+                    writer.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def _deliver(self, channel, message):
+        callback = self._callbacks.get(channel)
+        if not callback:
+            return
+        try:
+            # Handled in line so messages keep their order.
+            await callback(channel, message)
+        except Exception:
+            # One bad message mustn't take down the subscription.
+            log.exception(f"Error handling backplane message on {channel}: {message}")
+
+    def _close_publisher(self):
+        if self._publisher:
+            self._publisher[1].close()
+            self._publisher = None
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        if self._subscriber:
+            self._subscriber.close()
+            self._subscriber = None
+        self._close_publisher()
+
+
+def create_backplane(url):
+    """Create a backplane from a URL: None, "local", or "redis://host:port"."""
+    if not url:
+        return None
+    if url == "local":
+        return LocalBackplane()
+    parts = urlsplit(url)
+    if parts.scheme == "redis":
+        return RedisBackplane(parts.hostname or "localhost", parts.port or 6379)
+    raise ValueError(f"Unknown backplane: {url}")
+
+
+class StandInServer:
+
+    """A stand-in for Redis that only knows PUBLISH, SUBSCRIBE and PING."""
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+
+    async def handle_connection(self, reader, writer):
+        channels = set()
+        try:
+            while True:
+                command = await read_reply(reader)
+                if not isinstance(command, list) or not command:
+                    writer.write(b"-ERR expected a command\r\n")
+                    continue
+                name = command[0].upper()
+                if name == b"SUBSCRIBE":
+                    for channel in command[1:]:
+                        channels.add(channel)
+                        self._subscribers[channel].add(writer)
+                        writer.write(b"*3\r\n" + _bulk("subscribe") + _bulk(channel) + b":%d\r\n" % len(channels))
+                elif name == b"PUBLISH" and len(command) == 3:
+                    channel, message = command[1:]
+                    subscribers = self._subscribers.get(channel, ())
+                    for subscriber in subscribers:
+                        subscriber.write(b"*3\r\n" + _bulk("message") + _bulk(channel) + _bulk(message))
+                    writer.write(b":%d\r\n" % len(subscribers))
+                elif name == b"PING":
+                    writer.write(b"+PONG\r\n")
+                else:
+                    writer.write(b"-ERR unknown command '%s'\r\n" % command[0])
+        except (OSError, asyncio.IncompleteReadError, BackplaneError):
+            pass
+        finally:
+            for channel in channels:
+                self._subscribers[channel].discard(writer)
+            writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a stand-in for Redis pub/sub.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    stand_in = StandInServer()
+    loop.run_until_complete(asyncio.start_server(stand_in.handle_connection, args.host, args.port))
+    log.info(f"Backplane stand-in listening on {args.host}:{args.port}.")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
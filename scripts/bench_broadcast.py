@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Benchmark broadcast delivery skew across simulated players."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+import middleware
+from middleware import Display, Game, MessageTypes, Player
+
+
+class FakeWebSocket:
+    """A stand-in websocket that takes a random amount of time to send."""
+
+    def __init__(self, latency):
+        self.open = True
+        self.latency = latency
+        self.delivered_at = None
+
+    async def send(self, msg):
+        await asyncio.sleep(self.latency)
+        self.delivered_at = time.perf_counter()
+
+    async def close(self):
+        self.open = False
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def make_game(game_key, player_count, slow_fraction, rng):
+    game = Game(game_key)
+    sockets = []
+    for index in range(player_count):
+        if rng.random() < slow_fraction:
+            # A phone on bad venue Wi-Fi.
+            latency = rng.uniform(0.2, 0.5)
+        else:
+            latency = rng.uniform(0.001, 0.005)
+        ws = FakeWebSocket(latency)
+        sockets.append(ws)
+        Player(ws, game_key, index, f"Player {index}")
+    display_ws = FakeWebSocket(0.001)
+    sockets.append(display_ws)
+    Display(display_ws, game_key)
+    # These never connected for real, so there's nothing for them to catch up on.
+    for client in list(game.displays) + list(game.players):
+        client.catching_up = False
+    return game, sockets
+
+
+async def serial_broadcast(game, msg_type, msg_data):
+    # The pre-fan-out behavior: one client at a time.
+    for client in list(game.displays) + list(game.players):
+        client.send_message(msg_type, msg_data)
+        await client.drain()
+
+
+async def concurrent_broadcast(game, msg_type, msg_data):
+    await game.broadcast(msg_type, msg_data, audiences=("displays", "players"))
+    await asyncio.gather(*[client.drain() for client in list(game.displays) + list(game.players)])
+
+
+async def run(name, broadcast, args):
+    rng = random.Random(args.seed)
+    game, sockets = make_game(name, args.players, args.slow, rng)
+    msg_data = {"question_id": "bench", "question_text": "This is a benchmark question."}
+    start = time.perf_counter()
+    await broadcast(game, MessageTypes.POP_QUESTION, msg_data)
+    elapsed = time.perf_counter() - start
+    skews = [(ws.delivered_at - start) * 1000 for ws in sockets if ws.delivered_at is not None]
+    dropped = sum(1 for ws in sockets if ws.delivered_at is None)
+    print(f"{name:>10}: total {elapsed * 1000:9.1f}ms  p50 {percentile(skews, 0.5):9.1f}ms"
+          f"  p99 {percentile(skews, 0.99):9.1f}ms  dropped {dropped}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--slow", type=float, default=0.05, help="fraction of players on slow connections")
+    parser.add_argument("--timeout", type=float, default=middleware.SEND_TIMEOUT)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    middleware.SEND_TIMEOUT = args.timeout
+    middleware.log.setLevel(logging.ERROR)
+    print(f"Broadcasting POP_QUESTION to {args.players} players ({args.slow:.0%} slow).")
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run("serial", serial_broadcast, args))
+    loop.run_until_complete(run("concurrent", concurrent_broadcast, args))
+
+
+if __name__ == "__main__":
+    main()
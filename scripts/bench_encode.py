@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the cost of encoding a message for a broadcast."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import argparse
+import json
+import timeit
+
+import middleware
+from middleware import Frame, MessageTypes
+
+
+MESSAGES = {
+    "POP_QUESTION": (MessageTypes.POP_QUESTION, {
+        "question_id": "0b8f0f8a-2f4b-4f8e-9d6c-4a1f0c6f2b71",
+        "question_text": "This 19th century novel opens with the line 'Call me Ishmael.'",
+    }),
+    "PLAY_SOUND": (MessageTypes.PLAY_SOUND, {
+        "sound": "time",
+    }),
+}
+
+
+def encode_per_recipient(msg_type, msg_data, recipients):
+    # The old behavior: a fresh dict and json.dumps for every client.
+    for _ in range(recipients):
+        msg = {}
+        msg["type"] = msg_type
+        msg["data"] = msg_data
+        json.dumps(msg)
+
+
+def encode_once(msg_type, msg_data, recipients):
+    Frame(msg_type, msg_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--number", type=int, default=1000)
+    args = parser.parse_args()
+    print(f"Encoding broadcasts to {args.players} players using {middleware.JSON_BACKEND}.")
+    for name, (msg_type, msg_data) in MESSAGES.items():
+        for label, encode in (("before", encode_per_recipient), ("after", encode_once)):
+            elapsed = timeit.timeit(lambda: encode(msg_type, msg_data, args.players), number=args.number)
+            per_broadcast = elapsed / args.number * 1000000
+            print(f"{name:>12} {label:>6}: {per_broadcast:10.1f}us per broadcast")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Benchmark board generation and question search over a large question bank."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import argparse
+import datetime
+import os
+from os.path import abspath, dirname, join
+import random
+import sys
+import time
+
+import django
+from django.db import connection
+
+
+BASE_DIR = dirname(dirname(abspath(__file__)))
+DJANGO_DIR = join(BASE_DIR, "django")
+sys.path.insert(0, DJANGO_DIR)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "trebek.settings")
+django.setup()
+
+from trebek.apps.trivia import search  # noqa: E402
+from trebek.apps.trivia.models import bulk_create_ids, Category, CategoryState, Game, GameRound, Question  # noqa: E402
+
+
+POINT_VALUES = (200, 400, 600, 800, 1000)
+WORDS = ("river", "empire", "novel", "planet", "composer", "treaty", "mountain", "painter", "element", "island",
+         "king", "queen", "war", "ocean", "poet", "desert", "opera", "bridge", "battle", "city", "language",
+         "inventor", "festival", "volcano", "museum", "dynasty", "symphony", "canal", "glacier", "temple")
+SEARCHES = ("melville", "symphony", "river empire", "volc", "ocean poet treaty")
+
+
+def make_bank(question_count, rng):
+    """Fill the database with random categories and questions, returning the category IDs."""
+    category_count = max(1, question_count // (len(POINT_VALUES) * 20))
+    categories = sorted(bulk_create_ids(
+        Category, (Category(title=f"Category {index}") for index in range(category_count)), "title").values())
+    questions = []
+    for index in range(question_count):
+        words = " ".join(rng.choice(WORDS) for _ in range(8))
+        questions.append(Question(
+            category_id=categories[index % category_count], point_value=POINT_VALUES[index // category_count % 5],
+            text=f"This {words} ({index})", answer=" ".join(rng.choice(WORDS) for _ in range(2))))
+    # The one needle for searches to find.
+    questions[-1].answer = "Herman Melville"
+    Question.objects.bulk_create(questions, batch_size=2000)
+    return categories
+
+
+def make_game(categories, categories_per_round, rng):
+    game = Game.objects.create(name="Benchmark", date=datetime.date.today(), key="BNCH")
+    chosen = iter(rng.sample(categories, categories_per_round * 2 + 1))
+    for round_number in (1, 2, 3):
+        game_round = GameRound.objects.create(game=game, round=round_number, is_final=round_number == 3)
+        for order in range(1, (categories_per_round if round_number < 3 else 1) + 1):
+            CategoryState.objects.create(game_round=game_round, category_id=next(chosen), order=order)
+    return game
+
+
+def best_of(repeats, func):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run(game, repeats):
+    results = {"generate_questions": best_of(repeats, game.generate_questions)}
+    for query in SEARCHES:
+        results[f"search {query!r}"] = best_of(
+            repeats, lambda: list(search.filter_questions(Question.objects.all(), query)[:100]))
+    return results
+
+
+def drop_indexes():
+    with connection.schema_editor() as schema_editor:
+        schema_editor.execute("DROP INDEX trivia_question_cat_value")
+        search.uninstall_index(schema_editor)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=100000)
+    parser.add_argument("--categories-per-round", type=int, default=6)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # A throwaway database, so the real one is never touched.
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        start = time.perf_counter()
+        categories = make_bank(args.questions, rng)
+        game = make_game(categories, args.categories_per_round, rng)
+        print(f"Built a bank of {args.questions} questions in {len(categories)} categories"
+              f" in {time.perf_counter() - start:.1f}s.")
+        indexed = run(game, args.repeats)
+        drop_indexes()
+        unindexed = run(game, args.repeats)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    print(f"{'':<32}{'indexed':>12}{'unindexed':>12}")
+    for name, seconds in indexed.items():
+        print(f"{name:<32}{seconds * 1000:>10.2f}ms{unindexed[name] * 1000:>10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""Load test the middleware with simulated admin, display and player clients."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import argparse
+import asyncio
+from collections import defaultdict
+import datetime
+import json
+import os
+from os.path import dirname, join
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+import middleware
+from django.db import connection
+from middleware import MessageTypes, msgpack
+from trebek.apps.trivia import models
+
+
+TYPE_NAMES = {value: name for name, value in vars(MessageTypes).items() if not name.startswith("_")}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Stats:
+
+    """Timings collected from every simulated client."""
+
+    def __init__(self):
+        self.sent_at = {}
+        self.buzz_sent_at = {}
+        self.latencies = defaultdict(list)
+        self.received = defaultdict(int)
+        self.total_received = 0
+        self.total_sent = 0
+        self.bytes_received = 0
+        self.inversions = 0
+        self.pairs = 0
+        self.first_buzz_correct = 0
+        self.questions = 0
+
+    def mark(self, *msg_types):
+        now = time.perf_counter()
+        for msg_type in msg_types:
+            self.sent_at[msg_type] = now
+
+    def record(self, msg_type, msg_data):
+        self.total_received += 1
+        self.received[msg_type] += 1
+        if msg_type == MessageTypes.PING:
+            # Pings come from the middleware's own schedule, stamped with its clock.
+            self.latencies[msg_type].append(time.time() - msg_data["start_time"])
+            return
+        elif msg_type == MessageTypes.PLAYER_BUZZED:
+            sent_at = self.buzz_sent_at.get(msg_data.get("player_id"))
+        else:
+            sent_at = self.sent_at.get(msg_type)
+        if sent_at is not None:
+            self.latencies[msg_type].append(time.perf_counter() - sent_at)
+
+    def record_buzz_order(self, order):
+        """Compare the order buzzes were broadcast in to the order they were sent in."""
+        sent_order = sorted(order, key=lambda player_id: self.buzz_sent_at[player_id])
+        rank = {player_id: index for index, player_id in enumerate(sent_order)}
+        ranks = [rank[player_id] for player_id in order]
+        for index, first in enumerate(ranks):
+            for second in ranks[index + 1:]:
+                self.pairs += 1
+                if first > second:
+                    self.inversions += 1
+        self.questions += 1
+        if order and order[0] == sent_order[0]:
+            self.first_buzz_correct += 1
+
+
+class SimulatedClient:
+
+    # The encoding to ask for, and whether to offer permessage-deflate.
+    encoding = "json"
+    compression = "deflate"
+
+    def __init__(self, stats, game_key):
+        self.stats = stats
+        self.game_key = game_key
+        self.ws = None
+        self._reader = None
+        self._sending = "json"
+
+    async def connect(self, uri):
+        self.ws = await websockets.connect(uri, max_queue=None, compression=self.compression)
+        self._reader = asyncio.ensure_future(self.read())
+        await self.send(self.connect_type, dict(self.connect_data(), encoding=self.encoding))
+
+    def connect_data(self):
+        return {}
+
+    async def send(self, msg_type, msg_data={}):
+        msg_data = dict(msg_data, game_key=self.game_key)
+        self.stats.total_sent += 1
+        if self._sending == "msgpack":
+            await self.ws.send(msgpack.packb([msg_type, msg_data], use_bin_type=True))
+        else:
+            await self.ws.send(json.dumps({"type": msg_type, "data": msg_data}))
+
+    async def read(self):
+        try:
+            async for msg in self.ws:
+                self.stats.bytes_received += len(msg)
+                if isinstance(msg, bytes):
+                    values = msgpack.unpackb(msg, raw=False)
+                    msg = {"type": values[0], "data": values[1]}
+                else:
+                    msg = json.loads(msg)
+                if msg["type"] == MessageTypes.RESUME:
+                    self._sending = msg["data"]["encoding"]
+                self.stats.record(msg["type"], msg["data"])
+                await self.handle_message(msg["type"], msg["data"])
+        except websockets.ConnectionClosed:
+            pass
+
+    async def handle_message(self, msg_type, msg_data):
+        pass
+
+    async def close(self):
+        await self.ws.close()
+        await self._reader
+
+
+class SimulatedAdmin(SimulatedClient):
+
+    connect_type = MessageTypes.ADMIN_CONNECTED
+
+    def __init__(self, stats, game_key):
+        super().__init__(stats, game_key)
+        self.buzzes = []
+
+    async def handle_message(self, msg_type, msg_data):
+        if msg_type == MessageTypes.PLAYER_BUZZED:
+            self.buzzes.append(msg_data["player_id"])
+
+
+class SimulatedDisplay(SimulatedClient):
+
+    connect_type = MessageTypes.DISPLAY_CONNECTED
+
+
+class SimulatedPlayer(SimulatedClient):
+
+    connect_type = MessageTypes.PLAYER_CONNECTED
+
+    def __init__(self, stats, game_key, player_id, player_name):
+        super().__init__(stats, game_key)
+        self.id = player_id
+        self.name = player_name
+        self.question_id = None
+
+    def connect_data(self):
+        return {"player_id": self.id, "player_name": self.name}
+
+    async def send(self, msg_type, msg_data={}):
+        await super().send(msg_type, dict(msg_data, player_id=self.id, player_name=self.name))
+
+    async def handle_message(self, msg_type, msg_data):
+        if msg_type == MessageTypes.PING:
+            await self.send(MessageTypes.PING, dict(msg_data, client_time=time.time()))
+        elif msg_type == MessageTypes.POP_QUESTION:
+            self.question_id = msg_data["question_id"]
+
+    async def buzz(self, delay):
+        await asyncio.sleep(delay)
+        self.stats.buzz_sent_at[self.id] = time.perf_counter()
+        await self.send(MessageTypes.PLAYER_BUZZED, {"question_id": self.question_id})
+
+
+class ServerMonitor:
+
+    """Reads CPU time and memory use of the middleware process from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK")
+        self.start_cpu = self.cpu_time()
+        self.start_time = time.perf_counter()
+
+    def cpu_time(self):
+        with open(f"/proc/{self.pid}/stat") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        # utime and stime are the 14th and 15th fields, counting the pid and name.
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def memory(self, key):
+        with open(f"/proc/{self.pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) / 1024
+        return 0
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start_time
+        cpu = self.cpu_time() - self.start_cpu
+        print(f"Server CPU: {cpu:.2f}s ({cpu / elapsed:.0%} of one core),"
+              f" RSS {self.memory('VmRSS'):.1f}MB, peak {self.memory('VmHWM'):.1f}MB")
+
+
+def create_game(game_key, player_count):
+    """Create a throwaway game with a board and players in the database."""
+    if models.Game.objects.filter(key=game_key).exists():
+        sys.exit(f"A game with the key {game_key} already exists, pick another with --game-key.")
+    game = models.Game.objects.create(name="Load test", date=datetime.date.today(), key=game_key)
+    # A category of its own, so nothing in the real bank is touched when it's deleted.
+    category = models.Category.objects.create(title=f"Load test {game_key}")
+    for point_value in (200, 400, 600, 800, 1000):
+        models.Question.objects.create(
+            category=category, text=f"Load test question for {point_value}.", answer="Load",
+            point_value=point_value)
+    game_round = models.GameRound.objects.create(game=game, round=1)
+    models.GameRound.objects.create(game=game, round=2, is_final=True)
+    models.CategoryState.objects.create(game_round=game_round, category=category)
+    game.generate_questions()
+    models.Player.objects.bulk_create(
+        [models.Player(game=game, name=f"Load {index}") for index in range(player_count)])
+    question_ids = list(models.QuestionState.objects.filter(game_round=game_round).values_list("question_id", flat=True))
+    players = list(models.Player.objects.filter(game=game).values_list("id", "name"))
+    return category.id, question_ids, players
+
+
+def delete_game(game_key, category_id):
+    models.Game.objects.filter(key=game_key).delete()
+    # Questions outlive their category, so they have to go first.
+    models.Question.objects.filter(category_id=category_id).delete()
+    models.Category.objects.filter(id=category_id).delete()
+
+
+def create_database(directory):
+    """Switch to a new, migrated SQLite database in a directory, returning its path."""
+    path = join(directory, "db.sqlite3")
+    connection.settings_dict["TEST"]["NAME"] = path
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    return path
+
+
+def start_server(port, worker_index, database, state_dir, verbose):
+    output = None if verbose else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, join(dirname(__file__), "middleware.py"),
+                                "--port", str(port), "--worker", str(worker_index), "--state-dir", state_dir],
+                               env=dict(os.environ, TREBEK_DATABASE=database), stdout=output, stderr=output)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("middleware did not start")
+
+
+async def wait_until(condition, timeout):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.001)
+    return True
+
+
+async def connect_all(clients, uri, batch_size=50):
+    for index in range(0, len(clients), batch_size):
+        await asyncio.gather(*[client.connect(uri) for client in clients[index:index + batch_size]])
+
+
+async def run_game(args, uri, question_ids, player_rows, stats):
+    admin = SimulatedAdmin(stats, args.game_key)
+    displays = [SimulatedDisplay(stats, args.game_key) for _ in range(args.displays)]
+    players = [SimulatedPlayer(stats, args.game_key, player_id, name) for player_id, name in player_rows]
+    await admin.connect(uri)
+    await connect_all(displays + players, uri)
+    await wait_until(lambda: stats.received[MessageTypes.PLAYER_CONNECTED] >= len(players) * (1 + len(displays)), 30)
+    everyone = len(players) + len(displays) + 1
+    start = time.perf_counter()
+    stats.mark(MessageTypes.CHANGE_ROUND)
+    await admin.send(MessageTypes.CHANGE_ROUND, {"round": 1})
+    await wait_until(lambda: stats.received[MessageTypes.CHANGE_ROUND] >= everyone, args.timeout)
+    rng = random.Random(args.seed)
+    for number in range(args.questions):
+        question_id = question_ids[number % len(question_ids)]
+        received = dict(stats.received)
+        stats.buzz_sent_at.clear()
+        admin.buzzes.clear()
+        # Pop the question.
+        stats.mark(MessageTypes.POP_QUESTION)
+        await admin.send(MessageTypes.POP_QUESTION, {
+            "question_id": question_id,
+            "question_text": "Load test question.",
+            "specific_player": None,
+        })
+        await wait_until(lambda: stats.received[MessageTypes.POP_QUESTION]
+                         >= received.get(MessageTypes.POP_QUESTION, 0) + len(players) + len(displays), args.timeout)
+        # Everyone buzzes at once.
+        await asyncio.gather(*[player.buzz(rng.uniform(0, args.buzz_spread)) for player in players])
+        await wait_until(lambda: len(admin.buzzes) >= len(players), args.timeout)
+        stats.record_buzz_order(admin.buzzes)
+        # Clear it and give the first buzzer some points.
+        stats.mark(MessageTypes.CLEAR_QUESTION, MessageTypes.UPDATE_SCORE)
+        await admin.send(MessageTypes.CLEAR_QUESTION, {"question_id": question_id, "answered": True})
+        if admin.buzzes:
+            await admin.send(MessageTypes.UPDATE_SCORE, {"player_id": admin.buzzes[0], "score": 200 * (number + 1)})
+        await wait_until(lambda: stats.received[MessageTypes.CLEAR_QUESTION]
+                         >= received.get(MessageTypes.CLEAR_QUESTION, 0) + len(players) + len(displays), args.timeout)
+    stats.mark(MessageTypes.CHANGE_ROUND)
+    await admin.send(MessageTypes.CHANGE_ROUND, {"round": 2})
+    await wait_until(lambda: stats.received[MessageTypes.CHANGE_ROUND] >= everyone * 2, args.timeout)
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*[client.close() for client in [admin] + displays + players])
+    return elapsed
+
+
+def report(stats, elapsed):
+    print(f"Sent {stats.total_sent} and received {stats.total_received} messages in {elapsed:.2f}s"
+          f" ({stats.total_received / elapsed:.0f} msg/s), {stats.bytes_received / 1024:.1f}KB before compression.")
+    print(f"{'message':>22} {'count':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for msg_type, latencies in sorted(stats.latencies.items()):
+        latencies = [latency * 1000 for latency in latencies]
+        print(f"{TYPE_NAMES.get(msg_type, msg_type):>22} {len(latencies):7d}"
+              f" {percentile(latencies, 0.5):7.2f}ms {percentile(latencies, 0.9):7.2f}ms"
+              f" {percentile(latencies, 0.99):7.2f}ms {max(latencies):7.2f}ms")
+    if stats.pairs:
+        print(f"Buzz ordering: {stats.inversions / stats.pairs:.2%} of pairs out of order,"
+              f" first buzz correct in {stats.first_buzz_correct} of {stats.questions} questions.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--displays", type=int, default=2)
+    parser.add_argument("--questions", type=int, default=10)
+    parser.add_argument("--buzz-spread", type=float, default=0.05,
+                        help="players buzz at random within this many seconds")
+    parser.add_argument("--timeout", type=float, default=10, help="how long to wait for each step")
+    parser.add_argument("--game-key", default="LOAD")
+    parser.add_argument("--port", type=int, default=8766, help="port to start a middleware instance on")
+    parser.add_argument("--uri", help="use an already running middleware (and its database) instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="process to report CPU and memory for with --uri")
+    parser.add_argument("--encoding", choices=middleware.ENCODINGS, default="json")
+    parser.add_argument("--no-deflate", action="store_true", help="don't offer permessage-deflate")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="with --uri, don't delete the test game afterwards")
+    parser.add_argument("--verbose", action="store_true", help="show the middleware's output")
+    args = parser.parse_args()
+    middleware.log.setLevel("WARNING")
+    SimulatedClient.encoding = args.encoding
+    SimulatedClient.compression = None if args.no_deflate else "deflate"
+    process = None
+    scratch = None
+    if args.uri:
+        uri = args.uri
+        pid = args.server_pid
+        category_id, question_ids, players = create_game(args.game_key, args.players)
+    else:
+        # The middleware started here gets a database and journal of its own, thrown away afterwards.
+        scratch = tempfile.TemporaryDirectory(prefix="trebek-loadtest-")
+        database = create_database(scratch.name)
+        category_id, question_ids, players = create_game(args.game_key, args.players)
+        # Run as whichever worker hosts the test game, so it isn't turned away.
+        process = start_server(args.port, middleware.get_worker_index(args.game_key), database,
+                               join(scratch.name, "state"), args.verbose)
+        uri = f"ws://localhost:{args.port}"
+        pid = process.pid
+    monitor = ServerMonitor(pid) if pid else None
+    stats = Stats()
+    print(f"Running {args.questions} questions with {args.players} players and {args.displays} displays.")
+    try:
+        loop = asyncio.get_event_loop()
+        elapsed = loop.run_until_complete(run_game(args, uri, question_ids, players, stats))
+        report(stats, elapsed)
+        if monitor:
+            monitor.report()
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        if scratch:
+            connection.close()
+            scratch.cleanup()
+        elif not args.keep:
+            delete_game(args.game_key, category_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Metrics for the middleware, served in the Prometheus text format."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import asyncio
+from bisect import bisect_left
+from collections import defaultdict
+import logging
+
+
+log = logging.getLogger(__name__)
+
+# Bucket upper bounds in seconds, from well under a millisecond up to a stalled send.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# How many observations a histogram holds before sorting them into its buckets.
+HISTOGRAM_BUFFER_SIZE = 4096
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class Metric:
+
+    """A named set of values, keyed by the values of its labels.
+
+    Keys are a tuple of label values, or just the value if there's one label.
+    Recording is kept to a dict or list operation and everything else is put
+    off until the metric is scraped, so metrics can be recorded on every
+    message.
+
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), names=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # Optional display names for label values, e.g. message types by number.
+        self.names = names or {}
+
+    def format_labels(self, key, extra=()):
+        if not self.labels:
+            values = ()
+        elif len(self.labels) == 1:
+            values = (self.names.get(key, key),)
+        else:
+            values = key
+        pairs = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, values)]
+        pairs.extend(f'{label}="{_escape(value)}"' for label, value in extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        """Yield (suffix, labels, value) for each sample."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_number(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+
+    """Values that only ever go up."""
+
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = defaultdict(int)
+
+    def inc(self, key=None, amount=1):
+        self.values[key] += amount
+
+    def samples(self):
+        for key, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            yield "", self.format_labels(key), value
+
+
+class Gauge(Metric):
+
+    """Values that are read from the process when it's scraped.
+
+    The collect function returns a dict of values by key, so nothing has to
+    be kept up to date between scrapes.
+
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, collect, labels=(), names=None):
+        super().__init__(name, help, labels, names)
+        self.collect = collect
+
+    def samples(self):
+        for key, value in sorted(self.collect().items(), key=lambda item: str(item[0])):
+            yield "", self.format_labels(key), value
+
+
+class Histogram(Metric):
+
+    """Counts of observed values by bucket, with their sum.
+
+    Observations are buffered and only sorted into buckets when the metric is
+    scraped or the buffer fills up.
+
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), names=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels, names)
+        self.buckets = tuple(buckets)
+        # [count per bucket..., count above the last bucket, sum] by key.
+        self.values = {}
+        self._buffer = []
+
+    def observe(self, value, key=None):
+        buffer = self._buffer
+        buffer.append((key, value))
+        if len(buffer) >= HISTOGRAM_BUFFER_SIZE:
+            self.fold()
+
+    def fold(self):
+        """Sort the buffered observations into their buckets."""
+        buffer, self._buffer = self._buffer, []
+        values = self.values
+        buckets = self.buckets
+        for key, value in buffer:
+            counts = values.get(key)
+            if counts is None:
+                counts = values[key] = [0] * (len(buckets) + 1) + [0.0]
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        self.fold()
+        for key, counts in sorted(self.values.items(), key=lambda item: str(item[0])):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                yield "_bucket", self.format_labels(key, (("le", _format_number(float(bound))),)), total
+            yield "_sum", self.format_labels(key), counts[-1]
+            yield "_count", self.format_labels(key), total
+
+
+class Registry:
+
+    """A set of metrics that are rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.add(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.add(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.add(Histogram(*args, **kwargs))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+    async def handle_connection(self, reader, writer):
+        """Answer one HTTP request, with the metrics for GET /metrics."""
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            method, path = request.split(b" ", 2)[:2]
+            if method == b"GET" and path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found.\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except Exception:
+            log.exception("Error serving metrics.")
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        """Start serving the metrics over HTTP."""
+        return await asyncio.start_server(self.handle_connection, host, port)
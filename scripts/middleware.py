@@ -4,21 +4,30 @@
 # :copyright: (c) 2018 Will Hutcheson
 # :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
 
+import argparse
+from array import array
 import asyncio
-from collections import deque
-import itertools
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import heapq
 import json
 import logging
 import os
 from os.path import abspath, dirname, join
+import signal
 import ssl
+import subprocess
 import sys
+import threading
 import time
 import uuid
 
-from asgiref.sync import sync_to_async
 import django
+from django.db import connection, transaction
+from django.db.models import F, Max
 import websockets
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 
 BASE_DIR = abspath(join(dirname(__file__), ".."))
 DJANGO_DIR = join(BASE_DIR, "django")
@@ -27,18 +36,121 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "trebek.settings")
 django.setup()
 from trebek import settings
 from trebek.apps.trivia import models
+from trebek.apps.trivia.sharding import get_worker_index
+
+from backplane import create_backplane
+from metrics import Registry
+
+# Use the fastest JSON backend available; they all produce the same wire format.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    try:
+        import ujson
+    except ImportError:
+        ujson = None
+
+if orjson:
+    JSON_BACKEND = "orjson"
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+elif ujson:
+    JSON_BACKEND = "ujson"
+    dumps = ujson.dumps
+    loads = ujson.loads
+else:
+    JSON_BACKEND = "json"
+    dumps = json.dumps
+    loads = json.loads
+
+# Game state is journaled with msgpack if it's available, or JSON lines if not.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+if msgpack:
+    JOURNAL_FORMAT = "msgpack"
+
+    def pack_record(record):
+        return msgpack.packb(record, use_bin_type=True)
+
+    def unpack_records(data):
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(data)
+        # A record cut short by a crash is left in the unpacker's buffer.
+        yield from unpacker
+else:
+    JOURNAL_FORMAT = "json"
+
+    def pack_record(record):
+        return (json.dumps(record) + "\n").encode()
+
+    def unpack_records(data):
+        for line in data.splitlines():
+            yield json.loads(line)
+
+# Clients can ask to be sent msgpack rather than JSON, if it's available.
+ENCODINGS = ("json", "msgpack") if msgpack else ("json",)
 
 
 HOST_URL = "0.0.0.0"
-HOST_PORT = 8765
+# Workers configured with these hosts are started by --spawn.
+LOCAL_HOSTS = (None, "localhost", "127.0.0.1")
+
+# How long a single send may take before the client is considered stalled.
+SEND_TIMEOUT = 2.0
+# How many messages can be waiting to go out to one client before its overflow policies kick in.
+OUTBOX_SIZE = 256
+
+ALL_AUDIENCES = ("admins", "displays", "players")
+
+# How long buzzes are collected for before they're ordered and passed on.
+BUZZ_WINDOW = 0.05
+# How often every player is pinged, and how many timer slots the pings are spread over.
+PING_INTERVAL = 5.0
+PING_WHEEL_SLOTS = 50
+# How many ping round trips are kept for estimating each player's latency.
+PING_WINDOW = 8
+# How quickly the smoothed round trip time and clock offset follow new samples.
+PING_SMOOTHING = 0.2
+
+# How many threads talk to the database, so a slow query for one game doesn't hold up the others.
+DB_THREADS = 4
+
+# How long score and answered-question updates are batched up before they're written.
+WRITE_BEHIND_INTERVAL = 0.5
+
+# How long bursts of state messages (scores, the scoreboard, display text) are merged for before they're sent.
+COALESCE_WINDOW = 0.1
+
+# How many sent messages each game keeps for replaying to clients that reconnect.
+HISTORY_SIZE = 1024
+
+# Where each worker serves its metrics, by default on its websocket port plus the offset.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT_OFFSET = 1000
+
+# Where workers keep their journals of live game state (each in its own worker-N directory),
+# and how often they're compacted into a snapshot.
+STATE_DIR = join(BASE_DIR, "state")
+SNAPSHOT_INTERVAL = 30.0
 
 
 class MessageTypes:
     ERROR = 0
     PING = 1
+    LATENCY_REPORT = 2
+    RESUME = 3
     ADMIN_CONNECTED = 10
     DISPLAY_CONNECTED = 11
     PLAYER_CONNECTED = 12
+    SERVER_CONNECTED = 13
+    PLAYER_REGISTERED = 14
     GAME_RESET = 21
     CHANGE_ROUND = 22
     POP_QUESTION = 30
@@ -56,39 +168,908 @@ class MessageTypes:
     TOGGLE_SCOREBOARD = 70
 
 
+class OverflowPolicies:
+    # Replace a queued message of the same type (and player) that this one supersedes.
+    COALESCE = "coalesce"
+    # Drop the message, it's not worth keeping a client around for.
+    DROP = "drop"
+    # Disconnect the client, it's too far behind to be any use.
+    DISCONNECT = "disconnect"
+
+
+# What to do with a message when a client's outbox is full; anything not listed disconnects.
+OVERFLOW_POLICIES = {
+    MessageTypes.PING: OverflowPolicies.DROP,
+    MessageTypes.LATENCY_REPORT: OverflowPolicies.COALESCE,
+    MessageTypes.UPDATE_SCORE: OverflowPolicies.COALESCE,
+    MessageTypes.PLAY_SOUND: OverflowPolicies.DROP,
+    MessageTypes.TOGGLE_SCOREBOARD: OverflowPolicies.COALESCE,
+}
+
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("middleware")
 
 GAMES = {}
 
+# Which of settings.MIDDLEWARE_WORKERS this process is, and how it reaches the others.
+WORKER_INDEX = 0
+BACKPLANE = None
 
-async def mark_question_answered(game_key, question_id):
-    try:
-        game = await sync_to_async(models.Game.objects.get)(key=game_key)
-    except models.Game.DoesNotExist:
-        log.warning(f"Game key does not exist in database: {game_key}")
-        return
-    try:
-        question_state = await sync_to_async(models.QuestionState.objects.get)(game_round__game=game, question__id=question_id)
-    except models.Question.DoesNotExist:
-        log.warning(f"Question does not have state in game: {question_id}, {game_key}")
-        return
-    question_state.answered = True
-    await sync_to_async(question_state.save)()
+
+def hosts_game(game_key):
+    return get_worker_index(game_key) == WORKER_INDEX
+
+
+def worker_channel(worker_index):
+    return f"trebek:worker:{worker_index}"
+
+
+MESSAGE_TYPE_NAMES = {value: name for name, value in vars(MessageTypes).items() if not name.startswith("_")}
+
+
+def get_type_label(msg_type):
+    """Return the metric label for a message type from a client.
+
+    Clients can send anything as a type, so only the known ones get their own
+    label, otherwise every new value would be a new series.
+
+    """
+    if isinstance(msg_type, int) and msg_type in MESSAGE_TYPE_NAMES:
+        return MESSAGE_TYPE_NAMES[msg_type]
+    return "unknown"
+
+
+def count_clients():
+    return {(game.key, audience): len(getattr(game, audience)) for game in GAMES.values() for audience in ALL_AUDIENCES}
+
+
+def count_outbox_frames():
+    return {(game.key, audience): sum(len(client.outbox) for client in getattr(game, audience))
+            for game in GAMES.values() for audience in ALL_AUDIENCES}
+
+
+# Recording a metric is a dict update, so they're kept whether or not anything is scraping them.
+METRICS = Registry()
+MESSAGES_RECEIVED = METRICS.counter(
+    "trebek_messages_received_total", "Messages received from clients, by type.", ("type",), MESSAGE_TYPE_NAMES)
+MESSAGES_SENT = METRICS.counter(
+    "trebek_messages_sent_total", "Messages sent to clients, by type.", ("type",), MESSAGE_TYPE_NAMES)
+HANDLER_SECONDS = METRICS.histogram(
+    "trebek_handler_seconds", "Time spent handling messages from clients, by type.", ("type",), MESSAGE_TYPE_NAMES)
+DB_WAIT_SECONDS = METRICS.histogram(
+    "trebek_db_wait_seconds", "Time database calls waited for a free database thread, by caller.", ("caller",))
+DB_RUN_SECONDS = METRICS.histogram(
+    "trebek_db_run_seconds", "Time database calls took once they had a thread, by caller.", ("caller",))
+DB_QUERIES = METRICS.counter("trebek_db_queries_total", "Database queries made, by caller.", ("caller",))
+BUZZ_BROADCAST_SECONDS = METRICS.histogram(
+    "trebek_buzz_broadcast_seconds", "Time from a player's buzz arriving to it being sent out.")
+MESSAGES_REJECTED = METRICS.counter(
+    "trebek_messages_rejected_total", "Messages from clients that weren't handled, by type and reason.",
+    ("type", "reason"))
+OUTBOX_OVERFLOWS = METRICS.counter(
+    "trebek_outbox_overflows_total", "Messages that didn't fit in a client's outbox, by what was done.", ("outcome",))
+METRICS.gauge("trebek_clients", "Connected clients, by game and audience.", count_clients, ("game", "audience"))
+METRICS.gauge(
+    "trebek_outbox_frames", "Messages waiting to be sent, by game and audience.", count_outbox_frames,
+    ("game", "audience"))
+METRICS.gauge(
+    "trebek_write_behind_depth", "Database updates waiting to be written.", lambda: {None: WRITE_BEHIND.depth})
+METRICS.gauge("trebek_db_pending", "Database calls waiting for a free database thread.", lambda: {None: DB.pending})
+
+
+class Database:
+
+    """Runs the middleware's blocking ORM calls on a pool of threads of its own.
+
+    Django's sync_to_async puts every call on one shared thread, so a slow
+    query for one game would hold up every other game's. Each of these
+    threads keeps its own connection instead. How long a call waits for a
+    free thread is recorded apart from how long it takes once it has one,
+    along with the queries it made.
+
+    """
+
+    def __init__(self, threads=DB_THREADS):
+        self.threads = threads
+        # Calls that have been submitted but haven't started yet.
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._executor = None
+
+    def start(self, threads=None):
+        if threads:
+            self.threads = threads
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="db")
+
+    async def run(self, caller, func, *args, **kwargs):
+        """Run a blocking function on a database thread, recording its wait, run time and queries."""
+        self.start()
+        submitted = time.perf_counter()
+        with self._pending_lock:
+            self.pending += 1
+        # [started, finished, queries], filled in by the thread and recorded back on the event
+        # loop, since the metrics aren't safe to update from more than one thread.
+        timings = [submitted, submitted, 0]
+
+        def call():
+            timings[0] = time.perf_counter()
+            with self._pending_lock:
+                self.pending -= 1
+
+            def count_query(execute, sql, params, many, context):
+                timings[2] += 1
+                return execute(sql, params, many, context)
+
+            try:
+                with connection.execute_wrapper(count_query):
+                    return func(*args, **kwargs)
+            except Exception:
+                # Don't leave this thread holding on to a broken connection.
+                connection.close_if_unusable_or_obsolete()
+                raise
+            finally:
+                timings[1] = time.perf_counter()
+
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, call)
+        finally:
+            started, finished, queries = timings
+            DB_WAIT_SECONDS.observe(started - submitted, caller)
+            DB_RUN_SECONDS.observe(finished - started, caller)
+            DB_QUERIES.inc(caller, queries)
+
+    def close(self):
+        """Wait for any calls that are still running."""
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+DB = Database()
+
+
+class BatchLoader:
+
+    """Gathers lookups from the same pass of the event loop into one database call.
+
+    The fetch function takes a list of keys and returns a dict of what was
+    found for them. Keys that aren't in it raise the given exception.
+
+    """
+
+    def __init__(self, caller, fetch, missing=KeyError):
+        self.caller = caller
+        self.fetch = fetch
+        self.missing = missing
+        self._pending = {}
+
+    async def load(self, key):
+        future = self._pending.get(key)
+        if future is None:
+            if not self._pending:
+                asyncio.ensure_future(self._flush())
+            future = self._pending[key] = asyncio.get_event_loop().create_future()
+        # Other lookups can be waiting on the same future, so one of them being cancelled mustn't cancel it.
+        return await asyncio.shield(future)
+
+    async def _flush(self):
+        pending, self._pending = self._pending, {}
+        try:
+            found = await DB.run(self.caller, self.fetch, list(pending))
+        except Exception as exc:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for key, future in pending.items():
+            if future.done():
+                continue
+            if key in found:
+                future.set_result(found[key])
+            else:
+                future.set_exception(self.missing(key))
+
+
+class WriteBehindQueue:
+
+    """A queue of database updates that are batched and written in the background.
+
+    Updates are coalesced as they come in (only the latest score for a player
+    is kept) and written together in one transaction every
+    WRITE_BEHIND_INTERVAL seconds, so handlers never wait on the database.
+
+    """
+
+    def __init__(self, interval=WRITE_BEHIND_INTERVAL):
+        self.interval = interval
+        self._scores = {}
+        self._answered = {}
+        # The batch that's being written, so it can still be snapshotted.
+        self._writing = ({}, {})
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def depth(self):
+        """The number of updates waiting to be written."""
+        return len(self._scores) + sum(len(question_ids) for question_ids in self._answered.values())
+
+    def update_score(self, player_id, score):
+        self._scores[player_id] = score
+        self._schedule()
+
+    def mark_answered(self, game_key, question_id):
+        self._answered.setdefault(game_key, set()).add(question_id)
+        self._schedule()
+
+    def _schedule(self):
+        if not self._flush_task:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Write all pending updates to the database."""
+        async with self._lock:
+            if not self._scores and not self._answered:
+                return
+            scores, self._scores = self._scores, {}
+            answered, self._answered = self._answered, {}
+            log.debug(f"Flushing {len(scores)} score and {len(answered)} answered updates.")
+            self._writing = (scores, answered)
+            try:
+                await DB.run("write_behind", self._write, scores, answered)
+            except Exception:
+                log.exception("Failed to write pending updates, they will be retried.")
+                # Put them back without clobbering anything newer.
+                for player_id, score in scores.items():
+                    self._scores.setdefault(player_id, score)
+                for game_key, question_ids in answered.items():
+                    self._answered.setdefault(game_key, set()).update(question_ids)
+                self._schedule()
+            finally:
+                self._writing = ({}, {})
+
+    @staticmethod
+    def _write(scores, answered):
+        with transaction.atomic():
+            if scores:
+                players = [models.Player(id=player_id, score=score) for player_id, score in scores.items()]
+                models.Player.objects.bulk_update(players, ["score"])
+            for game_key, question_ids in answered.items():
+                count = (models.QuestionState.objects
+                         .filter(game_round__game__key=game_key, question__id__in=question_ids)
+                         .update(answered=True))
+                if count < len(question_ids):
+                    log.warning(f"Some questions do not have state in game {game_key}: {question_ids}")
+                models.Game.objects.filter(key=game_key).update(board_version=F("board_version") + 1)
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def get_pending_scores(self):
+        """Return every score that hasn't been committed yet, by player ID."""
+        scores = dict(self._writing[0])
+        scores.update(self._scores)
+        return scores
+
+    def to_snapshot(self):
+        """Return every update that hasn't been committed yet."""
+        scores = self.get_pending_scores()
+        answered = {}
+        for batch in (self._writing[1], self._answered):
+            for game_key, question_ids in batch.items():
+                answered.setdefault(game_key, set()).update(question_ids)
+        return {
+            "scores": list(scores.items()),
+            "answered": [[game_key, sorted(question_ids)] for game_key, question_ids in answered.items()],
+        }
+
+
+WRITE_BEHIND = WriteBehindQueue()
+
+
+class JournalLocked(Exception):
+
+    """Another process already has a journal directory open."""
+
+
+class GameJournal:
+
+    """A journal of every game's live state, so a restarted worker can pick up where it left off.
+
+    Each change to a game is appended to an event log, and every
+    SNAPSHOT_INTERVAL seconds the whole state is written to a snapshot and
+    the log is started over. On startup the snapshot is loaded and the log
+    replayed on top of it. Events are numbered, so any that made it into
+    the snapshot before the log was truncated aren't applied twice.
+
+    The files are only written by the journal's own thread, which takes
+    events and snapshots in the order they're queued, so a buzz never waits
+    on the disk.
+
+    """
+
+    def __init__(self, interval=SNAPSHOT_INTERVAL):
+        self.interval = interval
+        self.directory = None
+        self._sequence = 0
+        # Only used on the writer thread.
+        self._log = None
+        self._writer = None
+        self._task = None
+        self._lock_file = None
+
+    @property
+    def snapshot_path(self):
+        return join(self.directory, f"snapshot.{JOURNAL_FORMAT}")
+
+    @property
+    def events_path(self):
+        return join(self.directory, f"events.{JOURNAL_FORMAT}")
+
+    def record(self, event, game_key, *args):
+        if not self._writer:
+            return
+        self._sequence += 1
+        self._writer.submit(self._append, pack_record([self._sequence, event, game_key, *args]))
+
+    def _append(self, record):
+        if not self._log:
+            return
+        try:
+            self._log.write(record)
+            # Flushed to the OS so it survives the process dying, but not fsynced.
+            self._log.flush()
+        except OSError:
+            log.exception("Failed to write to the journal.")
+
+    async def restore(self, directory):
+        """Load this worker's games from its journal and open a new log."""
+        started = time.perf_counter()
+        os.makedirs(directory, exist_ok=True)
+        self._lock(directory)
+        self.directory = directory
+        snapshot = next(self._read(self.snapshot_path), None)
+        replayed = 0
+        if snapshot:
+            self._sequence = snapshot["sequence"]
+            for state in snapshot["games"]:
+                Game.from_snapshot(state)
+            for player_id, score in snapshot["scores"]:
+                WRITE_BEHIND.update_score(player_id, score)
+            for game_key, question_ids in snapshot["answered"]:
+                for question_id in question_ids:
+                    WRITE_BEHIND.mark_answered(game_key, question_id)
+        for sequence, event, game_key, *args in self._read(self.events_path):
+            if sequence <= self._sequence:
+                continue
+            self._sequence = sequence
+            self._apply(event, game_key, args)
+            replayed += 1
+        # Compact what was just loaded, which also starts the new log.
+        self.snapshot()
+        restored = time.perf_counter() - started
+        log.info(f"Restored {len(GAMES)} games and replayed {replayed} events in {restored * 1000:.1f}ms.")
+        # Anything that was pending before the restart has to land before the games' state is loaded.
+        await WRITE_BEHIND.flush()
+        if GAMES:
+            for game_key in await Game.load_states(list(GAMES.values())):
+                log.info(f"Game {game_key} no longer exists, forgetting it.")
+                GAMES.pop(game_key, None)
+        log.info(f"Loaded state for {len(GAMES)} games in {(time.perf_counter() - started) * 1000:.1f}ms.")
+
+    def _lock(self, directory):
+        # Two processes sharing a journal would truncate and overwrite each other's files.
+        lock_file = open(join(directory, "lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise JournalLocked(f"The journal in {directory} is in use by another process.")
+        self._lock_file = lock_file
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as journal_file:
+                data = journal_file.read()
+        except FileNotFoundError:
+            return
+        try:
+            yield from unpack_records(data)
+        except ValueError:
+            log.warning(f"Journal {path} is damaged, ignoring the rest of it.")
+
+    @staticmethod
+    def _apply(event, game_key, args):
+        game = GAMES.get(game_key) or Game(game_key)
+        if event == "pop_question":
+            game.pop_question(*args)
+        elif event == "clear_question":
+            game.clear_question()
+        elif event == "buzz":
+            game.add_buzz(*args)
+        elif event == "pop_buzz":
+            game.pop_buzz()
+        elif event == "clear_buzzes":
+            game.clear_buzzes()
+        elif event == "score":
+            game.set_score(*args)
+        elif event == "answered":
+            game.mark_answered(*args)
+        else:
+            log.warning(f"Unknown event '{event}' in journal for game {game_key}.")
+
+    def snapshot(self):
+        """Queue every game's state to be written to a new snapshot, starting the log over.
+
+        The state is taken straight away, and written after any events that
+        were recorded before it. Returns a future for when it's written.
+
+        """
+        if not self.directory:
+            return None
+        if not self._writer:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        snapshot = dict(
+            WRITE_BEHIND.to_snapshot(),
+            sequence=self._sequence,
+            games=[game.to_snapshot() for game in GAMES.values()])
+        return self._writer.submit(self._write_snapshot, snapshot)
+
+    def _write_snapshot(self, snapshot):
+        temp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(temp_path, "wb") as snapshot_file:
+                snapshot_file.write(pack_record(snapshot))
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(temp_path, self.snapshot_path)
+        except OSError:
+            log.exception("Failed to write a journal snapshot, keeping the log as it is.")
+            if not self._log:
+                self._log = open(self.events_path, "ab")
+            return
+        if self._log:
+            self._log.close()
+        self._log = open(self.events_path, "wb")
+
+    def _close_log(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._snapshot_forever())
+
+    async def _snapshot_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await asyncio.wrap_future(self.snapshot())
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._writer:
+            self.snapshot()
+            self._writer.submit(self._close_log)
+            self._writer.shutdown(wait=True)
+            self._writer = None
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+JOURNAL = GameJournal()
 
 
 def parse_message(msg_json):
     try:
-        msg = json.loads(msg_json)
+        if msgpack and isinstance(msg_json, bytes):
+            # Clients that asked for msgpack send [type, data] as binary messages.
+            values = msgpack.unpackb(msg_json, raw=False)
+            msg = {"type": values[0], "data": values[1] if len(values) > 1 else {}}
+        else:
+            msg = loads(msg_json)
     except:
         raise
+    if not isinstance(msg, dict):
+        log.error(f"Message is not an object: {msg_json}")
+        return None, {}
     msg_type = msg.get("type")
     msg_data = msg.get("data", {})
     if msg_type is None:
         log.error(f"Message has no type: {msg_json}")
+    elif not isinstance(msg_type, int) or isinstance(msg_type, bool):
+        # It's used as a dict key from here on, so it can't be left to the handlers to reject.
+        log.error(f"Message has a type that isn't a number: {msg_json}")
+        return None, msg_data
     return msg_type, msg_data
 
 
+class Frame:
+
+    """A message that is encoded once and can be sent to any number of clients.
+
+    Messages that are part of a game's replayable history carry its
+    sequence number. The msgpack encoding is only made the first time a
+    client that asked for it is sent the frame.
+
+    """
+
+    __slots__ = ("type", "data", "seq", "payload", "_packed")
+
+    def __init__(self, msg_type, msg_data={}, seq=None):
+        self.type = msg_type
+        self.data = msg_data
+        self.seq = seq
+        if seq is None:
+            self.payload = dumps({"type": msg_type, "data": msg_data})
+        else:
+            self.payload = dumps({"type": msg_type, "data": msg_data, "seq": seq})
+        self._packed = None
+
+    @property
+    def packed(self):
+        """The message as a msgpack array of [type, data] or [type, data, seq]."""
+        if self._packed is None:
+            values = [self.type, self.data] if self.seq is None else [self.type, self.data, self.seq]
+            self._packed = msgpack.packb(values, use_bin_type=True)
+        return self._packed
+
+    def encode(self, encoding):
+        return self.packed if encoding == "msgpack" else self.payload
+
+
+class SmallMessageDeflate:
+
+    """A permessage-deflate extension that sends short messages uncompressed.
+
+    The extension allows each message to be compressed or not, and for
+    something like a buzz the deflate overhead costs more than it saves.
+
+    """
+
+    def __init__(self, extension, min_size):
+        self._extension = extension
+        self.min_size = min_size
+
+    def __getattr__(self, name):
+        return getattr(self._extension, name)
+
+    def decode(self, frame, **kwargs):
+        return self._extension.decode(frame, **kwargs)
+
+    def encode(self, frame):
+        # Only whole text (1) or binary (2) messages can be let through; control frames are never compressed.
+        if frame.fin and frame.opcode in (1, 2) and len(frame.data) < self.min_size:
+            return frame
+        return self._extension.encode(frame)
+
+
+class SmallMessageDeflateFactory(ServerPerMessageDeflateFactory):
+
+    def __init__(self, min_size=0, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, SmallMessageDeflate(extension, self.min_size)
+
+
+def get_deflate_options(options):
+    """Return websockets.serve keyword arguments for a MIDDLEWARE_DEFLATE setting."""
+    if not options:
+        return {"compression": None}
+    factory = SmallMessageDeflateFactory(
+        min_size=options.get("min_size", 0),
+        server_max_window_bits=options.get("max_window_bits"),
+        compress_settings={"level": options.get("level", 6), "memLevel": options.get("mem_level", 8)})
+    return {"extensions": [factory]}
+
+
+class ClockEstimate:
+
+    """Round trip time and clock offset estimates for one player.
+
+    The last PING_WINDOW round trips are kept in a ring buffer. The latency
+    estimate comes from the fastest of them, since queueing only ever adds
+    delay. The clock offset is smoothed, using only samples that were close
+    to that fastest round trip.
+
+    """
+
+    __slots__ = ("rtts", "index", "count", "min_rtt", "rtt", "offset")
+
+    def __init__(self, size=PING_WINDOW):
+        self.rtts = array("d", [0.0]) * size
+        self.index = 0
+        self.count = 0
+        self.min_rtt = 0.0
+        self.rtt = 0.0
+        self.offset = None
+
+    @property
+    def latency(self):
+        """The estimated one-way latency in seconds."""
+        return self.min_rtt / 2
+
+    def add(self, rtt, offset=None):
+        self.rtts[self.index] = rtt
+        self.index = (self.index + 1) % len(self.rtts)
+        self.count = min(self.count + 1, len(self.rtts))
+        self.min_rtt = min(self.rtts[:self.count])
+        if self.count == 1:
+            self.rtt = rtt
+        else:
+            self.rtt += PING_SMOOTHING * (rtt - self.rtt)
+        # Slow samples have an asymmetric delay we can't account for, so they'd skew the offset.
+        if offset is not None and rtt <= self.min_rtt * 2:
+            if self.offset is None:
+                self.offset = offset
+            else:
+                self.offset += PING_SMOOTHING * (offset - self.offset)
+
+    def to_dict(self):
+        return {
+            "rtt": round(self.rtt * 1000, 1),
+            "latency": round(self.latency * 1000, 1),
+            "offset": round(self.offset * 1000, 1) if self.offset is not None else None,
+        }
+
+
+class PingWheel:
+
+    """Pings every connected player once per PING_INTERVAL.
+
+    Players are dealt into the slots of a single timing wheel and one slot is
+    pinged per tick, so the pings are spread evenly over the interval and
+    there's only one timer for the whole process however many players are
+    connected. Each time the wheel comes around, every game's admins are sent
+    a latency report.
+
+    """
+
+    def __init__(self, interval=PING_INTERVAL, slots=PING_WHEEL_SLOTS):
+        self.interval = interval
+        self.slots = [set() for _ in range(slots)]
+        self._next_slot = 0
+        self._task = None
+
+    def add(self, player):
+        player.ping_slot = self._next_slot
+        self.slots[self._next_slot].add(player)
+        self._next_slot = (self._next_slot + 1) % len(self.slots)
+        if not self._task:
+            self._task = asyncio.ensure_future(self.run())
+
+    def remove(self, player):
+        self.slots[player.ping_slot].discard(player)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        tick = self.interval / len(self.slots)
+        deadline = loop.time()
+        index = 0
+        while True:
+            deadline += tick
+            await asyncio.sleep(max(0, deadline - loop.time()))
+            players = self.slots[index]
+            if players:
+                frame = Frame(MessageTypes.PING, {
+                    "start_time": time.time(),
+                    "sent_at": time.monotonic(),
+                })
+                for player in list(players):
+                    # Pings skip the queue, so they measure the network rather than how backed up the player is.
+                    player.send_frame(frame, urgent=True)
+            index = (index + 1) % len(self.slots)
+            if index == 0:
+                for game in list(GAMES.values()):
+                    if game.admins and game.players:
+                        asyncio.ensure_future(game.broadcast(MessageTypes.LATENCY_REPORT, {
+                            "players": {str(player.id): player.clock.to_dict() for player in game.players},
+                        }, audiences=("admins",), replay=False))
+
+
+PING_WHEEL = PingWheel()
+
+
+class Outbox:
+
+    """A bounded queue of frames waiting to be sent to one client.
+
+    Once it's full, each new frame is handled by its OVERFLOW_POLICIES
+    entry. A frame that coalesces replaces the queued one it supersedes,
+    which is moved to the back so sequence numbers stay in order. A frame
+    that can't be coalesced or dropped can still push out a queued frame
+    that can be dropped. If there's nothing to make room with, the client
+    has to go.
+
+    """
+
+    def __init__(self, size=OUTBOX_SIZE):
+        self.size = size
+        self.frames = deque()
+        self.peak = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame, urgent=False):
+        """Queue a frame, returning False if the client should be disconnected.
+
+        Urgent frames go to the front of the queue.
+
+        """
+        if len(self.frames) >= self.size:
+            policy = OVERFLOW_POLICIES.get(frame.type, OverflowPolicies.DISCONNECT)
+            if policy == OverflowPolicies.COALESCE and self._remove(self._superseded_by(frame)):
+                self.coalesced += 1
+                OUTBOX_OVERFLOWS.inc("coalesced")
+            elif policy == OverflowPolicies.DROP:
+                self.dropped += 1
+                OUTBOX_OVERFLOWS.inc("dropped")
+                return True
+            elif self._remove(self._droppable()):
+                self.dropped += 1
+                OUTBOX_OVERFLOWS.inc("evicted")
+            else:
+                OUTBOX_OVERFLOWS.inc("disconnected")
+                return False
+        if urgent:
+            self.frames.appendleft(frame)
+        else:
+            self.frames.append(frame)
+        self.peak = max(self.peak, len(self.frames))
+        return True
+
+    def popleft(self):
+        return self.frames.popleft()
+
+    def clear(self):
+        self.frames.clear()
+
+    def _superseded_by(self, frame):
+        player_id = frame.data.get("player_id")
+        for queued in self.frames:
+            if queued.type == frame.type and queued.data.get("player_id") == player_id:
+                return queued
+        return None
+
+    def _droppable(self):
+        for queued in self.frames:
+            if OVERFLOW_POLICIES.get(queued.type) == OverflowPolicies.DROP:
+                return queued
+        return None
+
+    def _remove(self, frame):
+        if frame is None:
+            return False
+        self.frames.remove(frame)
+        return True
+
+
+Buzz = namedtuple("Buzz", ("id", "name"))
+
+
+class BuzzQueue:
+
+    """Buzzed players in order, with constant time membership checks by player ID."""
+
+    def __init__(self):
+        self._queue = deque()
+        self._ids = set()
+
+    def __contains__(self, player_id):
+        return player_id in self._ids
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def append(self, player_id, player_name):
+        if player_id in self._ids:
+            return False
+        self._queue.append(Buzz(player_id, player_name))
+        self._ids.add(player_id)
+        return True
+
+    def popleft(self):
+        buzz = self._queue.popleft()
+        self._ids.discard(buzz.id)
+        return buzz
+
+    def clear(self):
+        self._queue.clear()
+        self._ids.clear()
+
+
+class BuzzArbiter:
+
+    """Orders buzzes by when they were most likely pressed, rather than when they arrived.
+
+    Buzzes are collected for BUZZ_WINDOW seconds after the first one arrives,
+    then ordered by their receive time minus the player's estimated one-way
+    latency. The compensation is capped at the window, so nobody can gain
+    more than that by stalling their pings.
+
+    """
+
+    def __init__(self, game, window=BUZZ_WINDOW):
+        self.game = game
+        self.window = window
+        self.pending_ids = set()
+        self._pending = []
+        self._task = None
+        self._sequence = 0
+
+    def buzz(self, player, msg_data):
+        received = time.monotonic()
+        compensation = min(player.latency, self.window)
+        # The sequence number breaks any remaining ties by arrival order.
+        self._sequence += 1
+        heapq.heappush(self._pending, (received - compensation, received, self._sequence, player, msg_data))
+        self.pending_ids.add(player.id)
+        if not self._task:
+            self._task = asyncio.ensure_future(self._close_window())
+
+    def clear(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._pending.clear()
+        self.pending_ids.clear()
+
+    async def _close_window(self):
+        await asyncio.sleep(self.window)
+        self._task = None
+        pending, self._pending = self._pending, []
+        self.pending_ids.clear()
+        buzzes = [heapq.heappop(pending) for _ in range(len(pending))]
+        self.report(buzzes)
+        for _, received, _, player, msg_data in buzzes:
+            if not self.game.add_buzz(player.id, player.name):
+                # An admin already entered this player's buzz by hand while it was waiting here.
+                continue
+            await self.game.broadcast(MessageTypes.PLAYER_BUZZED, msg_data)
+            BUZZ_BROADCAST_SECONDS.observe(time.monotonic() - received)
+
+    def report(self, buzzes):
+        """Log how the buzzes in a window were ordered, and how much compensation changed it."""
+        if not buzzes:
+            return
+        first_received = min(received for _, received, _, _, _ in buzzes)
+        arrival_order = sorted(buzzes, key=lambda buzz: buzz[2])
+        moved = sum(1 for buzz, arrived in zip(buzzes, arrival_order) if buzz is not arrived)
+        entries = ", ".join(
+            f"'{player.name}' (+{(received - first_received) * 1000:.1f}ms,"
+            f" latency {player.latency * 1000:.1f}ms)"
+            for _, received, _, player, _ in buzzes)
+        log.info(f"Ordered {len(buzzes)} buzzes in game {self.game.key}, {moved} moved by compensation: {entries}")
+
+
+def fetch_scores(player_ids):
+    return dict(models.Player.objects.filter(id__in=player_ids).values_list("id", "score"))
+
+
+SCORES = BatchLoader("get_score", fetch_scores, models.Player.DoesNotExist)
+
+
 class Game:
 
     def __init__(self, game_key):
@@ -96,33 +1077,158 @@ class Game:
         self.admins = set()
         self.displays = set()
         self.players = set()
+        # Player connections by player ID, since a player can have more than one tab open.
+        self.connections = {}
         self.popped_question_uuid = None
         self.popped_question_real_id = None
         self.popped_question_text = None
-        self.buzzes = deque()
+        self.buzzes = BuzzQueue()
+        self.arbiter = BuzzArbiter(self)
+        # Every message sent to the game's clients is numbered and kept for a while, so a client
+        # that reconnects can be sent what it missed. The stream ID changes whenever the worker
+        # restarts, since the numbering starts over.
+        self.stream_id = uuid.uuid4().hex
+        self.sequence = 0
+        self.history = deque(maxlen=HISTORY_SIZE)
+        # State messages waiting out the coalescing window, by what they describe.
+        self._coalesced = {}
+        self._coalesce_task = None
+        self.scoreboard_visible = False
+        # A snapshot of the game's state in the database, so handlers don't have to query for it.
+        self.loaded = False
+        self.round = 0
+        self.final_round = 0
+        self.scores = {}
         self._game = None
         GAMES[game_key] = self
 
-    def get_round(self):
-        if not self._game:
-            self._game = models.Game.objects.get(key=self.key)
-        return self._game.current_round
+    @classmethod
+    def from_snapshot(cls, state):
+        game = cls(state["key"])
+        if state["question"]:
+            game.popped_question_real_id, game.popped_question_text, game.popped_question_uuid = state["question"]
+        for player_id, name in state["buzzes"]:
+            game.buzzes.append(player_id, name)
+        return game
+
+    def to_snapshot(self):
+        if self.popped_question_real_id:
+            question = [self.popped_question_real_id, self.popped_question_text, self.popped_question_uuid]
+        else:
+            question = None
+        return {"key": self.key, "question": question, "buzzes": [list(buzz) for buzz in self.buzzes]}
+
+    @staticmethod
+    def fetch_states(game_keys):
+        """Read several games' rounds and player scores in two queries.
+
+        This runs on the database pool, so it only reads; the rows are
+        applied to the games back on the event loop. Returns a dict of
+        (game, last round, scores) by game key, without any games that
+        aren't in the database.
+
+        """
+        scores = {game_key: {} for game_key in game_keys}
+        players = models.Player.objects.filter(game__key__in=game_keys).values_list("game__key", "id", "score")
+        for game_key, player_id, score in players:
+            scores[game_key][player_id] = score
+        return {game_object.key: (game_object, game_object.last_round or 0, scores[game_object.key])
+                for game_object in models.Game.objects.filter(key__in=game_keys)
+                .annotate(last_round=Max("rounds__round"))}
+
+    def apply_state(self, state):
+        game_object, final_round, scores = state
+        self._game = game_object
+        self.round = game_object.current_round
+        self.final_round = final_round
+        # Scores set while the rows were being read are still waiting to be written, and are newer.
+        pending = WRITE_BEHIND.get_pending_scores()
+        scores.update((player_id, pending[player_id]) for player_id in scores.keys() & pending.keys())
+        self.scores = scores
+        self.loaded = True
+
+    @staticmethod
+    async def load_states(games):
+        """Load snapshots of several games' rounds and player scores.
+
+        Returns the keys of any games that aren't in the database.
+
+        """
+        states = await DB.run("load_state", Game.fetch_states, [game.key for game in games])
+        missing = []
+        for game in games:
+            if game.key in states:
+                game.apply_state(states[game.key])
+            else:
+                missing.append(game.key)
+        return missing
+
+    async def load_state(self):
+        """Load a snapshot of this game's round and player scores from the database."""
+        if await self.load_states([self]):
+            raise models.Game.DoesNotExist(f"Game {self.key} does not exist.")
+
+    async def ensure_loaded(self):
+        if not self.loaded:
+            await self.load_state()
+
+    async def change_round(self, value):
+        await DB.run("change_round", models.Game.objects.filter(key=self.key).update,
+                     current_round=value, board_version=F("board_version") + 1)
+        await self.load_state()
+
+    async def reset(self):
+        await DB.run("reset", self._game.reset)
+        await self.load_state()
+
+    async def get_score(self, player_id):
+        if player_id not in self.scores:
+            # A player that joined after the snapshot was loaded.
+            # Players joining together are looked up together.
+            self.scores[player_id] = await SCORES.load(player_id)
+        return self.scores[player_id]
 
-    def set_round(self, value):
-        if not self._game:
-            self._game = models.Game.objects.get(key=self.key)
-        self._game.current_round = value
-        self._game.save()
+    def set_score(self, player_id, score):
+        self.scores[player_id] = score
+        WRITE_BEHIND.update_score(player_id, score)
+        JOURNAL.record("score", self.key, player_id, score)
 
-    def get_final_round(self):
-        if not self._game:
-            self._game = models.Game.objects.get(key=self.key)
-        return self._game.rounds.last().round
+    def mark_answered(self, question_id):
+        WRITE_BEHIND.mark_answered(self.key, question_id)
+        JOURNAL.record("answered", self.key, question_id)
 
-    def reset(self):
-        if not self._game:
-            self._game = models.Game.objects.get(key=self.key)
-        self._game.reset()
+    def pop_question(self, real_id, text, question_uuid=None):
+        """Pop a question, returning the UUID the players know it by."""
+        self.clear_buzzes()
+        self.popped_question_real_id = real_id
+        self.popped_question_text = text
+        self.popped_question_uuid = question_uuid or str(uuid.uuid4())
+        JOURNAL.record("pop_question", self.key, real_id, text, self.popped_question_uuid)
+        return self.popped_question_uuid
+
+    def clear_question(self):
+        self.popped_question_real_id = None
+        self.popped_question_uuid = None
+        self.popped_question_text = None
+        self.clear_buzzes()
+        JOURNAL.record("clear_question", self.key)
+
+    def add_buzz(self, player_id, name):
+        """Add a buzz to the queue, returning False if the player had already buzzed."""
+        if not self.buzzes.append(player_id, name):
+            return False
+        JOURNAL.record("buzz", self.key, player_id, name)
+        return True
+
+    def pop_buzz(self):
+        if self.buzzes:
+            self.buzzes.popleft()
+            JOURNAL.record("pop_buzz", self.key)
+
+    def clear_buzzes(self):
+        self.buzzes.clear()
+        self.arbiter.clear()
+        JOURNAL.record("clear_buzzes", self.key)
 
     def register_client(self, client):
         if isinstance(client, Admin):
@@ -133,23 +1239,205 @@ class Game:
             self.displays.add(client)
         elif isinstance(client, Player):
             log.info(f"Registering player '{client.name}' ({client.id}) for game {self.key}.")
+            # Replace any of the player's connections that have gone away since they last connected.
+            for stale in [connection for connection in self.connections.get(client.id, ())
+                          if not connection._ws.open]:
+                stale.clean_up()
             self.players.add(client)
+            self.connections.setdefault(client.id, set()).add(client)
         elif isinstance(client, Client):
             log.error(f"Client subclass not recognized: {client}")
         else:
             log.error(f"Tried to register {client} as a client!")
 
-    def get_player_by_id(self, player_id):
-        for player in self.players:
-            if player.id == player_id:
-                return player
-        return None
+    def unregister_player(self, player):
+        self.players.discard(player)
+        connections = self.connections.get(player.id)
+        if connections is not None:
+            connections.discard(player)
+            if not connections:
+                del self.connections[player.id]
+
+    def get_player_connections(self, player_id):
+        return self.connections.get(player_id, ())
+
+    def record(self, msg_type, msg_data, audiences=(), player_id=None, exclude=None):
+        """Number a message and add it to the history, returning its frame."""
+        self.sequence += 1
+        frame = Frame(msg_type, msg_data, seq=self.sequence)
+        self.history.append((self.sequence, audiences, player_id, exclude.client_id if exclude else None, frame))
+        return frame
+
+    def missed_frames(self, client, last_seq):
+        """Return the messages a client missed since last_seq, or None if they're no longer all kept."""
+        if last_seq > self.sequence:
+            return None
+        if last_seq < self.sequence and (not self.history or self.history[0][0] > last_seq + 1):
+            return None
+        player_id = getattr(client, "id", None)
+        frames = []
+        for seq, audiences, recipient, exclude_id, frame in self.history:
+            if seq <= last_seq or exclude_id == client.client_id:
+                continue
+            if isinstance(frame, dict):
+                # A message from send_to_players, with a copy for each player.
+                frame = frame.get(player_id)
+                if frame is not None:
+                    frames.append(frame)
+            elif client.audience in audiences or (recipient is not None and recipient == player_id):
+                frames.append(frame)
+        return frames
+
+    def coalesce(self, msg_type, msg_data, audiences=(), player_id=None, subject=None):
+        """Queue a state message to be sent once COALESCE_WINDOW has passed.
+
+        A message of the same type for the same recipients and subject that
+        comes in before then replaces this one, so a burst of updates goes out
+        as one frame with the latest values. Messages for a single player are
+        sent to them, otherwise to the given audiences.
+
+        """
+        key = (msg_type, audiences, player_id, subject)
+        # The latest update goes to the back, so its ordering relative to other updates is kept.
+        self._coalesced.pop(key, None)
+        self._coalesced[key] = msg_data
+        if not self._coalesce_task:
+            self._coalesce_task = asyncio.ensure_future(self._send_coalesced_later())
+
+    async def _send_coalesced_later(self):
+        await asyncio.sleep(COALESCE_WINDOW)
+        self._coalesce_task = None
+        await self.send_coalesced()
+
+    async def send_coalesced(self):
+        """Send any state messages that are waiting out the coalescing window."""
+        pending, self._coalesced = self._coalesced, {}
+        for (msg_type, audiences, player_id, _), msg_data in pending.items():
+            if player_id is None:
+                await self.broadcast(msg_type, msg_data, audiences=audiences)
+            else:
+                await self.send_to_player(player_id, msg_type, msg_data)
+
+    async def send_to_player(self, player_id, msg_type, msg_data={}):
+        """Send a message to all of a player's connections, returning False if they have none.
+
+        The message is kept in the history either way, so a player that's
+        offline gets it when they reconnect.
+
+        """
+        if self._coalesced:
+            # State messages can't be overtaken by what comes after them.
+            await self.send_coalesced()
+        frame = self.record(msg_type, msg_data, player_id=player_id)
+        connections = self.get_player_connections(player_id)
+        if not connections:
+            return False
+        for player in list(connections):
+            player.send_frame(frame)
+        return True
+
+    async def send_to_players(self, msg_type, msg_data, player_data):
+        """Send a message to several players, with fields that differ from player to player.
+
+        player_data maps player IDs to the fields for each of them. The
+        copies share one sequence number and one history entry, so sending
+        to every player in a big game doesn't push everything else out of
+        the history. Players that are offline get theirs when they reconnect.
+
+        """
+        if self._coalesced:
+            # State messages can't be overtaken by what comes after them.
+            await self.send_coalesced()
+        self.sequence += 1
+        frames = {player_id: Frame(msg_type, dict(msg_data, **fields), seq=self.sequence)
+                  for player_id, fields in player_data.items()}
+        self.history.append((self.sequence, (), None, None, frames))
+        for player_id, frame in frames.items():
+            for player in list(self.get_player_connections(player_id)):
+                player.send_frame(frame)
+
+    async def broadcast(self, msg_type, msg_data={}, audiences=ALL_AUDIENCES, exclude=None, replay=True):
+        """Send a message to every client in the given audiences concurrently.
+
+        The message is encoded once and the same frame is queued for every
+        client, so a single slow client can't hold up delivery to the rest of
+        the game. Unless replay is False, the message is kept in the history
+        for clients that reconnect.
+
+        """
+        if self._coalesced:
+            # State messages can't be overtaken by what comes after them.
+            await self.send_coalesced()
+        if replay:
+            frame = self.record(msg_type, msg_data, audiences=audiences, exclude=exclude)
+        clients = [client for audience in audiences for client in getattr(self, audience)
+                   if client is not exclude]
+        if not clients:
+            return
+        if not replay:
+            frame = Frame(msg_type, msg_data)
+        for client in clients:
+            client.send_frame(frame)
+
+
+class Dispatcher:
+
+    """Handlers for the messages one kind of connection can send, by message type.
+
+    Handlers are registered with the on() decorator, along with the fields a
+    message has to have for them. Finding a handler is one dict lookup, so
+    adding message types doesn't slow down the others, and every message is
+    checked and timed in one place.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.handlers = {}
+
+    def on(self, msg_type, *required):
+        """Register a handler, called with the target and message data."""
+        def register(func):
+            self.handlers[msg_type] = (func, frozenset(required))
+            return func
+        return register
+
+    async def dispatch(self, target, msg_type, msg_data):
+        """Handle a message, returning the handler's result or None if it wasn't handled."""
+        entry = self.handlers.get(msg_type)
+        if entry is None:
+            MESSAGES_REJECTED.inc((get_type_label(msg_type), "unhandled"))
+            log.warning(f"{self.name} sent unhandled message type '{msg_type}': {msg_data}")
+            return None
+        handler, required = entry
+        if not isinstance(msg_data, dict) or not required <= msg_data.keys():
+            MESSAGES_REJECTED.inc((get_type_label(msg_type), "invalid"))
+            log.warning(f"{self.name} sent message type '{msg_type}' without {', '.join(sorted(required))}: {msg_data}")
+            return None
+        started = time.perf_counter()
+        result = await handler(target, msg_data)
+        HANDLER_SECONDS.observe(time.perf_counter() - started, msg_type)
+        return result
 
 
 class Client:
 
-    def __init__(self, websocket, game_key):
+    # Which of the game's client sets this belongs to.
+    audience = None
+    handlers = Dispatcher("Client")
+
+    def __init__(self, websocket, game_key=None):
         self._ws = websocket
+        self.stalled = False
+        # Numbered messages are held back until the client has caught up with the ones before them.
+        self.catching_up = True
+        self.client_id = None
+        self.encoding = "json"
+        self.outbox = Outbox()
+        self._writer = None
+        self.game = None
+        if game_key is None:
+            return
         if not game_key in GAMES:
             game = Game(game_key)
             self.game = game
@@ -164,29 +1452,121 @@ class Client:
         return hash(self._ws)
 
     @classmethod
-    async def new(cls, *args, **kwargs):
-        return cls(*args, **kwargs)
+    async def new(cls, *args, resume=None, **kwargs):
+        client = cls(*args, **kwargs)
+        resume = resume or {}
+        if resume.get("encoding") in ENCODINGS:
+            client.encoding = resume["encoding"]
+        try:
+            await client.game.ensure_loaded()
+            if resume.get("round") not in (None, client.game.round):
+                # The page was rendered for another round, which can be changed without the middleware
+                # seeing it (from the Django admin, say), so the snapshot may be what's out of date.
+                await client.game.load_state()
+            await client.catch_up(resume)
+        except BaseException as exc:
+            # The connection never gets handed back, so it has to be taken out of the game here.
+            client.clean_up()
+            if isinstance(exc, models.Game.DoesNotExist) and GAMES.get(client.game.key) is client.game:
+                log.info(f"Game {client.game.key} does not exist, forgetting it.")
+                GAMES.pop(client.game.key)
+            raise
+        return client
+
+    async def catch_up(self, resume):
+        """Bring a new connection up to date.
+
+        A client that's reconnecting sends the stream ID and last sequence
+        number it saw, and is sent just the messages it missed. If it's too
+        far behind (or is new) it's sent the game's current state instead,
+        though that doesn't cover the board or scores, so admin and display
+        pages that were already connected reload rather than use it.
+
+        """
+        game = self.game
+        # Reuse the client ID from before the reconnect, so the client isn't sent its own messages back.
+        self.client_id = resume.get("client_id") or uuid.uuid4().hex
+        frames = None
+        if resume.get("stream") == game.stream_id and resume.get("last_seq") is not None:
+            frames = game.missed_frames(self, resume["last_seq"])
+        replayed = frames is not None
+        if not replayed:
+            frames = self.state_frames()
+        frames.insert(0, Frame(MessageTypes.RESUME, {
+            "stream": game.stream_id,
+            "seq": game.sequence,
+            "client_id": self.client_id,
+            "round": game.round,
+            "replayed": replayed,
+            # Clients keep sending JSON until they're told which encoding was agreed on.
+            "encoding": self.encoding,
+        }))
+        # Nothing has been awaited since the frames were gathered, so no numbered message can fall in between.
+        self.catching_up = False
+        for frame in frames:
+            self.send_frame(frame)
+
+    def state_frames(self):
+        """Return the messages that give a client the game's current state."""
+        return []
 
     async def handler(self):
         async for msg in self._ws:
             msg_type, msg_data = parse_message(msg)
             if not msg_type:
                 continue
+            MESSAGES_RECEIVED.inc(get_type_label(msg_type))
             await self.handle_message(msg_type, msg_data)
 
     async def handle_message(self, msg_type, msg_data):
-        raise NotImplementedError
+        await self.handlers.dispatch(self, msg_type, msg_data)
+
+    def send_message(self, msg_type, msg_data={}):
+        # Use Game.broadcast rather than calling this in a loop, so the message is only encoded once.
+        self.send_frame(Frame(msg_type, msg_data))
 
-    async def send_message(self, msg_type, msg_data={}):
-        # Building these dicts is inefficient when send_message is called in a loop with the same data,
-        #  but it's fine for our small-scale purposes now.
-        if not self._ws.open:
+    def send_frame(self, frame, urgent=False):
+        """Queue a frame to be sent by this client's writer."""
+        if self.stalled or not self._ws.open:
+            return
+        if self.catching_up and frame.seq is not None:
+            # This will be included in what's sent when the client catches up.
             return
-        msg = {}
-        msg["type"] = msg_type
-        msg["data"] = msg_data
-        msg_json = json.dumps(msg)
-        await self._ws.send(msg_json)
+        if not self.outbox.put(frame, urgent):
+            self.drop(f"outbox overflowed with {len(self.outbox)} messages waiting")
+            return
+        if not self._writer:
+            self._writer = asyncio.ensure_future(self._write())
+
+    async def _write(self):
+        # The writer stops once the outbox is empty, and is started again by the next send.
+        try:
+            while self.outbox and not self.stalled:
+                frame = self.outbox.popleft()
+                try:
+                    await asyncio.wait_for(self._ws.send(frame.encode(self.encoding)), SEND_TIMEOUT)
+                    MESSAGES_SENT.inc(frame.type)
+                except asyncio.TimeoutError:
+                    self.drop(f"send of message type {frame.type} timed out after {SEND_TIMEOUT}s")
+                except websockets.ConnectionClosed:
+                    self.outbox.clear()
+        finally:
+            self._writer = None
+
+    async def drain(self):
+        """Wait until everything queued for this client has been sent."""
+        while self._writer:
+            await asyncio.shield(self._writer)
+
+    def drop(self, reason):
+        """Flag this client as stalled and disconnect it from the game."""
+        if self.stalled:
+            return
+        log.warning(f"Dropping stalled {type(self).__name__.lower()} from game {self.game.key}: {reason}")
+        self.stalled = True
+        self.outbox.clear()
+        self.clean_up()
+        asyncio.ensure_future(self._ws.close())
 
     def clean_up(self):
         raise NotImplementedError
@@ -194,293 +1574,379 @@ class Client:
 
 class Admin(Client):
 
+    audience = "admins"
+    handlers = Dispatcher("Admin")
+
     @classmethod
     async def new(cls, *args, **kwargs):
-        admin = cls(*args, **kwargs)
+        admin = await super().new(*args, **kwargs)
         # Forward admin connections to all players.
-        for player in admin.game.players:
-            await player.send_message(MessageTypes.ADMIN_CONNECTED)
+        await admin.game.broadcast(MessageTypes.ADMIN_CONNECTED, audiences=("players",))
+        return admin
+
+    def state_frames(self):
+        frames = []
         # If there is a question popped, let the admin know.
-        if admin.game.popped_question_real_id:
-            await admin.send_message(MessageTypes.POP_QUESTION, {
-                "question_id": admin.game.popped_question_real_id,
-            })
+        if self.game.popped_question_real_id:
+            frames.append(Frame(MessageTypes.POP_QUESTION, {
+                "question_id": self.game.popped_question_real_id,
+            }))
         # If players have buzzed, let the admin know.
-        for buzz in admin.game.buzzes:
-            msg_data = {
+        for buzz in self.game.buzzes:
+            frames.append(Frame(MessageTypes.PLAYER_BUZZED, {
                 "player_id": buzz.id,
                 "player_name": buzz.name,
                 "no_sound": True,
-            }
-            await admin.send_message(MessageTypes.PLAYER_BUZZED, msg_data)
-        return admin
+            }))
+        return frames
 
-    async def handle_message(self, msg_type, msg_data):
-        if not msg_type:
+    @handlers.on(MessageTypes.GAME_RESET)
+    async def handle_game_reset(self, msg_data):
+        log.info(f"Reseting game {self.game.key}.")
+        self.game.clear_question()
+        # Displays reload and start with the board showing.
+        self.game.scoreboard_visible = False
+        # Pending updates have to land first or they'd clobber the reset.
+        await WRITE_BEHIND.flush()
+        await self.game.reset()
+        # Start the journal over, so older scores aren't replayed on top of the reset.
+        JOURNAL.snapshot()
+        # Pass it on to everything.
+        await self.game.broadcast(MessageTypes.GAME_RESET)
+
+    @handlers.on(MessageTypes.CHANGE_ROUND, "round")
+    async def handle_change_round(self, msg_data):
+        new_round = msg_data["round"]
+        if new_round < 1:
             return
-        elif msg_type == MessageTypes.GAME_RESET:
-            log.info(f"Reseting game {self.game.key}.")
-            self.game.popped_question_real_id = None
-            self.game.popped_question_uuid = None
-            self.game.popped_question_text = None
-            self.game.buzzes.clear()
-            await sync_to_async(self.game.reset)()
-            # Pass it on to everything.
-            for client in itertools.chain(self.game.admins, self.game.displays, self.game.players):
-                await client.send_message(MessageTypes.GAME_RESET)
-        elif msg_type == MessageTypes.CHANGE_ROUND:
-            new_round = msg_data["round"]
-            if new_round < 1:
-                return
-            round = await sync_to_async(self.game.get_round)()
-            final_round = await sync_to_async(self.game.get_final_round)()
-            if round == new_round or new_round > final_round:
-                return
-            log.info(f"Changing to round {new_round} in game {self.game.key}.")
-            self.game.popped_question_real_id = None
-            self.game.popped_question_uuid = None
-            self.game.popped_question_text = None
-            self.game.buzzes.clear()
-            await sync_to_async(self.game.set_round)(new_round)
-            # Pass it on to everything.
-            for client in itertools.chain(self.game.admins, self.game.displays, self.game.players):
-                await client.send_message(MessageTypes.CHANGE_ROUND, msg_data)
-        elif msg_type == MessageTypes.POP_QUESTION:
-            # Update pings first.
-            for player in self.game.players:
-                await player.send_message(MessageTypes.PING, {
-                    "start_time": time.time(),
-                })
-            self.game.popped_question_real_id = msg_data["question_id"]
-            self.game.popped_question_text = msg_data["question_text"]
-            self.game.buzzes.clear()
-            # Pass it on to the displays.
-            for display in self.game.displays:
-                await display.send_message(MessageTypes.POP_QUESTION, msg_data)
-            # Inject a question UUID before passing it on to the players.
-            question_uuid = str(uuid.uuid4())
-            self.game.popped_question_uuid = question_uuid
-            msg_data["question_id"] = question_uuid
-            specific_player = msg_data.pop("specific_player")
-            if specific_player:
-                player = self.game.get_player_by_id(specific_player)
-                await player.send_message(MessageTypes.POP_QUESTION, msg_data)
-            else:
-                for player in self.game.players:
-                    await player.send_message(MessageTypes.POP_QUESTION, msg_data)
-        elif msg_type == MessageTypes.CLEAR_QUESTION:
-            self.game.popped_question_real_id = None
-            self.game.popped_question_uuid = None
-            self.game.popped_question_text = None
-            self.game.buzzes.clear()
-            # Mark the question as answered.
-            if msg_data.get("answered"):
-                question_id = msg_data["question_id"]
-                await mark_question_answered(self.game.key, question_id)
-            # Pass it on to the displays.
-            for display in self.game.displays:
-                await display.send_message(MessageTypes.CLEAR_QUESTION, msg_data)
-            # Strip out the question_id before passing it on to the players.
-            del msg_data["question_id"]
-            for player in self.game.players:
-                await player.send_message(MessageTypes.CLEAR_QUESTION, msg_data)
-        elif msg_type == MessageTypes.REQUIRE_WAGER:
-            round = await sync_to_async(self.game.get_round)()
-            final_round = await sync_to_async(self.game.get_final_round)()
-            if round == final_round:
-                round_max_wager = 0
-            else:
-                round_max_wager = self.game.get_round() * 1000
-            player_id = msg_data.pop("player_id")
-            if player_id:
-                player = self.game.get_player_by_id(player_id)
-                if not player:
-                   log.error(f"Received a wager request for player ({player_id}) not found in game!")
-                   return
-                log.info(f"Received a wager request for player '{player.name}' ({player.id}) of game {self.game.key}.")
-                player_object = await sync_to_async(models.Player.objects.get)(id=player_id)
-                msg_data["max_wager"] = max(round_max_wager, player_object.score)
-                await player.send_message(MessageTypes.REQUIRE_WAGER, msg_data)
-            else:
-                # Send to all players.
-                log.info(f"Received a wager request for all players in game {self.game.key}.")
-                for player in self.game.players:
-                    player_object = await sync_to_async(models.Player.objects.get)(id=player.id)
-                    msg_data["max_wager"] = max(round_max_wager, player_object.score)
-                    await player.send_message(MessageTypes.REQUIRE_WAGER, msg_data)
-        elif msg_type == MessageTypes.REQUIRE_ANSWER:
-            player_id = msg_data.pop("player_id")
-            if player_id:
-                player = self.game.get_player_by_id(player_id)
-                await player.send_message(MessageTypes.REQUIRE_ANSWER, msg_data)
-            else:
-                # Send to all players.
-                for player in self.game.players:
-                    await player.send_message(MessageTypes.REQUIRE_ANSWER, msg_data)
-        elif msg_type == MessageTypes.DISPLAY_TEXT:
-            player_id = msg_data.pop("player_id")
-            if player_id:
-                player = self.game.get_player_by_id(player_id)
-                await player.send_message(MessageTypes.DISPLAY_TEXT, msg_data)
-            else:
-                # Pass it on to all players.
-                for player in self.game.players:
-                    await player.send_message(MessageTypes.DISPLAY_TEXT, msg_data)
-            # Pass it on to the displays.
-            for display in self.game.displays:
-                await display.send_message(MessageTypes.DISPLAY_TEXT, msg_data)
-        elif msg_type == MessageTypes.PLAYER_BUZZED:
-            player = self.game.get_player_by_id(msg_data["player_id"])
-            if player in self.game.buzzes:
-                return
-            name = msg_data["player_name"]
-            log.info(f"Player '{name}' ({player.id}) buzzed in game {self.game.key}.")
-            self.game.buzzes.append(self)
-            # Pass it on to other admins.
-            for admin in self.game.admins:
-                if admin is self:
-                    continue
-                await admin.send_message(MessageTypes.PLAYER_BUZZED, msg_data)
-        elif msg_type == MessageTypes.CLEAR_BUZZ:
-            self.game.buzzes.popleft()
-            # Pass it on to other admins.
-            for admin in self.game.admins:
-                if admin is self:
-                    continue
-                await admin.send_message(MessageTypes.CLEAR_BUZZ)
-        elif msg_type == MessageTypes.CLEAR_ALL_BUZZES:
-            self.game.buzzes.clear()
-            # Pass it on to other admins.
-            for admin in self.game.admins:
-                if admin is self:
-                    continue
-                await admin.send_message(MessageTypes.CLEAR_ALL_BUZZES)
-        elif msg_type == MessageTypes.UPDATE_SCORE:
-            player_id = msg_data["player_id"]
-            score = msg_data["score"]
-            player_object = await sync_to_async(models.Player.objects.get)(id=player_id)
-            log.info(f"Received score update for player '{player_object.name}' ({player_object.id})"
-                     f" of game {self.game.key}, new value is {score}.")
-            player_object.score = score
-            await sync_to_async(player_object.save)()
-            # Pass it on to the displays.
-            for display in self.game.displays:
-                await display.send_message(MessageTypes.UPDATE_SCORE, msg_data)
-            # Pass it on to the player.
-            player = self.game.get_player_by_id(player_id)
-            del msg_data["player_id"]
-            await player.send_message(MessageTypes.UPDATE_SCORE, msg_data)
-        elif msg_type == MessageTypes.PLAY_SOUND:
-            # Pass it on to the displays and players.
-            for client in itertools.chain(self.game.displays, self.game.players):
-                await client.send_message(MessageTypes.PLAY_SOUND, msg_data)
-        elif msg_type == MessageTypes.TOGGLE_SCOREBOARD:
+        if self.game.round == new_round or new_round > self.game.final_round:
+            return
+        log.info(f"Changing to round {new_round} in game {self.game.key}.")
+        self.game.clear_question()
+        self.game.scoreboard_visible = False
+        # Clients reload the round from the database when they get this, so it has to be written first.
+        await WRITE_BEHIND.flush()
+        await self.game.change_round(new_round)
+        # Pass it on to everything.
+        await self.game.broadcast(MessageTypes.CHANGE_ROUND, msg_data)
+
+    @handlers.on(MessageTypes.POP_QUESTION, "question_id", "question_text", "specific_player")
+    async def handle_pop_question(self, msg_data):
+        question_uuid = self.game.pop_question(msg_data["question_id"], msg_data["question_text"])
+        # Pass it on to the displays.
+        await self.game.broadcast(MessageTypes.POP_QUESTION, msg_data, audiences=("displays",))
+        # Swap in the question UUID before passing it on to the players.
+        msg_data = dict(msg_data, question_id=question_uuid)
+        specific_player = msg_data.pop("specific_player")
+        if specific_player:
+            await self.game.send_to_player(specific_player, MessageTypes.POP_QUESTION, msg_data)
+        else:
+            await self.game.broadcast(MessageTypes.POP_QUESTION, msg_data, audiences=("players",))
+
+    @handlers.on(MessageTypes.CLEAR_QUESTION)
+    async def handle_clear_question(self, msg_data):
+        self.game.clear_question()
+        # Mark the question as answered.
+        if msg_data.get("answered"):
+            self.game.mark_answered(msg_data["question_id"])
+        # Pass it on to the displays.
+        await self.game.broadcast(MessageTypes.CLEAR_QUESTION, msg_data, audiences=("displays",))
+        # Strip out the question_id before passing it on to the players.
+        msg_data = {key: value for key, value in msg_data.items() if key != "question_id"}
+        await self.game.broadcast(MessageTypes.CLEAR_QUESTION, msg_data, audiences=("players",))
+
+    @handlers.on(MessageTypes.REQUIRE_WAGER, "player_id")
+    async def handle_require_wager(self, msg_data):
+        if self.game.round == self.game.final_round:
+            round_max_wager = 0
+        else:
+            round_max_wager = self.game.round * 1000
+        player_id = msg_data.pop("player_id")
+        if player_id:
+            if not self.game.get_player_connections(player_id):
+               log.error(f"Received a wager request for player ({player_id}) not found in game!")
+               return
+            log.info(f"Received a wager request for player ({player_id}) of game {self.game.key}.")
+            score = await self.game.get_score(player_id)
+            msg_data["max_wager"] = max(round_max_wager, score)
+            await self.game.send_to_player(player_id, MessageTypes.REQUIRE_WAGER, msg_data)
+        else:
+            # Send to all players.
+            log.info(f"Received a wager request for all players in game {self.game.key}.")
+            # This goes to every player in the game, so those that are offline get it when they reconnect.
+            await self.game.send_to_players(MessageTypes.REQUIRE_WAGER, msg_data, {
+                player_id: {"max_wager": max(round_max_wager, score)}
+                for player_id, score in self.game.scores.items()})
+
+    @handlers.on(MessageTypes.REQUIRE_ANSWER, "player_id")
+    async def handle_require_answer(self, msg_data):
+        player_id = msg_data.pop("player_id")
+        if player_id:
+            await self.game.send_to_player(player_id, MessageTypes.REQUIRE_ANSWER, msg_data)
+        else:
+            # Send to all players.
+            await self.game.broadcast(MessageTypes.REQUIRE_ANSWER, msg_data, audiences=("players",))
+
+    @handlers.on(MessageTypes.DISPLAY_TEXT, "player_id")
+    async def handle_display_text(self, msg_data):
+        player_id = msg_data.pop("player_id")
+        if player_id:
+            self.game.coalesce(MessageTypes.DISPLAY_TEXT, msg_data, player_id=player_id)
             # Pass it on to the displays.
-            for display in self.game.displays:
-                await display.send_message(MessageTypes.TOGGLE_SCOREBOARD)
+            self.game.coalesce(MessageTypes.DISPLAY_TEXT, msg_data, audiences=("displays",))
         else:
-            log.warning(f"Admin sent unhandled message type '{msg_type}': {msg_data}")
+            # Pass it on to all players and the displays.
+            self.game.coalesce(MessageTypes.DISPLAY_TEXT, msg_data, audiences=("displays", "players"))
+
+    @handlers.on(MessageTypes.PLAYER_BUZZED, "player_id", "player_name")
+    async def handle_player_buzzed(self, msg_data):
+        player_id = msg_data["player_id"]
+        name = msg_data["player_name"]
+        if not self.game.add_buzz(player_id, name):
+            return
+        log.info(f"Player '{name}' ({player_id}) buzzed in game {self.game.key}.")
+        # Pass it on to other admins.
+        await self.game.broadcast(MessageTypes.PLAYER_BUZZED, msg_data, audiences=("admins",), exclude=self)
+
+    @handlers.on(MessageTypes.CLEAR_BUZZ)
+    async def handle_clear_buzz(self, msg_data):
+        self.game.pop_buzz()
+        # Pass it on to other admins.
+        await self.game.broadcast(MessageTypes.CLEAR_BUZZ, audiences=("admins",), exclude=self)
+
+    @handlers.on(MessageTypes.CLEAR_ALL_BUZZES)
+    async def handle_clear_all_buzzes(self, msg_data):
+        self.game.clear_buzzes()
+        # Pass it on to other admins.
+        await self.game.broadcast(MessageTypes.CLEAR_ALL_BUZZES, audiences=("admins",), exclude=self)
+
+    @handlers.on(MessageTypes.UPDATE_SCORE, "player_id", "score")
+    async def handle_update_score(self, msg_data):
+        player_id = msg_data["player_id"]
+        score = msg_data["score"]
+        log.info(f"Received score update for player ({player_id}) of game {self.game.key}, new value is {score}.")
+        self.game.set_score(player_id, score)
+        # Pass it on to the displays.
+        self.game.coalesce(MessageTypes.UPDATE_SCORE, msg_data, audiences=("displays",), subject=player_id)
+        # Pass it on to the player.
+        self.game.coalesce(MessageTypes.UPDATE_SCORE, {"score": score}, player_id=player_id)
+
+    @handlers.on(MessageTypes.PLAY_SOUND)
+    async def handle_play_sound(self, msg_data):
+        # Pass it on to the displays and players.
+        await self.game.broadcast(MessageTypes.PLAY_SOUND, msg_data, audiences=("displays", "players"))
+
+    @handlers.on(MessageTypes.TOGGLE_SCOREBOARD)
+    async def handle_toggle_scoreboard(self, msg_data):
+        # The displays are told whether it's shown rather than to toggle it, so toggles can be coalesced.
+        self.game.scoreboard_visible = not self.game.scoreboard_visible
+        # Pass it on to the displays.
+        self.game.coalesce(MessageTypes.TOGGLE_SCOREBOARD, {"visible": self.game.scoreboard_visible},
+                           audiences=("displays",))
 
     def clean_up(self):
-        self.game.admins.remove(self)
+        self.game.admins.discard(self)
 
 
 class Display(Client):
 
-    @classmethod
-    async def new(cls, *args, **kwargs):
-        display = cls(*args, **kwargs)
-        # If there is a question popped, let the display know.
-        if display.game.popped_question_real_id:
-            await display.send_message(MessageTypes.POP_QUESTION, {
-                "question_id": display.game.popped_question_real_id,
-                "question_text": display.game.popped_question_text,
-            })
-        return display
+    audience = "displays"
+    # We don't currently handle any messages from displays.
+    handlers = Dispatcher("Display")
 
-    async def handle_message(self, msg_type, msg_data):
-        if not msg_type:
-            return
-        else:
-            # We don't currently handle any messages from displays.
-            log.warning(f"Display sent unhandled message type '{msg_type}': {msg_data}")
+    def state_frames(self):
+        frames = []
+        # If there is a question popped, let the display know.
+        if self.game.popped_question_real_id:
+            frames.append(Frame(MessageTypes.POP_QUESTION, {
+                "question_id": self.game.popped_question_real_id,
+                "question_text": self.game.popped_question_text,
+            }))
+        if self.game.scoreboard_visible:
+            frames.append(Frame(MessageTypes.TOGGLE_SCOREBOARD, {"visible": True}))
+        return frames
 
     def clean_up(self):
-        self.game.displays.remove(self)
+        self.game.displays.discard(self)
 
 
 class Player(Client):
 
+    audience = "players"
+    handlers = Dispatcher("Player")
+
     def __init__(self, websocket, game_key, player_id, player_name):
         self.id = player_id
         self.name = player_name
-        self.ping = -1
+        self.clock = ClockEstimate()
+        self.ping_slot = 0
         super().__init__(websocket, game_key)
 
     @classmethod
     async def new(cls, *args, **kwargs):
-        player = cls(*args, **kwargs)
-        # If there's an admin in our game already, let the player know.
-        if player.game.admins:
-            await player.send_message(MessageTypes.ADMIN_CONNECTED)
+        player = await super().new(*args, **kwargs)
         # Pass the player data on to the admins and displays.
-        player_object = await sync_to_async(models.Player.objects.get)(id=player.id)
-        for client in itertools.chain(player.game.admins, player.game.displays):
-            await client.send_message(MessageTypes.PLAYER_CONNECTED, {
-                "player_id": player.id,
-                "player_name": player.name,
-                "score": player_object.score,
-            })
+        await player.game.broadcast(MessageTypes.PLAYER_CONNECTED, {
+            "player_id": player.id,
+            "player_name": player.name,
+            "score": player.game.scores[player.id],
+        }, audiences=("admins", "displays"))
+        PING_WHEEL.add(player)
+        return player
+
+    async def catch_up(self, resume):
+        # Make sure the player's score is in the snapshot before their state is put together.
+        await self.game.get_score(self.id)
+        await super().catch_up(resume)
+
+    def state_frames(self):
+        frames = []
+        # If there's an admin in our game already, let the player know.
+        if self.game.admins:
+            frames.append(Frame(MessageTypes.ADMIN_CONNECTED))
         # Send the player their current score.
-        await player.send_message(MessageTypes.UPDATE_SCORE, {
-                "score": player_object.score,
-            })
+        frames.append(Frame(MessageTypes.UPDATE_SCORE, {
+            "score": self.game.scores[self.id],
+        }))
         # If there is a question popped, let the player know.
-        if player.game.popped_question_real_id:
-            await player.send_message(MessageTypes.POP_QUESTION, {
-                "question_id": player.game.popped_question_uuid,
-                "question_text": player.game.popped_question_text,
-            })
-        return player
+        if self.game.popped_question_real_id:
+            frames.append(Frame(MessageTypes.POP_QUESTION, {
+                "question_id": self.game.popped_question_uuid,
+                "question_text": self.game.popped_question_text,
+            }))
+        return frames
 
-    async def handle_message(self, msg_type, msg_data):
-        if not msg_type:
-            return
-        elif msg_type == MessageTypes.PING:
-            delta = time.time() - msg_data["start_time"]
-            self.ping = delta
-        elif msg_type == MessageTypes.PLAYER_BUZZED:
-            round = await sync_to_async(self.game.get_round)()
-            final_round = await sync_to_async(self.game.get_final_round)()
-            if round == final_round:
-                return
-            question_id = msg_data["question_id"]
-            if question_id != self.game.popped_question_uuid:
-                return
-            if self in self.game.buzzes:
-                return
-            log.info(f"Player '{self.name}' ({self.id}) buzzed in game {self.game.key}.")
-            self.game.buzzes.append(self)
-            # Pass it on to everything.
-            for client in itertools.chain(self.game.admins, self.game.displays, self.game.players):
-                await client.send_message(MessageTypes.PLAYER_BUZZED, msg_data)
-        elif msg_type == MessageTypes.PLAYER_ENTERED_WAGER:
-            amount = msg_data["amount"]
-            log.info(f"Player '{self.name}' ({self.id}) submit a wager of {amount} in game {self.game.key}.")
-            # Pass it on to admins.
-            for admin in self.game.admins:
-                await admin.send_message(MessageTypes.PLAYER_ENTERED_WAGER, msg_data)
-        elif msg_type == MessageTypes.PLAYER_ENTERED_ANSWER:
-            answer = msg_data["answer"]
-            log.info(f"Player '{self.name}' ({self.id}) submit an answer of '{answer}' in game {self.game.key}.")
-            # Pass it on to admins.
-            for admin in self.game.admins:
-                await admin.send_message(MessageTypes.PLAYER_ENTERED_ANSWER, msg_data)
+    @property
+    def latency(self):
+        """An estimate of this player's one-way latency, from their fastest recent ping."""
+        return self.clock.latency
+
+    @handlers.on(MessageTypes.PING, "start_time")
+    async def handle_ping(self, msg_data):
+        if "sent_at" in msg_data:
+            rtt = time.monotonic() - msg_data["sent_at"]
         else:
-            log.warning(f"Player sent unhandled message type '{msg_type}': {msg_data}")
+            rtt = time.time() - msg_data["start_time"]
+        if rtt < 0:
+            return
+        offset = None
+        if "client_time" in msg_data:
+            # Assume the client stamped its reply halfway through the round trip.
+            offset = msg_data["client_time"] - (msg_data["start_time"] + rtt / 2)
+        self.clock.add(rtt, offset)
+
+    @handlers.on(MessageTypes.PLAYER_BUZZED, "question_id")
+    async def handle_player_buzzed(self, msg_data):
+        if self.game.round == self.game.final_round:
+            return
+        question_id = msg_data["question_id"]
+        if question_id != self.game.popped_question_uuid:
+            return
+        if self.id in self.game.arbiter.pending_ids or self.id in self.game.buzzes:
+            return
+        log.info(f"Player '{self.name}' ({self.id}) buzzed in game {self.game.key}.")
+        # The arbiter will pass it on to everything once the buzz window closes.
+        self.game.arbiter.buzz(self, msg_data)
+
+    @handlers.on(MessageTypes.PLAYER_ENTERED_WAGER, "amount")
+    async def handle_player_entered_wager(self, msg_data):
+        amount = msg_data["amount"]
+        log.info(f"Player '{self.name}' ({self.id}) submit a wager of {amount} in game {self.game.key}.")
+        # Pass it on to admins.
+        await self.game.broadcast(MessageTypes.PLAYER_ENTERED_WAGER, msg_data, audiences=("admins",))
+
+    @handlers.on(MessageTypes.PLAYER_ENTERED_ANSWER, "answer")
+    async def handle_player_entered_answer(self, msg_data):
+        answer = msg_data["answer"]
+        log.info(f"Player '{self.name}' ({self.id}) submit an answer of '{answer}' in game {self.game.key}.")
+        # Pass it on to admins.
+        await self.game.broadcast(MessageTypes.PLAYER_ENTERED_ANSWER, msg_data, audiences=("admins",))
 
     def clean_up(self):
-        self.game.players.remove(self)
+        self.game.unregister_player(self)
+        PING_WHEEL.remove(self)
+
+
+class Server(Client):
+
+    """A connection from the web server, which isn't tied to any one game."""
+
+    handlers = Dispatcher("Server")
+
+    def __init__(self, websocket):
+        super().__init__(websocket)
+        # Nothing it's sent is numbered, so there's nothing to hold back.
+        self.catching_up = False
+
+    @classmethod
+    async def new(cls, *args, **kwargs):
+        log.info("Web server connected.")
+        return cls(*args, **kwargs)
+
+    async def handle_message(self, msg_type, msg_data):
+        await handle_server_message(msg_type, msg_data)
+
+    def clean_up(self):
+        log.info("Web server disconnected.")
+
+
+async def handle_server_message(msg_type, msg_data, forward=True):
+    """Handle a message from the web server, passing it on if another worker hosts its game."""
+    game_key = msg_data.get("game_key")
+    if game_key and not hosts_game(game_key):
+        worker_index = get_worker_index(game_key)
+        if forward and BACKPLANE:
+            await BACKPLANE.publish(worker_channel(worker_index), Frame(msg_type, msg_data).payload)
+        else:
+            log.warning(f"Game {game_key} is hosted by worker {worker_index}, dropping message of type {msg_type}.")
+        return
+    await Server.handlers.dispatch(None, msg_type, msg_data)
+
+
+@Server.handlers.on(MessageTypes.PLAYER_REGISTERED, "game_key", "player_id", "score")
+async def handle_player_registered(server, msg_data):
+    game = GAMES.get(msg_data["game_key"])
+    if not game or not game.loaded:
+        # The game's state will be loaded fresh when its first client connects.
+        return
+    # Seed the player's score so it's ready when their buzzer connects.
+    game.scores.setdefault(msg_data["player_id"], msg_data["score"])
+
+
+async def handle_backplane_message(channel, msg_json):
+    msg_type, msg_data = parse_message(msg_json)
+    if not msg_type:
+        return
+    try:
+        # Messages from the backplane were already routed, so they're never passed on again.
+        await handle_server_message(msg_type, msg_data, forward=False)
+    except Exception:
+        log.exception(f"Error handling backplane message: {msg_json}")
+
+
+# Handlers for the first message on a connection, which says what kind of client it is.
+CONNECT_HANDLERS = Dispatcher("Connection")
+
+
+@CONNECT_HANDLERS.on(MessageTypes.SERVER_CONNECTED)
+async def connect_server(websocket, msg_data):
+    return await Server.new(websocket)
+
+
+@CONNECT_HANDLERS.on(MessageTypes.ADMIN_CONNECTED, "game_key")
+async def connect_admin(websocket, msg_data):
+    return await Admin.new(websocket, msg_data.pop("game_key"), resume=msg_data)
+
+
+@CONNECT_HANDLERS.on(MessageTypes.DISPLAY_CONNECTED, "game_key")
+async def connect_display(websocket, msg_data):
+    return await Display.new(websocket, msg_data.pop("game_key"), resume=msg_data)
+
+
+@CONNECT_HANDLERS.on(MessageTypes.PLAYER_CONNECTED, "game_key", "player_id", "player_name")
+async def connect_player(websocket, msg_data):
+    return await Player.new(websocket, msg_data.pop("game_key"), msg_data["player_id"], msg_data["player_name"],
+                            resume=msg_data)
 
 
 async def create_client(websocket):
@@ -488,47 +1954,124 @@ async def create_client(websocket):
         msg_type, msg_data = parse_message(msg)
         if not msg_type:
             continue
-        if not "game_key" in msg_data:
-            log.error(f"Message has no game key: {msg}")
-            continue
-        game_key = msg_data.pop("game_key")
-        if msg_type == MessageTypes.ADMIN_CONNECTED:
-            return await Admin.new(websocket, game_key)
-        elif msg_type == MessageTypes.DISPLAY_CONNECTED:
-            return await Display.new(websocket, game_key)
-        elif msg_type == MessageTypes.PLAYER_CONNECTED:
-            player_id = msg_data["player_id"]
-            player_name = msg_data["player_name"]
-            return await Player.new(websocket, game_key, player_id, player_name)
-        else:
-            log.warning(f"Received message of type {msg_type} before detecting client type: {msg_data}")
+        MESSAGES_RECEIVED.inc(get_type_label(msg_type))
+        game_key = msg_data.get("game_key") if isinstance(msg_data, dict) else None
+        if game_key and not hosts_game(game_key):
+            # Pages are given the right worker's address, so this is a stale page or bad config.
+            log.warning(f"Client connected for game {game_key}, which is hosted by worker {get_worker_index(game_key)}.")
+            await websocket.send(Frame(MessageTypes.ERROR, {"error": "This game is hosted by another worker."}).payload)
+            return None
+        client = await CONNECT_HANDLERS.dispatch(websocket, msg_type, msg_data)
+        if client:
+            return client
 
 
 async def handle_websocket(websocket, path):
     host = websocket.remote_address[0]
     log.info(f"New connection from {host}.")
+    client = None
     try:
         client = await create_client(websocket)
-        await client.handler()
+        if client:
+            await client.handler()
     except websockets.ConnectionClosed:
         log.info(f"Lost connection from {host}.")
     else:
         await websocket.close()
-        client.clean_up()
+    finally:
+        if client:
+            client.clean_up()
+            outbox = client.outbox
+            if outbox.dropped or outbox.coalesced:
+                log.info(f"Outbox for {host} dropped {outbox.dropped} and coalesced {outbox.coalesced} messages,"
+                         f" peaking at {outbox.peak}.")
 
 
-def start_middleware():
-    log.info("Middleware started.")
+def start_middleware(host=HOST_URL, port=None, worker_index=0, metrics_port=None, db_threads=DB_THREADS,
+                     state_dir=STATE_DIR):
+    global BACKPLANE, WORKER_INDEX
+    WORKER_INDEX = worker_index
+    if port is None:
+        port = settings.MIDDLEWARE_WORKERS[worker_index][1]
+    if metrics_port is None:
+        metrics_port = port + METRICS_PORT_OFFSET
+    log.info(f"Middleware worker {worker_index} of {len(settings.MIDDLEWARE_WORKERS)} started on port {port},"
+             f" using {JSON_BACKEND} for JSON and offering {', '.join(ENCODINGS)}.")
+    DB.start(db_threads)
     if settings.ENABLE_SSL:
         ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         ssl_context.load_cert_chain(certfile=settings.SSL_CERT_PATH, keyfile=settings.SSL_KEY_PATH)
     else:
         ssl_context = None
-    server = websockets.serve(handle_websocket, HOST_URL, HOST_PORT, ssl=ssl_context)
     loop = asyncio.get_event_loop()
+    # Pick up where this worker left off before any clients come back.
+    try:
+        loop.run_until_complete(JOURNAL.restore(join(state_dir, f"worker-{worker_index}")))
+    except JournalLocked as exc:
+        log.error(f"{exc} Is worker {worker_index} already running? Use --state-dir to give this one its own.")
+        sys.exit(1)
+    JOURNAL.start()
+    server = websockets.serve(handle_websocket, host, port, ssl=ssl_context,
+                              **get_deflate_options(settings.MIDDLEWARE_DEFLATE))
     loop.run_until_complete(server)
-    loop.run_forever()
+    if metrics_port:
+        loop.run_until_complete(METRICS.serve(METRICS_HOST, metrics_port))
+        log.info(f"Serving metrics at http://{METRICS_HOST}:{metrics_port}/metrics.")
+    BACKPLANE = create_backplane(settings.MIDDLEWARE_BACKPLANE)
+    if BACKPLANE:
+        loop.run_until_complete(BACKPLANE.start())
+        loop.run_until_complete(BACKPLANE.subscribe(worker_channel(worker_index), handle_backplane_message))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Don't lose any updates that haven't been written yet.
+        log.info(f"Middleware stopping, flushing {WRITE_BEHIND.depth} pending updates.")
+        loop.run_until_complete(WRITE_BEHIND.close())
+        DB.close()
+        JOURNAL.close()
+        if BACKPLANE:
+            loop.run_until_complete(BACKPLANE.close())
+
+
+def spawn_workers(host=HOST_URL, db_threads=DB_THREADS, state_dir=STATE_DIR):
+    """Run every worker configured for this machine as a child process."""
+    processes = []
+    for worker_index, (worker_host, _) in enumerate(settings.MIDDLEWARE_WORKERS):
+        if worker_host in LOCAL_HOSTS:
+            processes.append(subprocess.Popen(
+                [sys.executable, abspath(__file__), "--host", host, "--worker", str(worker_index),
+                 "--db-threads", str(db_threads), "--state-dir", state_dir]))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        for process in processes:
+            process.wait()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        # The workers flush their pending updates when they're terminated.
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
 
 
 if __name__ == "__main__":
-    start_middleware()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default=HOST_URL)
+    parser.add_argument("--port", type=int, help="defaults to the worker's configured port")
+    parser.add_argument("--worker", type=int, default=0, help="index into settings.MIDDLEWARE_WORKERS")
+    parser.add_argument("--metrics-port", type=int,
+                        help=f"defaults to the worker's port plus {METRICS_PORT_OFFSET}, or 0 to turn metrics off")
+    parser.add_argument("--db-threads", type=int, default=DB_THREADS, help="threads to make database calls from")
+    parser.add_argument("--state-dir", default=STATE_DIR,
+                        help="where workers keep their journals, each in its own worker-N directory")
+    parser.add_argument("--spawn", action="store_true", help="start every worker configured for this machine")
+    args = parser.parse_args()
+    if args.spawn:
+        spawn_workers(args.host, args.db_threads, args.state_dir)
+    else:
+        start_middleware(args.host, args.port, args.worker, args.metrics_port, args.db_threads, args.state_dir)
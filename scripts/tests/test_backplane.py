@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Tests for the pub/sub backplane, against the stand-in server."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import asyncio
+from os.path import abspath, dirname
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from backplane import RedisBackplane, StandInServer  # noqa: E402
+
+
+async def wait_for(condition, timeout=2.0):
+    """Wait until condition() is true, failing if it takes too long."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError("Timed out waiting.")
+        await asyncio.sleep(0.01)
+
+
+class BackplaneTestCase(unittest.IsolatedAsyncioTestCase):
+
+    """A stand-in server that can be restarted on the same port, with backplanes connected to it."""
+
+    async def asyncSetUp(self):
+        self.port = None
+        self.connections = 0
+        self.writers = set()
+        self.stand_in = StandInServer()
+        self.server = None
+        self.backplanes = []
+        await self.start_server(self.stand_in.handle_connection)
+
+    async def asyncTearDown(self):
+        for backplane in self.backplanes:
+            await backplane.close()
+        await self.stop_server()
+
+    async def start_server(self, handler):
+        async def handle_connection(reader, writer):
+            self.connections += 1
+            self.writers.add(writer)
+            try:
+                await handler(reader, writer)
+            finally:
+                self.writers.discard(writer)
+
+        self.server = await asyncio.start_server(handle_connection, "localhost", self.port or 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop_server(self):
+        self.server.close()
+        # Closing the server doesn't close the connections it already has.
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+
+    async def create_backplane(self):
+        backplane = RedisBackplane("localhost", self.port, reconnect_delay=0.01, max_reconnect_delay=0.05)
+        await backplane.start()
+        self.backplanes.append(backplane)
+        return backplane
+
+    async def subscribe(self, channel):
+        backplane = await self.create_backplane()
+        received = []
+
+        async def callback(channel, message):
+            received.append(message)
+
+        await backplane.subscribe(channel, callback)
+        await wait_for(lambda: self.stand_in._subscribers.get(channel.encode()))
+        return backplane, received
+
+    async def test_publish(self):
+        backplane, received = await self.subscribe("one")
+        publisher = await self.create_backplane()
+        self.assertEqual(await publisher.publish("one", "hello"), 1)
+        self.assertEqual(await publisher.publish("two", "nobody"), 0)
+        await wait_for(lambda: received)
+        self.assertEqual(received, ["hello"])
+
+    async def test_reconnect(self):
+        backplane, received = await self.subscribe("one")
+        publisher = await self.create_backplane()
+        await publisher.publish("one", "before")
+        await self.stop_server()
+        self.assertEqual(await publisher.publish("one", "lost"), 0)
+        await self.start_server(self.stand_in.handle_connection)
+        # Both connections come back, and the subscriber subscribes again.
+        await wait_for(lambda: self.stand_in._subscribers.get(b"one"))
+        self.assertEqual(await publisher.publish("one", "after"), 1)
+        await wait_for(lambda: len(received) == 2)
+        self.assertEqual(received, ["before", "after"])
+
+    async def test_callback_error(self):
+        backplane = await self.create_backplane()
+        received = []
+
+        async def callback(channel, message):
+            if message == "bad":
+                raise ValueError(message)
+            received.append(message)
+
+        await backplane.subscribe("one", callback)
+        await wait_for(lambda: self.stand_in._subscribers.get(b"one"))
+        publisher = await self.create_backplane()
+        await publisher.publish("one", "bad")
+        await publisher.publish("one", "good")
+        await wait_for(lambda: received)
+        self.assertEqual(received, ["good"])
+        self.assertFalse(backplane._listener.done())
+
+    async def test_error_reply(self):
+        await self.stop_server()
+
+        async def refuse(reader, writer):
+            # Like a Redis server that wants a password.
+            while await reader.read(1024):
+                writer.write(b"-NOAUTH Authentication required.\r\n")
+            writer.close()
+
+        await self.start_server(refuse)
+        backplane = await self.create_backplane()
+        await backplane.subscribe("one", None)
+        self.assertEqual(await backplane.publish("one", "hello"), 0)
+        # The subscriber keeps trying rather than giving up.
+        connections = self.connections
+        await wait_for(lambda: self.connections >= connections + 2)
+        self.assertFalse(backplane._listener.done())
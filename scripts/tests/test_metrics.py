@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Tests for the middleware's metrics."""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import asyncio
+from os.path import abspath, dirname
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from metrics import Registry  # noqa: E402
+
+
+class RegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter("test_total", "A counter.", ("type",), {1: "PING"})
+        counter.inc(1)
+        counter.inc(1)
+        counter.inc('say "hi"\n', 5)
+        self.assertEqual(self.registry.render(), "\n".join((
+            "# HELP test_total A counter.",
+            "# TYPE test_total counter",
+            'test_total{type="PING"} 2',
+            'test_total{type="say \\"hi\\"\\n"} 5',
+        )) + "\n")
+
+    def test_counter_labels(self):
+        counter = self.registry.counter("test_total", "A counter.", ("type", "reason"))
+        counter.inc(("PING", "invalid"))
+        counter = self.registry.counter("test_plain_total", "A counter without labels.")
+        counter.inc()
+        self.assertIn('test_total{type="PING",reason="invalid"} 1\n', self.registry.render())
+        self.assertIn("test_plain_total 1\n", self.registry.render())
+
+    def test_gauge(self):
+        self.registry.gauge("test_clients", "A gauge.", lambda: {("GAME", "players"): 3}, ("game", "audience"))
+        self.assertIn('test_clients{game="GAME",audience="players"} 3\n', self.registry.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("test_seconds", "A histogram.", buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value)
+        self.assertEqual(self.registry.render(), "\n".join((
+            "# HELP test_seconds A histogram.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            "test_seconds_sum 6.05",
+            "test_seconds_count 4",
+        )) + "\n")
+
+
+class ServeTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def request(self, path):
+        registry = Registry()
+        registry.counter("test_total", "A counter.").inc()
+        server = await registry.serve("localhost", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        reader, writer = await asyncio.open_connection("localhost", server.sockets[0].getsockname()[1])
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        return response.decode()
+
+    async def test_metrics(self):
+        response = await self.request("/metrics")
+        self.assertTrue(response.startswith("HTTP/1.1 200 OK\r\n"))
+        self.assertIn("Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n", response)
+        self.assertTrue(response.endswith("\r\n\r\n# HELP test_total A counter.\n# TYPE test_total counter\n"
+                                          "test_total 1\n"))
+
+    async def test_not_found(self):
+        response = await self.request("/")
+        self.assertTrue(response.startswith("HTTP/1.1 404 Not Found\r\n"))
@@ -0,0 +1,780 @@
+# -*- coding: utf-8 -*-
+"""Tests for the WebSocket middleware.
+
+Run them from the repository root with:
+
+    python -m unittest discover scripts/tests
+
+"""
+# Part of Trebek (https://github.com/whutch/trebek)
+# :copyright: (c) 2018 Will Hutcheson
+# :license: MIT (https://github.com/whutch/trebek/blob/master/LICENSE.txt)
+
+import asyncio
+import datetime
+import json
+from os.path import abspath, dirname
+import sys
+import tempfile
+import threading
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+import websockets  # noqa: E402
+from websockets.extensions.permessage_deflate import PerMessageDeflate  # noqa: E402
+
+from backplane import LocalBackplane  # noqa: E402
+import middleware  # noqa: E402
+from middleware import (BatchLoader, ClockEstimate, Database, Dispatcher, Display, Frame, Game, GameJournal,  # noqa: E402
+                        GAMES, get_deflate_options, JournalLocked, MessageTypes, models, Outbox, parse_message,
+                        PING_WHEEL, PingWheel, Player, Server, SmallMessageDeflateFactory, WriteBehindQueue)
+
+
+class FakeWebSocket:
+
+    """Stands in for a client's connection, keeping every message sent to it."""
+
+    def __init__(self, incoming=()):
+        self.open = True
+        self.sent = []
+        self.incoming = list(incoming)
+
+    async def __aiter__(self):
+        for message in self.incoming:
+            yield message
+
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+
+    async def close(self):
+        self.open = False
+
+    def types(self):
+        return [message["type"] for message in self.sent]
+
+
+class OutboxTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.outbox = Outbox(size=2)
+
+    def types(self):
+        return [frame.type for frame in self.outbox.frames]
+
+    def test_coalesce(self):
+        self.outbox.put(Frame(MessageTypes.UPDATE_SCORE, {"player_id": 1, "score": 200}, seq=1))
+        self.outbox.put(Frame(MessageTypes.POP_QUESTION, {}, seq=2))
+        self.assertTrue(self.outbox.put(Frame(MessageTypes.UPDATE_SCORE, {"player_id": 1, "score": 400}, seq=3)))
+        # The newer score replaces the older one, at the back so the sequence stays in order.
+        self.assertEqual([frame.seq for frame in self.outbox.frames], [2, 3])
+        self.assertEqual(self.outbox.frames[-1].data["score"], 400)
+        self.assertEqual(self.outbox.coalesced, 1)
+
+    def test_coalesce_other_player(self):
+        self.outbox.put(Frame(MessageTypes.UPDATE_SCORE, {"player_id": 1, "score": 200}))
+        self.outbox.put(Frame(MessageTypes.POP_QUESTION))
+        # Nothing for player 2 to supersede, and nothing to drop.
+        self.assertFalse(self.outbox.put(Frame(MessageTypes.UPDATE_SCORE, {"player_id": 2, "score": 400})))
+        self.assertEqual(self.outbox.coalesced, 0)
+
+    def test_drop(self):
+        self.outbox.put(Frame(MessageTypes.POP_QUESTION))
+        self.outbox.put(Frame(MessageTypes.CLEAR_QUESTION))
+        self.assertTrue(self.outbox.put(Frame(MessageTypes.PING)))
+        self.assertEqual(self.types(), [MessageTypes.POP_QUESTION, MessageTypes.CLEAR_QUESTION])
+        self.assertEqual(self.outbox.dropped, 1)
+
+    def test_evict(self):
+        self.outbox.put(Frame(MessageTypes.PING))
+        self.outbox.put(Frame(MessageTypes.POP_QUESTION))
+        self.assertTrue(self.outbox.put(Frame(MessageTypes.PLAYER_BUZZED)))
+        self.assertEqual(self.types(), [MessageTypes.POP_QUESTION, MessageTypes.PLAYER_BUZZED])
+        self.assertEqual(self.outbox.dropped, 1)
+
+    def test_disconnect(self):
+        self.outbox.put(Frame(MessageTypes.POP_QUESTION))
+        self.outbox.put(Frame(MessageTypes.CLEAR_QUESTION))
+        self.assertFalse(self.outbox.put(Frame(MessageTypes.PLAYER_BUZZED)))
+        self.assertEqual(len(self.outbox), 2)
+
+    def test_urgent(self):
+        self.outbox.put(Frame(MessageTypes.POP_QUESTION))
+        self.outbox.put(Frame(MessageTypes.PING), urgent=True)
+        self.assertEqual(self.types(), [MessageTypes.PING, MessageTypes.POP_QUESTION])
+
+
+class FrameTestCase(unittest.TestCase):
+
+    def test_json(self):
+        frame = Frame(MessageTypes.UPDATE_SCORE, {"player_id": 1, "score": 200}, seq=3)
+        self.assertEqual(json.loads(frame.encode("json")),
+                         {"type": MessageTypes.UPDATE_SCORE, "data": {"player_id": 1, "score": 200}, "seq": 3})
+        self.assertEqual(json.loads(Frame(MessageTypes.PING).encode("json")), {"type": MessageTypes.PING, "data": {}})
+
+    @unittest.skipUnless(middleware.msgpack, "msgpack is not installed")
+    def test_msgpack(self):
+        frame = Frame(MessageTypes.UPDATE_SCORE, {"player_id": 1, "score": 200}, seq=3)
+        self.assertIsNone(frame._packed)
+        packed = frame.encode("msgpack")
+        self.assertEqual(middleware.msgpack.unpackb(packed, raw=False),
+                         [MessageTypes.UPDATE_SCORE, {"player_id": 1, "score": 200}, 3])
+        # Packed once, however many clients it's sent to.
+        self.assertIs(frame.encode("msgpack"), packed)
+        self.assertEqual(middleware.msgpack.unpackb(Frame(MessageTypes.PING).packed, raw=False),
+                         [MessageTypes.PING, {}])
+
+
+class SmallMessageDeflateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        factory = SmallMessageDeflateFactory(min_size=100)
+        _, self.extension = factory.process_request_params([], [])
+        # What the browser's end of the connection decompresses with.
+        self.client = PerMessageDeflate(False, False, 15, 15)
+
+    def test_small(self):
+        frame = websockets.frames.Frame(websockets.frames.Opcode.TEXT, b'{"type": 1}')
+        self.assertIs(self.extension.encode(frame), frame)
+
+    def test_large(self):
+        data = json.dumps({"type": MessageTypes.PING, "data": {"padding": "x" * 200}}).encode()
+        encoded = self.extension.encode(websockets.frames.Frame(websockets.frames.Opcode.TEXT, data))
+        self.assertTrue(encoded.rsv1)
+        self.assertLess(len(encoded.data), len(data))
+        self.assertEqual(self.client.decode(encoded).data, data)
+
+    def test_fragment(self):
+        # Only a whole message can be let through, since the first fragment says whether it's compressed.
+        frame = websockets.frames.Frame(websockets.frames.Opcode.TEXT, b'{"type": 1', fin=False)
+        self.assertTrue(self.extension.encode(frame).rsv1)
+
+    def test_disabled(self):
+        self.assertEqual(get_deflate_options(None), {"compression": None})
+        (factory,) = get_deflate_options({"min_size": 64})["extensions"]
+        self.assertEqual(factory.min_size, 64)
+
+class DispatcherTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.dispatcher = Dispatcher("Test")
+
+        @self.dispatcher.on(MessageTypes.PLAYER_BUZZED, "question_id")
+        async def handle_buzz(target, msg_data):
+            self.handled.append((target, msg_data))
+            return True
+
+        self.rejected = dict(middleware.MESSAGES_REJECTED.values)
+
+    def get_rejected(self):
+        counts = {key: value - self.rejected.get(key, 0) for key, value in middleware.MESSAGES_REJECTED.values.items()}
+        return {key: value for key, value in counts.items() if value}
+
+    def test_parse(self):
+        self.assertEqual(parse_message('{"type": 40, "data": {"question_id": 1}}'),
+                         (MessageTypes.PLAYER_BUZZED, {"question_id": 1}))
+        self.assertEqual(parse_message('{"type": 40}'), (MessageTypes.PLAYER_BUZZED, {}))
+
+    def test_parse_bad_types(self):
+        for message in ('{"type": [40], "data": {}}', '{"type": {"a": 1}}', '{"type": "40"}', '{"type": true}',
+                        '{"data": {}}', "[40, {}]", "40"):
+            self.assertIsNone(parse_message(message)[0], message)
+
+    async def test_dispatch(self):
+        self.assertTrue(await self.dispatcher.dispatch("target", MessageTypes.PLAYER_BUZZED, {"question_id": 1}))
+        self.assertEqual(self.handled, [("target", {"question_id": 1})])
+        self.assertEqual(self.get_rejected(), {})
+
+    async def test_unknown(self):
+        self.assertIsNone(await self.dispatcher.dispatch("target", 999, {}))
+        self.assertIsNone(await self.dispatcher.dispatch("target", MessageTypes.PING, {}))
+        self.assertEqual(self.handled, [])
+        self.assertEqual(self.get_rejected(), {("unknown", "unhandled"): 1, ("PING", "unhandled"): 1})
+
+    async def test_missing_fields(self):
+        self.assertIsNone(await self.dispatcher.dispatch("target", MessageTypes.PLAYER_BUZZED, {}))
+        self.assertIsNone(await self.dispatcher.dispatch("target", MessageTypes.PLAYER_BUZZED, [1]))
+        self.assertEqual(self.handled, [])
+        self.assertEqual(self.get_rejected(), {("PLAYER_BUZZED", "invalid"): 2})
+
+
+class MiddlewareTestCase(unittest.IsolatedAsyncioTestCase):
+
+    """A game that's already loaded, with helpers to connect fake clients to it."""
+
+    def setUp(self):
+        self.game = Game("TEST")
+        # Nothing here needs the database.
+        self.game.loaded = True
+
+    def tearDown(self):
+        if self.game._coalesce_task:
+            self.game._coalesce_task.cancel()
+        if PING_WHEEL._task:
+            PING_WHEEL._task.cancel()
+            PING_WHEEL._task = None
+        for player in list(self.game.players):
+            player.clean_up()
+        GAMES.pop("TEST", None)
+
+    async def connect(self, resume=None, incoming=()):
+        websocket = FakeWebSocket(incoming)
+        display = await Display.new(websocket, "TEST", resume=resume)
+        await display.drain()
+        return display, websocket
+
+    async def connect_player(self, player_id, resume=None):
+        websocket = FakeWebSocket()
+        self.game.scores.setdefault(player_id, 0)
+        player = await Player.new(websocket, "TEST", player_id, f"Player {player_id}", resume=resume)
+        await player.drain()
+        return player, websocket
+
+
+class ClientTestCase(MiddlewareTestCase):
+
+    async def test_outbox_overflow_disconnects(self):
+        display, websocket = await self.connect()
+        display.outbox.size = 1
+        # The writer doesn't get to run in between, so the second message overflows.
+        display.send_frame(Frame(MessageTypes.POP_QUESTION))
+        display.send_frame(Frame(MessageTypes.CLEAR_QUESTION))
+        self.assertTrue(display.stalled)
+        self.assertNotIn(display, self.game.displays)
+        await asyncio.sleep(0)
+        self.assertFalse(websocket.open)
+
+    async def test_unknown_types_counted_together(self):
+        received = dict(middleware.MESSAGES_RECEIVED.values)
+        display, websocket = await self.connect(incoming=[
+            json.dumps({"type": MessageTypes.PING, "data": {}}),
+            json.dumps({"type": 999, "data": {}}),
+            json.dumps({"type": "anything", "data": {}}),
+            # Not even something that can be looked up.
+            json.dumps({"type": [MessageTypes.PING], "data": {}}),
+        ])
+        await display.handler()
+        counts = {key: value - received.get(key, 0) for key, value in middleware.MESSAGES_RECEIVED.values.items()}
+        # Types that aren't numbers don't get past parse_message to be counted.
+        self.assertEqual({key: value for key, value in counts.items() if value}, {"PING": 1, "unknown": 1})
+
+
+    async def test_server(self):
+        websocket = FakeWebSocket()
+        server = await Server.new(websocket)
+        self.assertIsNone(server.game)
+        self.assertFalse(server.catching_up)
+        self.assertEqual(list(GAMES), ["TEST"])
+        await server.handle_message(MessageTypes.PLAYER_REGISTERED, {"game_key": "TEST", "player_id": 1, "score": 400})
+        self.assertEqual(self.game.scores, {1: 400})
+        # Nothing it's sent is held back.
+        server.send_frame(Frame(MessageTypes.PING))
+        await server.drain()
+        self.assertEqual(websocket.types(), [MessageTypes.PING])
+
+class ResumeTestCase(MiddlewareTestCase):
+
+    async def test_resume_replays_missed(self):
+        display, websocket = await self.connect()
+        await self.game.broadcast(MessageTypes.POP_QUESTION, {"question_id": 1}, audiences=("displays",))
+        await display.drain()
+        resume = {"stream": self.game.stream_id, "last_seq": websocket.sent[-1]["seq"],
+                  "client_id": websocket.sent[0]["data"]["client_id"]}
+        display.clean_up()
+        await self.game.broadcast(MessageTypes.PLAY_SOUND, {"sound": "buzz"}, audiences=("displays",))
+        await self.game.broadcast(MessageTypes.CLEAR_QUESTION, audiences=("players",))
+        await self.game.broadcast(MessageTypes.CLEAR_QUESTION, audiences=("displays",))
+        display, websocket = await self.connect(resume)
+        resumed = websocket.sent[0]["data"]
+        self.assertTrue(resumed["replayed"])
+        self.assertEqual(resumed["seq"], 4)
+        # Only what was sent to displays since the last message it saw.
+        self.assertEqual([(message["type"], message.get("seq")) for message in websocket.sent[1:]],
+                         [(MessageTypes.PLAY_SOUND, 2), (MessageTypes.CLEAR_QUESTION, 4)])
+
+    async def test_resume_too_far_behind(self):
+        self.game.history = type(self.game.history)(maxlen=2)
+        self.game.popped_question_real_id = 1
+        self.game.popped_question_text = "Question"
+        for _ in range(3):
+            await self.game.broadcast(MessageTypes.PLAY_SOUND, {"sound": "buzz"}, audiences=("displays",))
+        display, websocket = await self.connect({"stream": self.game.stream_id, "last_seq": 0})
+        self.assertFalse(websocket.sent[0]["data"]["replayed"])
+        # Sent the current state instead.
+        self.assertEqual(websocket.types(), [MessageTypes.RESUME, MessageTypes.POP_QUESTION])
+
+    async def test_resume_other_stream(self):
+        await self.game.broadcast(MessageTypes.PLAY_SOUND, {"sound": "buzz"}, audiences=("displays",))
+        display, websocket = await self.connect({"stream": "old", "last_seq": 0})
+        self.assertFalse(websocket.sent[0]["data"]["replayed"])
+        self.assertEqual(websocket.types(), [MessageTypes.RESUME])
+
+    async def test_resume_rereads_round(self):
+        state = (SimpleNamespace(current_round=2), 3, {})
+        with mock.patch.object(Game, "fetch_states", return_value={"TEST": state}) as fetch_states:
+            display, websocket = await self.connect({"round": 0})
+            self.assertEqual(websocket.sent[0]["data"]["round"], 0)
+            fetch_states.assert_not_called()
+            # The page has a round the snapshot doesn't, so the game is read again.
+            display, websocket = await self.connect({"round": 2})
+            fetch_states.assert_called_once_with(["TEST"])
+        self.assertEqual(websocket.sent[0]["data"]["round"], 2)
+        self.assertEqual(self.game.final_round, 3)
+
+    async def test_send_to_players(self):
+        first, first_websocket = await self.connect_player(1)
+        second, second_websocket = await self.connect_player(2)
+        resume = {"stream": self.game.stream_id, "last_seq": self.game.sequence,
+                  "client_id": second_websocket.sent[0]["data"]["client_id"]}
+        second.clean_up()
+        await self.game.send_to_players(MessageTypes.REQUIRE_WAGER, {}, {1: {"max_wager": 1000},
+                                                                         2: {"max_wager": 2000}})
+        await first.drain()
+        self.assertEqual(first_websocket.sent[-1]["data"], {"max_wager": 1000})
+        # One entry in the history for all of them, that each player gets their own copy of.
+        self.assertEqual(len(self.game.history), resume["last_seq"] + 1)
+        second, second_websocket = await self.connect_player(2, resume)
+        self.assertTrue(second_websocket.sent[0]["data"]["replayed"])
+        self.assertEqual([(message["type"], message["data"]) for message in second_websocket.sent[1:]],
+                         [(MessageTypes.REQUIRE_WAGER, {"max_wager": 2000})])
+
+
+class CoalesceTestCase(MiddlewareTestCase):
+
+    async def test_coalesced_sent_first(self):
+        display, websocket = await self.connect()
+        for visible in (True, False, True):
+            self.game.coalesce(MessageTypes.TOGGLE_SCOREBOARD, {"visible": visible}, audiences=("displays",))
+        await self.game.broadcast(MessageTypes.POP_QUESTION, {"question_id": 1}, audiences=("displays",))
+        await display.drain()
+        # Just the latest state, and ahead of the message that came after it.
+        self.assertEqual([(message["type"], message["data"]) for message in websocket.sent[1:]],
+                         [(MessageTypes.TOGGLE_SCOREBOARD, {"visible": True}),
+                          (MessageTypes.POP_QUESTION, {"question_id": 1})])
+
+    async def test_coalesced_sent_later(self):
+        display, websocket = await self.connect()
+        self.game.coalesce(MessageTypes.TOGGLE_SCOREBOARD, {"visible": True}, audiences=("displays",))
+        self.game.coalesce(MessageTypes.TOGGLE_SCOREBOARD, {"visible": False}, audiences=("displays",))
+        self.assertEqual(websocket.types(), [MessageTypes.RESUME])
+        await self.game._coalesce_task
+        await display.drain()
+        self.assertEqual(websocket.sent[1:], [
+            {"type": MessageTypes.TOGGLE_SCOREBOARD, "data": {"visible": False}, "seq": 1}])
+
+    async def test_coalesced_sent_before_player_message(self):
+        player, websocket = await self.connect_player(1)
+        self.game.coalesce(MessageTypes.UPDATE_SCORE, {"score": 200}, player_id=1)
+        self.game.coalesce(MessageTypes.UPDATE_SCORE, {"score": 400}, player_id=1)
+        await self.game.send_to_player(1, MessageTypes.REQUIRE_ANSWER)
+        await player.drain()
+        self.assertEqual([(message["type"], message["data"]) for message in websocket.sent[-2:]],
+                         [(MessageTypes.UPDATE_SCORE, {"score": 400}), (MessageTypes.REQUIRE_ANSWER, {})])
+
+
+class ForwardingTestCase(MiddlewareTestCase):
+
+    async def asyncSetUp(self):
+        self.backplane = LocalBackplane()
+        self.forwarded = []
+        # Two workers, with this one not hosting the game.
+        workers = override_settings(MIDDLEWARE_WORKERS=[(None, 8765), (None, 8766)])
+        workers.enable()
+        self.addCleanup(workers.disable)
+        self.host = middleware.get_worker_index("TEST")
+        for patch in (mock.patch.object(middleware, "BACKPLANE", self.backplane),
+                      mock.patch.object(middleware, "WORKER_INDEX", 1 - self.host)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        async def callback(channel, message):
+            self.forwarded.append((channel, message))
+
+        await self.backplane.subscribe(middleware.worker_channel(self.host), callback)
+
+    async def test_forward(self):
+        message = {"game_key": "TEST", "player_id": 1, "score": 400}
+        await middleware.handle_server_message(MessageTypes.PLAYER_REGISTERED, dict(message))
+        await asyncio.sleep(0)
+        # Sent on to the worker that hosts the game, rather than handled here.
+        self.assertEqual(self.forwarded, [(middleware.worker_channel(self.host),
+                                           Frame(MessageTypes.PLAYER_REGISTERED, message).payload)])
+        self.assertNotIn(1, self.game.scores)
+        with mock.patch.object(middleware, "WORKER_INDEX", self.host):
+            await middleware.handle_backplane_message(*self.forwarded[0])
+        self.assertEqual(self.game.scores[1], 400)
+
+    async def test_not_forwarded_again(self):
+        message = Frame(MessageTypes.PLAYER_REGISTERED, {"game_key": "TEST", "player_id": 1, "score": 400}).payload
+        # Arriving at the wrong worker from the backplane means a stale config, so it's dropped.
+        await middleware.handle_backplane_message(middleware.worker_channel(1 - self.host), message)
+        await asyncio.sleep(0)
+        self.assertEqual(self.forwarded, [])
+        self.assertNotIn(1, self.game.scores)
+
+
+class DatabaseTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.database = Database(threads=2)
+        self.addCleanup(self.database.close)
+
+    async def test_run(self):
+        name = await self.database.run("test", lambda: threading.current_thread().name)
+        self.assertTrue(name.startswith("db"))
+        self.assertEqual(self.database.pending, 0)
+
+    async def test_run_error(self):
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            await self.database.run("test", fail)
+        self.assertEqual(self.database.pending, 0)
+
+
+class BatchLoaderTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.loader = BatchLoader("test", self.fetch)
+
+    def fetch(self, keys):
+        self.calls.append(sorted(keys))
+        return {key: key * 10 for key in keys if key < 100}
+
+    async def test_batch(self):
+        results = await asyncio.gather(self.loader.load(1), self.loader.load(2), self.loader.load(1))
+        self.assertEqual(results, [10, 20, 10])
+        self.assertEqual(self.calls, [[1, 2]])
+        self.assertEqual(await self.loader.load(3), 30)
+        self.assertEqual(self.calls, [[1, 2], [3]])
+
+    async def test_missing(self):
+        results = await asyncio.gather(self.loader.load(1), self.loader.load(100), return_exceptions=True)
+        self.assertEqual(results[0], 10)
+        self.assertIsInstance(results[1], KeyError)
+
+    async def test_fetch_error(self):
+        self.loader.fetch = lambda keys: {}[None]
+        results = await asyncio.gather(self.loader.load(1), self.loader.load(2), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, KeyError) for result in results))
+
+    async def test_cancelled(self):
+        cancelled = asyncio.ensure_future(self.loader.load(1))
+        waiting = asyncio.ensure_future(self.loader.load(1))
+        other = asyncio.ensure_future(self.loader.load(2))
+        await asyncio.sleep(0)
+        # Say, a client that disconnected while its score was being looked up.
+        cancelled.cancel()
+        self.assertEqual(await asyncio.wait_for(asyncio.gather(waiting, other), 2), [10, 20])
+        self.assertTrue(cancelled.cancelled())
+
+
+class JournalTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.addCleanup(GAMES.clear)
+        # The games are "in the database" as long as they were in the journal.
+        fetch_states = mock.patch.object(Game, "fetch_states", side_effect=lambda game_keys: {
+            game_key: (SimpleNamespace(current_round=1), 2, {}) for game_key in game_keys})
+        fetch_states.start()
+        self.addCleanup(fetch_states.stop)
+
+    async def restore(self):
+        """Start a journal on the directory, as a restarted worker would."""
+        GAMES.clear()
+        journal = GameJournal()
+        patch = mock.patch.object(middleware, "JOURNAL", journal)
+        patch.start()
+        self.addCleanup(patch.stop)
+        await journal.restore(self.directory)
+        self.addCleanup(journal.close)
+        return journal
+
+    def crash(self, journal):
+        """Stop a journal without the snapshot it would write on a clean shutdown."""
+        journal._writer.shutdown(wait=True)
+        journal._writer = None
+        journal._close_log()
+        journal._lock_file.close()
+        journal._lock_file = None
+
+    async def test_snapshot(self):
+        journal = await self.restore()
+        game = Game("TEST")
+        question_uuid = game.pop_question(5, "Question")
+        game.add_buzz(1, "One")
+        game.add_buzz(2, "Two")
+        journal.close()
+        await self.restore()
+        game = GAMES["TEST"]
+        self.assertEqual((game.popped_question_real_id, game.popped_question_text, game.popped_question_uuid),
+                         (5, "Question", question_uuid))
+        self.assertEqual([tuple(buzz) for buzz in game.buzzes], [(1, "One"), (2, "Two")])
+        self.assertTrue(game.loaded)
+        self.assertEqual(game.round, 1)
+
+    async def test_replay(self):
+        journal = await self.restore()
+        game = Game("TEST")
+        game.pop_question(5, "Question")
+        game.add_buzz(1, "One")
+        await asyncio.wrap_future(journal.snapshot())
+        # Only in the log after the snapshot.
+        game.add_buzz(2, "Two")
+        game.pop_buzz()
+        self.crash(journal)
+        await self.restore()
+        game = GAMES["TEST"]
+        self.assertEqual(game.popped_question_real_id, 5)
+        self.assertEqual([tuple(buzz) for buzz in game.buzzes], [(2, "Two")])
+
+    async def test_replay_several_games(self):
+        journal = await self.restore()
+        Game("TEST").pop_question(5, "Question")
+        GAMES["TEST"].clear_question()
+        Game("OTHER").pop_question(6, "Other question")
+        self.crash(journal)
+        await self.restore()
+        self.assertIsNone(GAMES["TEST"].popped_question_real_id)
+        self.assertEqual(GAMES["OTHER"].popped_question_real_id, 6)
+
+    async def test_locked(self):
+        await self.restore()
+        with self.assertRaises(JournalLocked):
+            await GameJournal().restore(self.directory)
+
+
+class BuzzArbiterTestCase(MiddlewareTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.arbiter = self.game.arbiter
+        self.arbiter.window = 0.2
+
+    def buzz(self, player_id, latency):
+        player = SimpleNamespace(id=player_id, name=f"Player {player_id}", latency=latency)
+        self.arbiter.buzz(player, {"player_id": player_id, "player_name": player.name})
+
+    async def close_window(self):
+        await self.arbiter._task
+
+    async def test_order_by_latency(self):
+        display, websocket = await self.connect()
+        self.buzz(1, 0.0)
+        # Arrived later, but made up for by its latency.
+        self.buzz(2, 0.1)
+        self.buzz(3, 0.0)
+        self.assertEqual(self.arbiter.pending_ids, {1, 2, 3})
+        self.assertEqual(list(self.game.buzzes), [])
+        await self.close_window()
+        await display.drain()
+        self.assertEqual([buzz.id for buzz in self.game.buzzes], [2, 1, 3])
+        self.assertEqual([message["data"]["player_id"] for message in websocket.sent[1:]], [2, 1, 3])
+        self.assertEqual(self.arbiter.pending_ids, set())
+
+    async def test_compensation_capped(self):
+        self.buzz(1, 0.15)
+        await asyncio.sleep(0.1)
+        # Its latency would put it first, if it wasn't capped at the window.
+        self.buzz(2, 10.0)
+        await self.close_window()
+        self.assertEqual([buzz.id for buzz in self.game.buzzes], [1, 2])
+
+    async def test_already_entered(self):
+        display, websocket = await self.connect()
+        self.buzz(1, 0.0)
+        self.buzz(2, 0.0)
+        # An admin enters the buzz by hand while the window is open.
+        self.game.add_buzz(2, "Player 2")
+        await self.close_window()
+        await display.drain()
+        self.assertEqual([buzz.id for buzz in self.game.buzzes], [2, 1])
+        self.assertEqual([message["data"]["player_id"] for message in websocket.sent[1:]], [1])
+
+    async def test_clear(self):
+        self.buzz(1, 0.0)
+        task = self.arbiter._task
+        self.game.clear_buzzes()
+        await asyncio.sleep(0)
+        self.assertTrue(task.cancelled())
+        self.assertEqual(self.arbiter.pending_ids, set())
+        self.assertEqual(list(self.game.buzzes), [])
+
+
+class ClockEstimateTestCase(unittest.TestCase):
+
+    def test_min_rtt(self):
+        clock = ClockEstimate(size=3)
+        for rtt in (0.1, 0.05, 0.2):
+            clock.add(rtt)
+        self.assertEqual(clock.min_rtt, 0.05)
+        self.assertEqual(clock.latency, 0.025)
+        # The fastest round trip falls out of the window.
+        clock.add(0.3)
+        clock.add(0.3)
+        self.assertEqual(clock.min_rtt, 0.2)
+
+    def test_smoothing(self):
+        clock = ClockEstimate()
+        clock.add(0.1)
+        self.assertEqual(clock.rtt, 0.1)
+        clock.add(0.2)
+        self.assertAlmostEqual(clock.rtt, 0.12)
+
+    def test_offset(self):
+        clock = ClockEstimate()
+        self.assertEqual(clock.to_dict(), {"rtt": 0.0, "latency": 0.0, "offset": None})
+        clock.add(0.1, 1.0)
+        self.assertEqual(clock.offset, 1.0)
+        # Too slow to trust.
+        clock.add(0.5, 5.0)
+        self.assertEqual(clock.offset, 1.0)
+        clock.add(0.15, 2.0)
+        self.assertAlmostEqual(clock.offset, 1.2)
+        self.assertEqual(clock.to_dict(), {"rtt": 174.0, "latency": 50.0, "offset": 1200.0})
+
+
+class FakeClient:
+
+    """Keeps the frames it's sent, for a wheel or broadcast to send to."""
+
+    def __init__(self, player_id=None):
+        self.id = player_id
+        self.clock = ClockEstimate()
+        self.frames = []
+
+    def send_frame(self, frame, urgent=False):
+        self.frames.append((frame, urgent))
+
+
+class PingWheelTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.wheel = PingWheel(interval=0.02, slots=2)
+        self.addCleanup(GAMES.pop, "PINGS", None)
+
+    def tearDown(self):
+        if self.wheel._task:
+            self.wheel._task.cancel()
+
+    async def test_slots(self):
+        players = [FakeClient(player_id) for player_id in (1, 2, 3)]
+        for player in players:
+            self.wheel.add(player)
+        self.assertEqual([player.ping_slot for player in players], [0, 1, 0])
+        self.assertEqual(self.wheel.slots, [{players[0], players[2]}, {players[1]}])
+        self.wheel.remove(players[2])
+        self.assertEqual(self.wheel.slots, [{players[0]}, {players[1]}])
+
+    async def test_ping(self):
+        players = [FakeClient(player_id) for player_id in (1, 2, 3)]
+        for player in players:
+            self.wheel.add(player)
+        self.wheel.remove(players[2])
+        await asyncio.sleep(0.05)
+        for player in players[:2]:
+            self.assertTrue(player.frames)
+            for frame, urgent in player.frames:
+                self.assertEqual(frame.type, MessageTypes.PING)
+                self.assertEqual(set(frame.data), {"start_time", "sent_at"})
+                self.assertTrue(urgent)
+        self.assertEqual(players[2].frames, [])
+        # Dealt in with the second player this time, and sent the same frame.
+        self.wheel.add(players[2])
+        self.assertEqual(players[2].ping_slot, 1)
+        await asyncio.sleep(0.03)
+        self.assertIs(players[1].frames[-1][0], players[2].frames[-1][0])
+
+    async def test_latency_report(self):
+        game = Game("PINGS")
+        admin = FakeClient()
+        player = FakeClient(1)
+        player.clock.add(0.1)
+        game.admins.add(admin)
+        game.players.add(player)
+        self.wheel.add(player)
+        await asyncio.sleep(0.05)
+        reports = [frame for frame, _ in admin.frames]
+        self.assertTrue(reports)
+        self.assertEqual(reports[0].type, MessageTypes.LATENCY_REPORT)
+        self.assertEqual(reports[0].data, {"players": {"1": {"rtt": 100.0, "latency": 50.0, "offset": None}}})
+        self.assertIsNone(reports[0].seq)
+        self.assertEqual(list(game.history), [])
+
+
+class WriteBehindTestCase(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # A throwaway database, rather than whatever the settings point at.
+        cls.old_name = connection.creation.create_test_db(verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connection.creation.destroy_test_db(cls.old_name, verbosity=0)
+        super().tearDownClass()
+
+    def setUp(self):
+        # A long interval, so nothing is written until the test flushes.
+        self.queue = WriteBehindQueue(interval=60)
+        self.game = models.Game.objects.create(name="Write Behind", date=datetime.date(2021, 6, 12), key="WRBH")
+        self.addCleanup(self.game.delete)
+        self.player = models.Player.objects.create(game=self.game, name="Alex")
+        game_round = models.GameRound.objects.create(game=self.game, round=1)
+        self.question_ids = []
+        for index in range(2):
+            question = models.Question.objects.create(text=f"Question {index}", answer="Answer")
+            models.QuestionState.objects.create(game_round=game_round, question=question)
+            self.question_ids.append(question.id)
+
+    async def asyncTearDown(self):
+        await self.queue.close()
+
+    def fetch(self):
+        """Return the player's score, the answered question IDs and the board version."""
+        return (models.Player.objects.get(id=self.player.id).score,
+                set(models.QuestionState.objects.filter(answered=True).values_list("question", flat=True)),
+                models.Game.objects.get(id=self.game.id).board_version)
+
+    def test_coalesce(self):
+        self.queue.update_score(1, 200)
+        self.queue.update_score(1, 600)
+        self.queue.update_score(2, -400)
+        self.queue.mark_answered("WRBH", 5)
+        self.queue.mark_answered("WRBH", 5)
+        self.queue.mark_answered("WRBH", 3)
+        self.assertEqual(self.queue.depth, 4)
+        self.assertEqual(self.queue.get_pending_scores(), {1: 600, 2: -400})
+        self.assertEqual(self.queue.to_snapshot(), {
+            "scores": [(1, 600), (2, -400)],
+            "answered": [["WRBH", [3, 5]]],
+        })
+
+    async def test_flush(self):
+        self.queue.update_score(self.player.id, 400)
+        self.queue.update_score(self.player.id, 800)
+        self.queue.mark_answered("WRBH", self.question_ids[0])
+        await self.queue.flush()
+        self.assertEqual(self.queue.depth, 0)
+        # The board version goes up too, since boards rendered before the write are stale now.
+        self.assertEqual(await middleware.DB.run("test", self.fetch), (800, {self.question_ids[0]}, 1))
+
+    async def test_flush_error(self):
+        self.queue.update_score(1, 200)
+        with mock.patch.object(WriteBehindQueue, "_write", side_effect=RuntimeError("database is gone")):
+            with self.assertLogs("middleware", "ERROR"):
+                await self.queue.flush()
+        self.queue.update_score(2, 400)
+        # Put back for the next flush.
+        self.assertEqual(self.queue.get_pending_scores(), {1: 200, 2: 400})